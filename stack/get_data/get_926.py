@@ -6,9 +6,11 @@ import os
 import json
 
 try:
-    from get_data.helper_get import get_rds, upload_file
+    from get_data.helper_get import upload_file
+    from get_data.helper_rds import get_rds
 except ModuleNotFoundError:
-    from helper_get import get_rds, upload_file
+    from helper_get import upload_file
+    from helper_rds import get_rds
 
 
 def lambda_handler(event, context):
@@ -4,11 +4,14 @@ except ImportError:
     pass
 import os
 import json
+from functools import partial
 
 try:
-    from get_data.helper_get import sap_post_req, write_sap_json, upload_file
+    from get_data.helper_get import sap_cached_req, iter_sap_rows, fetch_concurrently, upload_rows
+    from get_data.helper_join import build_keys, key_field, semi_join
 except ModuleNotFoundError:
-    from helper_get import sap_post_req, write_sap_json, upload_file
+    from helper_get import sap_cached_req, iter_sap_rows, fetch_concurrently, upload_rows
+    from helper_join import build_keys, key_field, semi_join
 """
 All buildings associated with sites that match the site (Location) filter criteria 
 should be included (where Site Building Reference flag is ticked “X”). 
@@ -39,7 +42,7 @@ def get_buildings(local=False):
     bldg_table_name = "ZTXXETBLDG"
     bldg_select_fields = "GEBNR,ZBLDGNAME,LAND1"
     bldg_where_field = "endda eq '99991231'"
-    return sap_post_req(
+    return iter_sap_rows(
         bldg_table_name, bldg_select_fields, bldg_where_field, header_mapping, local
     )
 
@@ -48,12 +51,29 @@ def get_sites(local=False):
     site_table_name = "T001W"
     site_select_fields = "WERKS"
     site_where_field = "ZZBLDG_REF EQ 'X'"
-    site_rows = sap_post_req(
+    # T001W is also read by get_location_site, in the same cycle it comes from the cache
+    site_rows = sap_cached_req(
         site_table_name, site_select_fields, site_where_field, None, local
     )
     return [site_row["WERKS"] for site_row in site_rows]
 
 
+def process_buildings(bldg_rows, site_id_list):
+    """only keep the Buildings that match a Site (which are already selected based on Flag)"""
+
+    # Superior Loc ID is the first 4 digits of the building's Location Reference ID
+    site_id = key_field("id", 4)
+
+    # if this Site is actively maintained, then append default fields, and add it to results
+    for row in semi_join(bldg_rows, build_keys(site_id_list), site_id):
+        row["Location_Usage_Type"] = "WORK SPACE"
+        row["Location_Type_ID"] = "B"
+        row["parentid"] = site_id(row)
+        row["Time_Profile_ID"] = ""
+        row["Default_Currency_ID"] = ""
+        yield row
+
+
 def lambda_handler(event, context):
     """Location - Buildings"""
 
@@ -61,26 +81,11 @@ def lambda_handler(event, context):
     bucket_name = os.environ.get("BUCKET")
     bucket_prefix = os.environ.get("BUILDING_NEW")
 
-    # get the list of Buildings from  ZTXXETBLDG
-    bldg_rows = get_buildings(event == "")
-
     # get all the Site IDs (field WERKS) for active Sites from T001W as a list
-    site_id_list = get_sites(event == "")
-
-    # only keep the Buildings that match a Site (which are already selected based on Flag)
-    results = []
-    for row in bldg_rows:
-        # Superior Loc ID is the first 4 digits of the building's Location Reference ID
-        site_id = row["id"][:4]
-
-        # if this Site is actively maintained, then append default fields, and add it to results
-        if site_id in site_id_list:
-            row["Location_Usage_Type"] = "WORK SPACE"
-            row["Location_Type_ID"] = "B"
-            row["parentid"] = site_id
-            row["Time_Profile_ID"] = ""
-            row["Default_Currency_ID"] = ""
-            results.append(row)
+    # while the list of Buildings from ZTXXETBLDG starts streaming
+    site_id_list, bldg_rows = fetch_concurrently(
+        partial(get_sites, event == ""), partial(get_buildings, event == "")
+    )
 
     # manual mode prevents s3 trigger
     try:
@@ -89,12 +94,12 @@ def lambda_handler(event, context):
     except KeyError:
         file_name = "building.json"
 
-    # write locally and uplaod to s3
-    output_path = f"/tmp/{file_name}" if event else f"tmp/{file_name}"
-    write_sap_json(results, output_path)
-    upload_file(output_path, bucket_name, bucket_prefix, file_name)
+    # filter the buildings while they are uploaded to s3
+    result_count = upload_rows(
+        process_buildings(bldg_rows, site_id_list), bucket_name, bucket_prefix, file_name
+    )
 
-    return {"result_count": len(results)}
+    return {"result_count": result_count}
 
 
 # if __name__ == "__main__":
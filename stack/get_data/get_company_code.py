@@ -5,11 +5,14 @@ except ImportError:
 
 import os
 import json
+from functools import partial
 
 try:
-    from get_data.helper_get import sap_post_req, write_sap_json, upload_file
+    from get_data.helper_get import sap_post_req, iter_sap_rows, fetch_concurrently, upload_rows
+    from get_data.helper_join import build_keys, key_field, semi_join
 except ModuleNotFoundError:
-    from helper_get import sap_post_req, write_sap_json, upload_file
+    from helper_get import sap_post_req, iter_sap_rows, fetch_concurrently, upload_rows
+    from helper_join import build_keys, key_field, semi_join
 
 
 """
@@ -45,7 +48,7 @@ def get_companies(local=False):
     cpny_select_fields = "BUKRS,BUTXT,WAERS,LAND1"  # SPRAS,ZZCCTYPID,ZZCCLNAME,ORT01
     cpny_where_field = ""
 
-    return sap_post_req(
+    return iter_sap_rows(
         cpny_table_name, cpny_select_fields, cpny_where_field, header_mapping, local
     )
 
@@ -62,30 +65,28 @@ def get_companies_to_keep(local=False):
     return [cpny_codes["BUKRS"] for cpny_codes in cpny_code_rows]
 
 
-def lambda_handler(event, context):
+def process_companies(cpny_rows, cpny_code_list):
+    """only keep the Company Codes that are in T001Z"""
 
-    # get environment variables
-    bucket_name = os.environ.get("BUCKET")
-    bucket_prefix = os.environ.get("COMPANYCODE_NEW")
+    for row in semi_join(cpny_rows, build_keys(cpny_code_list), key_field("id")):
 
-    # get the list of all Company Codes from T001
-    cpny_rows = get_companies(event == "")
+        # we're removing currency code
+        row.pop("currencycode", None)
 
-    # get the list of Company Codes that we want to keep from T001Z
-    cpny_code_list = get_companies_to_keep(event == "")
+        yield row
 
-    # only keep the Buildings that match a Site (which are already selected based on Flag)
-    results = []
-    failures = []
-    for row in cpny_rows:
-        cpny_id = row["id"]
 
-        if cpny_id in cpny_code_list:
+def lambda_handler(event, context):
 
-            # we're removing currency code
-            row.pop("currencycode", None)
+    # get environment variables
+    bucket_name = os.environ.get("BUCKET")
+    bucket_prefix = os.environ.get("COMPANYCODE_NEW")
 
-            results.append(row)
+    # get the list of Company Codes that we want to keep from T001Z
+    # while the list of all Company Codes from T001 starts streaming
+    cpny_code_list, cpny_rows = fetch_concurrently(
+        partial(get_companies_to_keep, event == ""), partial(get_companies, event == "")
+    )
 
     try:
         mode = event["mode"]
@@ -93,10 +94,8 @@ def lambda_handler(event, context):
     except KeyError:
         file_name = "companycode.json"
 
-    output_path = f"/tmp/{file_name}" if event else f"tmp/{file_name}"
-    write_sap_json(results, output_path)
-
-    upload_file(output_path, bucket_name, bucket_prefix, file_name)
+    # filter the companies while they are uploaded to s3
+    upload_rows(process_companies(cpny_rows, cpny_code_list), bucket_name, bucket_prefix, file_name)
 
 
 # if __name__ == "__main__":
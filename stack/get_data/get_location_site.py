@@ -8,9 +8,25 @@ import json
 import boto3
 
 try:
-    from get_data.helper_get import sap_post_req, write_sap_json, upload_file
+    from get_data.helper_get import (
+        iter_sap_rows,
+        iter_sap_rows_in,
+        sap_cached_req,
+        write_sap_json,
+        upload_rows,
+    )
+    from get_data.helper_join import build_index, build_keys, key_field, left_join
+    from get_data.helper_table import select
 except ModuleNotFoundError:
-    from helper_get import sap_post_req, write_sap_json, upload_file
+    from helper_get import (
+        iter_sap_rows,
+        iter_sap_rows_in,
+        sap_cached_req,
+        write_sap_json,
+        upload_rows,
+    )
+    from helper_join import build_index, build_keys, key_field, left_join
+    from helper_table import select
 
 """
 921 – HR GEO HIER WITH SITE-HYBRID 
@@ -66,12 +82,14 @@ def get_t001w(local=False):
     )
     site_where_field = "ZZBLDG_REF EQ 'X'"
 
-    return sap_post_req(
+    # T001W is also read by get_buildings, in the same cycle it comes from the cache
+    return sap_cached_req(
         site_table_name, site_select_fields, site_where_field, field_mapping_t001w, local,
     )
 
 
-def get_adrc(local=False):
+def get_adrc(local=False, address_numbers=None):
+    """ADRC fields by ADDRNUMBER, only for address_numbers when given rather than the whole table"""
 
     field_mapping_adrc = {
         "STR_SUPPL3": "City_Subdivision_1",
@@ -82,21 +100,62 @@ def get_adrc(local=False):
     adrc_select_fields = "ADDRNUMBER,STR_SUPPL3,CITY2"
     adrc_where_field = "ADDR_GROUP EQ 'CA01'"
 
-    adrc_response = sap_post_req(
-        adrc_table_name, adrc_select_fields, adrc_where_field, field_mapping_adrc, local
+    if address_numbers is None:
+        adrc_rows = iter_sap_rows(
+            adrc_table_name, adrc_select_fields, adrc_where_field, field_mapping_adrc, local
+        )
+    else:
+        adrc_rows = iter_sap_rows_in(
+            adrc_table_name,
+            adrc_select_fields,
+            adrc_where_field,
+            field_mapping_adrc,
+            "ADDRNUMBER",
+            address_numbers,
+            local,
+        )
+
+    # index ADRC repsonse so the key becomes the ADDRNUMBER field to join with sites
+    # only the two fields used for the sites are kept, as compact rows sharing one header
+    return build_index(
+        adrc_rows,
+        key_field("join_field"),
+        lambda row: select(row, ("City_Subdivision_1", "Region_Subdivision_1")),
     )
 
-    write_sap_json(adrc_response, "/tmp/adrc_response.json")
 
-    # process ADRC repsonse so the key becomes the ADDRNUMBER field to join with sites
-    results = {}
-    for row in adrc_response:
-        results[row["join_field"]] = {
-            "City_Subdivision_1": f"{row['City_Subdivision_1']}",
-            "Region_Subdivision_1": f"{row['Region_Subdivision_1']}",
-        }
+def add_site_defaults(row):
+    """populate non address related data and defaults"""
+    row["Location_Usage_Type"] = "BUSINESS SITE"
+    row["User_Language_ID"] = "en_US"
+    # Location_Hierarchy_Reference
+    row["ParentId"] = row["ID"]
+    row["Default_Currency_ID"] = ""
+    row["Time_Profile_ID"] = ""
+    row["Address_Line_2"] = ""
+    return row
+
+
+def add_adrc_fields(row, joined_fields):
+    """we are getting these two fields from ADRC, they are empty when the site isn't in ADRC"""
+    joined_fields = joined_fields or {}
+    row["Region_Subdivision_1"] = joined_fields.get("Region_Subdivision_1", "")
+    row["City_Subdivision_1"] = joined_fields.get("City_Subdivision_1", "")
+
+    # remove the field that we are using to join with adrc
+    row.pop("join_field", None)
+    return row
+
+
+def process_sites(site_rows, adrc_rows, adrc_failures):
+    """adds defaults and the ADRC fields to each site as it is streamed from T001W"""
+
+    # populate non address related data and defaults first
+    site_rows = (add_site_defaults(row) for row in site_rows)
 
-    return results
+    return left_join(
+        site_rows, adrc_rows, key_field("join_field"), add_adrc_fields, adrc_failures
+    )
 
 
 def lambda_handler(event, context):
@@ -105,52 +164,28 @@ def lambda_handler(event, context):
     data_bucket_name = os.environ.get("BUCKET")
     data_bucket_prefix = os.environ.get("SITE_NEW")
 
-    # Make request to T001W
-    site_rows = get_t001w(event == "")
-    adrc_rows = get_adrc(event == "")
+    # only the ADRC addresses of the sites are read, so T001W is read first for their ADRNR
+    site_rows = list(get_t001w(event == ""))
+    address_numbers = build_keys(site_rows, key_field("join_field")) - {""}
+    adrc_rows = get_adrc(event == "", address_numbers)
 
-    # process results
+    # process results while they are uploaded to s3
     adrc_failures = []
-
-    for row in site_rows:
-
-        # populate non address related data and defaults first
-        row["Location_Usage_Type"] = "BUSINESS SITE"
-        row["User_Language_ID"] = "en_US"
-        # Location_Hierarchy_Reference
-        row["ParentId"] = row["ID"]
-        row["Default_Currency_ID"] = ""
-        row["Time_Profile_ID"] = ""
-        row["Address_Line_2"] = ""
-
-        try:
-            # we are getting these two fields from ADRC
-            joined_fields = adrc_rows[row["join_field"]]
-            row["Region_Subdivision_1"] = joined_fields["Region_Subdivision_1"]
-            row["City_Subdivision_1"] = joined_fields["City_Subdivision_1"]
-        except KeyError:
-            adrc_failures.append(row)
-            row["Region_Subdivision_1"] = ""
-            row["City_Subdivision_1"] = ""
-        finally:
-            # remove the field that we are using to join with adrc
-            row.pop("join_field", None)
+    file_name = "site.json"
+    result_count = upload_rows(
+        process_sites(site_rows, adrc_rows, adrc_failures),
+        data_bucket_name,
+        data_bucket_prefix,
+        file_name,
+    )
 
     if len(adrc_failures):
         # we don't do anything with this, but these are the ones from T001W which don't exists in ADRC
         file_name = "adrc_failures.json"
         output_path = f"/tmp/{file_name}" if event else f"tmp/{file_name}"
-        write_sap_json(adrc_failures, output_path)
-
-    # write to file locally and upload to s3
-    file_name = "site.json"
-    output_path = f"/tmp/{file_name}" if event else f"tmp/{file_name}"
-
-    write_sap_json(site_rows, output_path)
-
-    upload_file(output_path, data_bucket_name, data_bucket_prefix, file_name)
+        write_sap_json(adrc_failures, output_path, format="json")
 
-    return {"result_count": len(site_rows)}
+    return {"result_count": result_count}
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""
+Page checkpoints for SAP PI table reads. Every completed page is saved, to a local folder or to
+S3, under the table, a hash of the query and the run date. When a Lambda times out part way
+through a large read, its retry replays the saved pages and continues from the next RowSkips
+rather than reading the whole table again. The checkpoint is removed once every row was read.
+"""
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime, timezone
+import boto3
+
+try:
+    from get_data.helper_table import row_json
+except ModuleNotFoundError:
+    from helper_table import row_json
+
+# where pages are saved, a local folder (e.g. /tmp/sap_checkpoints) or s3://bucket/prefix/
+# checkpoints are off when it's empty
+SAP_CHECKPOINT_PATH = os.environ.get("SAP_CHECKPOINT_PATH", "")
+
+
+class PageCheckpoint:
+    """completed pages of one table read, saved as a file of JSON rows per page"""
+
+    def __init__(self, path, sap_table_name, sap_select_fields, sap_where_field, run_date=None):
+        run_date = run_date or datetime.now(timezone.utc).strftime("%Y%m%d")
+        query = hashlib.sha1(f"{sap_select_fields}|{sap_where_field}".encode()).hexdigest()[:16]
+        location = f"{path.rstrip('/')}/{sap_table_name}/{run_date}/{query}/"
+
+        if location.startswith("s3://"):
+            self.bucket, _, self.prefix = location[len("s3://") :].partition("/")
+            self.client = boto3.client("s3")
+        else:
+            self.bucket = None
+            self.prefix = location
+
+        # rows in the saved pages, the next page starts at this RowSkips
+        self.offset = 0
+
+    def iter_saved_rows(self):
+        """yield the rows of the pages saved by an earlier attempt, moving offset past them"""
+        for name in self.list_pages():
+            for line in self.read_page(name).splitlines():
+                if line:
+                    self.offset += 1
+                    yield json.loads(line)
+
+    def save_page(self, page):
+        """save a completed page, pages are named by their RowSkips so they replay in order"""
+        if not page:
+            return
+        body = "".join(row_json(row) + "\n" for row in page).encode()
+        self.write_page(f"{self.offset:012}.json", body)
+        self.offset += len(page)
+
+    def list_pages(self):
+        if self.bucket is None:
+            if not os.path.isdir(self.prefix):
+                return []
+            return sorted(name for name in os.listdir(self.prefix) if name.endswith(".json"))
+
+        names = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for response in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            names += [item["Key"][len(self.prefix) :] for item in response.get("Contents", [])]
+        return sorted(names)
+
+    def read_page(self, name):
+        if self.bucket is None:
+            with open(self.prefix + name, "rb") as f:
+                return f.read()
+
+        response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        return response["Body"].read()
+
+    def write_page(self, name, body):
+        if self.bucket is None:
+            # written under a temporary name first, so a timeout never leaves half a page
+            os.makedirs(self.prefix, exist_ok=True)
+            with open(self.prefix + name + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(self.prefix + name + ".tmp", self.prefix + name)
+            return
+
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + name,
+            Body=body,
+            ServerSideEncryption="AES256",
+            ACL="private",
+        )
+
+    def clear(self):
+        """remove the checkpoint once the whole table has been read"""
+        if self.bucket is None:
+            shutil.rmtree(self.prefix, ignore_errors=True)
+            return
+
+        names = self.list_pages()
+        for i in range(0, len(names), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": self.prefix + name} for name in names[i : i + 1000]]},
+            )
+
+
+def get_checkpoint(sap_table_name, sap_select_fields, sap_where_field):
+    """checkpoint of today's read of the table, None when SAP_CHECKPOINT_PATH isn't set"""
+    if not SAP_CHECKPOINT_PATH:
+        return None
+    return PageCheckpoint(SAP_CHECKPOINT_PATH, sap_table_name, sap_select_fields, sap_where_field)
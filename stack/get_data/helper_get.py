@@ -1,128 +1,526 @@
 import os
 import json
+import ssl
+import time
+import zlib
+import hashlib
+import shutil
 import requests
-import xmltodict
+import threading
+from io import BytesIO, RawIOBase
+from queue import Queue, Full
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from lxml import etree
 
-# import cx_Oracle
 import boto3
 from botocore.exceptions import ClientError, ParamValidationError
-from tempfile import NamedTemporaryFile as NamedTempFile
+from tempfile import NamedTemporaryFile as NamedTempFile, TemporaryFile
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.util import ssl_
 
 try:
-    from shared.helper import get_secrets, logger
+    from shared.helper import logger
+    from lambda_common.secrets_cache import secrets_cache, invalidate_secrets
+    from lambda_common.s3_transfer import upload_fileobj, copy_object
+    from lambda_common.manifest import Manifest, CONTENT_HASH_METADATA
+    from get_data.helper_join import build_index, semi_join
+    from get_data.helper_table import Row, get_header, row_json
+    from get_data.helper_checkpoint import get_checkpoint
 except ModuleNotFoundError:
     import sys
 
     sys.path.append("../")
-    from shared.helper import get_secrets, logger
+    from shared.helper import logger
+    from lambda_common.secrets_cache import secrets_cache, invalidate_secrets
+    from lambda_common.s3_transfer import upload_fileobj, copy_object
+    from lambda_common.manifest import Manifest, CONTENT_HASH_METADATA
+    from helper_join import build_index, semi_join
+    from helper_table import Row, get_header, row_json
+    from helper_checkpoint import get_checkpoint
 
-SAP_MAX_RESULTS = 1000
+# optional output formats, only needed when OUTPUT_FORMAT asks for them
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-# export LD_LIBRARY_PATH=~/Projects/workday-hierarchies/stack/layers/oracle_instant_client/lib
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
+# rows requested per page (RowCount), SAP PI returns 1000 rows when RowCount is 0
+SAP_PAGE_SIZE = int(os.environ.get("SAP_PAGE_SIZE", 1000))
 
-# def get_rds(query_path, output_path):
-#     """connect to RDS using Oracle and executes a query"""
+# page size per table, e.g. {"T001Z": 20000} to read narrow tables in fewer round trips
+SAP_PAGE_SIZES = json.loads(os.environ.get("SAP_PAGE_SIZES", "{}"))
 
-#     # get secrets
-#     secrets = get_secrets(False)
-#     rds_user = secrets["rds_username"]
-#     rds_pwd = secrets["rds_password"]
-#     rds_db_name = secrets["rds_db_name"]
-#     rds_host = secrets["rds_host"]
-#     rds_port = secrets["rds_port"]
-#     rds_query = open(query_path).read()
+# tune the page size of each read from the size and latency of its responses
+SAP_AUTO_PAGE_SIZE = os.environ.get("SAP_AUTO_PAGE_SIZE", "false").lower() == "true"
+SAP_MIN_PAGE_SIZE = int(os.environ.get("SAP_MIN_PAGE_SIZE", 100))
+SAP_MAX_PAGE_SIZE = int(os.environ.get("SAP_MAX_PAGE_SIZE", 50000))
+SAP_TARGET_PAGE_BYTES = int(os.environ.get("SAP_TARGET_PAGE_BYTES", 4 * 1024 * 1024))
+SAP_TARGET_PAGE_SECONDS = float(os.environ.get("SAP_TARGET_PAGE_SECONDS", 10))
 
-#     try:
-#         dns_str = cx_Oracle.makedsn(rds_host, rds_port, rds_db_name)
-#         with cx_Oracle.connect(user=rds_user, password=rds_pwd, dsn=dns_str) as conn:
-#             cursor = conn.cursor()
-#             cursor.execute(rds_query)
-#             with open(output_path, "w") as f:
-#                 for result in cursor:
-#                     f.write(result[0].replace("null", '""'))
-#                     f.write("\n")
-#     except cx_Oracle.DatabaseError as e:
-#         raise e
+# number of pages requested from SAP PI at the same time, keep this low to not overload SAP PI
+SAP_MAX_WORKERS = int(os.environ.get("SAP_MAX_WORKERS", 1))
 
+# keep-alive connections held open to SAP PI, needs to be at least SAP_MAX_WORKERS
+SAP_MAX_CONNECTIONS = max(SAP_MAX_WORKERS, 10)
 
-def sap_post_req(
-    sap_table_name, sap_select_fields, sap_where_field, field_mapping, local=False
-):
-    """Sends a MT_TablesRead_Request query to SAP PI"""
-
-    # get secrets
-    secrets = get_secrets(False)
-    sap_username = secrets["sap_username"]
-    sap_password = secrets["sap_password"]
-    sap_host = secrets["sap_host"]
-    sap_url = secrets["sap_url"]
-    sap_pipo_url = f"https://{sap_host}{sap_url}"
-    sap_target_system = secrets["sap_target_system"]
-    sap_application_id = secrets["sap_application_id"]
-    sap_client_cert = secrets["sap_client_cert"]
-    sap_client_key = secrets["sap_client_private_key"]
-
-    # path is different when deployed vs locally
-    path = "certificates/" if local else "get_data/certificates/"
-    sap_ssl_cert = path + secrets["sap_ssl_cert"]
-
-    # variables for paging results
-    count = SAP_MAX_RESULTS
-    row_skips = 0
-    results = []
+# pages of a streamed read held ahead of the consumer, paging waits while they are all full
+SAP_READ_AHEAD = int(os.environ.get("SAP_READ_AHEAD", 2))
+
+# seconds a paused streamed read waits before checking whether it was abandoned
+SAP_READ_STOP_POLL = 0.1
+
+# format of the extract snapshots: json, json.gz, json.zst or parquet
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "json")
+
+# file extension of each output format, it replaces .json at the end of the filename
+OUTPUT_EXTENSIONS = {
+    "json": ".json",
+    "json.gz": ".json.gz",
+    "json.zst": ".json.zst",
+    "parquet": ".parquet",
+}
+
+# keys per IN-list when a read is limited to the keys of another table, see iter_sap_rows_in
+SAP_IN_LIST_SIZE = int(os.environ.get("SAP_IN_LIST_SIZE", 100))
+
+# with more keys than this the table is read in full and filtered here, in fewer requests
+SAP_IN_LIST_MAX_KEYS = int(os.environ.get("SAP_IN_LIST_MAX_KEYS", 5000))
+
+# S3 prefix of the run-scoped cache of table reads shared by extracts, off when it's empty
+SAP_CACHE_PREFIX = os.environ.get("SAP_CACHE_PREFIX", "")
+
+# seconds a cached table read can be used for, about the length of one cycle
+SAP_CACHE_TTL = int(os.environ.get("SAP_CACHE_TTL", 4 * 60 * 60))
+
+# rows per parquet row group, a row group is held in memory while it is written
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# skip uploads whose content is the same as the previous run's, every upload starts a step function
+SKIP_UNCHANGED = os.environ.get("SKIP_UNCHANGED", "true").lower() == "true"
+
+
+class SapAdapter(HTTPAdapter):
+    """Transport adapter presenting the SAP PI client certificate from an in-memory SSL context"""
 
-    # loop through until we get less than 1000 records, then it's the last page
-    while not count < SAP_MAX_RESULTS:
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super(SapAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self.poolmanager = PoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            ssl_context=self.ssl_context,
+            **pool_kwargs,
+        )
+
+
+class SapClient:
+    """
+    Keep-alive HTTPS session to SAP PI. The client certificate and private key are loaded once
+    into an SSL context, so each page only costs a request on an already open connection
+    """
+
+    def __init__(self, secrets, local=False):
+        self.local = local
+        self.target_system = secrets["sap_target_system"]
+        self.application_id = secrets["sap_application_id"]
+        self.url = f"https://{secrets['sap_host']}{secrets['sap_url']}"
+
+        # path is different when deployed vs locally
+        path = "certificates/" if local else "get_data/certificates/"
+
+        self.session = Session()
+        self.session.auth = HTTPBasicAuth(secrets["sap_username"], secrets["sap_password"])
+        # passed on every request, a session's verify is overridden by REQUESTS_CA_BUNDLE
+        self.verify = os.path.join(path, secrets["sap_ssl_cert"])
+        self.session.mount(
+            "https://",
+            SapAdapter(
+                load_client_cert(secrets["sap_client_cert"], secrets["sap_client_private_key"]),
+                pool_maxsize=SAP_MAX_CONNECTIONS,
+            ),
+        )
+
+    def read_table(
+        self, sap_table_name, sap_select_fields, sap_where_field, row_skips, row_count=0
+    ):
+        """send one MT_TablesRead_Request page to SAP PI and return the raw response"""
 
         # get the format of the SOAP call
         headers, payload = setup_sap_soap(
-            sap_target_system,
+            self.target_system,
             sap_table_name,
-            sap_application_id,
+            self.application_id,
             sap_select_fields,
             sap_where_field,
             row_skips,
+            row_count,
         )
 
-        # set up temporary file paths for requests to read in certificates
-        client_cert = NamedTempFile(delete=False, prefix="certificates", suffix=".pem")
-        client_cert.write(sap_client_cert.encode())
-        client_cert.close()
-        private_key = NamedTempFile(delete=False, prefix="certificates", suffix=".pem")
-        private_key.write(sap_client_key.encode())
-        private_key.close()
-
         # send the request to SAP PI
         try:
-            response = requests.request(
-                method="POST",
-                url=sap_pipo_url,
-                headers=headers,
-                data=payload,
-                auth=HTTPBasicAuth(sap_username, sap_password),
-                verify=sap_ssl_cert,
-                cert=(client_cert.name, private_key.name),
-            )
+            return self.session.post(self.url, headers=headers, data=payload, verify=self.verify)
+        except requests.exceptions.SSLError as e:
+            # the certificates may have been rotated, fetch the secrets again on the next call
+            invalidate_secrets()
+            raise Exception("cert error")
         except requests.exceptions.ConnectionError as e:
             raise Exception("failed to connect")
         except OSError as e:
             raise Exception("cert error")
-        finally:
-            # the temp files need to be explicitly deleted, this is security flaw
-            os.unlink(client_cert.name)
-            os.unlink(private_key.name)
+
+    def close(self):
+        self.session.close()
+
+
+def load_client_cert(sap_client_cert, sap_client_key):
+    """load the client certificate and private key into an SSL context used for mutual TLS"""
+
+    # python can only read certificates from files, they are deleted once loaded into the context
+    client_cert = NamedTempFile(delete=False, prefix="certificates", suffix=".pem")
+    client_cert.write(sap_client_cert.encode())
+    client_cert.close()
+    private_key = NamedTempFile(delete=False, prefix="certificates", suffix=".pem")
+    private_key.write(sap_client_key.encode())
+    private_key.close()
+
+    try:
+        ssl_context = ssl_.create_urllib3_context()
+        ssl_context.load_cert_chain(certfile=client_cert.name, keyfile=private_key.name)
+    except (OSError, ssl.SSLError) as e:
+        raise Exception("cert error")
+    finally:
+        # the temp files need to be explicitly deleted, this is security flaw
+        os.unlink(client_cert.name)
+        os.unlink(private_key.name)
+
+    return ssl_context
+
+
+def get_sap_client(local=False):
+    """
+    returns the SAP PI client, it is cached with the secrets so warm Lambdas reuse the
+    connection until the secrets change
+    """
+
+    def create_sap_client(secrets):
+        logger.info("Creating SAP PI client")
+        return SapClient(secrets, local)
+
+    # table reads can run in parallel threads, only one of them creates the client
+    return secrets_cache.derive(("sap_client", local), create_sap_client)
+
+
+def sap_post_req(
+    sap_table_name,
+    sap_select_fields,
+    sap_where_field,
+    field_mapping,
+    local=False,
+    max_workers=SAP_MAX_WORKERS,
+    page_size=None,
+    checkpoint=None,
+):
+    """Sends a MT_TablesRead_Request query to SAP PI and returns all of the rows"""
+    return list(
+        iter_sap_rows(
+            sap_table_name,
+            sap_select_fields,
+            sap_where_field,
+            field_mapping,
+            local,
+            max_workers,
+            page_size,
+            checkpoint,
+        )
+    )
+
+
+def iter_sap_rows(
+    sap_table_name,
+    sap_select_fields,
+    sap_where_field,
+    field_mapping,
+    local=False,
+    max_workers=SAP_MAX_WORKERS,
+    page_size=None,
+    checkpoint=None,
+):
+    """
+    Sends MT_TablesRead_Request queries to SAP PI and yields the rows one page at a time,
+    so only the pages being fetched are held in memory
+
+    Pages are requested in RowSkips windows of page_size rows, see get_page_size. With
+    max_workers > 1 several windows are fetched at once, rows are still returned in order
+
+    With a checkpoint (by default when SAP_CHECKPOINT_PATH is set) every page is saved as it
+    completes, a retry replays the saved pages and only requests the rest of the table
+    """
+    client = get_sap_client(local)
+    if page_size is None:
+        page_size = get_page_size(sap_table_name)
+    elif isinstance(page_size, int):
+        page_size = PageSize(page_size)
+
+    def get_page(row_skips, row_count):
+        """request a single page of up to row_count rows from SAP PI starting at row_skips"""
+        start = time.monotonic()
+        response = client.read_table(
+            sap_table_name, sap_select_fields, sap_where_field, row_skips, row_count
+        )
 
         if response.status_code == 200:
-            # add this page to results while formatting, get count of most recent results
-            count = process_response(response, results, field_mapping)
-            row_skips += count
+            # format this page of results
+            page = []
+            process_response(response, page, field_mapping)
+            page_size.update(len(page), len(response.content), time.monotonic() - start)
+            return page
         else:
             # SAP will return an HTML on auth error but SOAP response on server error
+            if response.status_code in (401, 403):
+                invalidate_secrets()
             raise Exception(response.content)
 
-    return results
+    if checkpoint is None:
+        checkpoint = get_checkpoint(sap_table_name, sap_select_fields, sap_where_field)
+
+    # pages saved by an earlier attempt at this read
+    row_skips = 0
+    if checkpoint is not None:
+        yield from checkpoint.iter_saved_rows()
+        row_skips = checkpoint.offset
+
+    if max_workers > 1:
+        pages = iter_pages_concurrently(get_page, page_size, max_workers, row_skips)
+    else:
+        pages = iter_pages(get_page, page_size, row_skips)
+
+    for page in pages:
+        if checkpoint is not None:
+            checkpoint.save_page(page)
+        yield from page
+
+    # every row has been read, the next run starts from the beginning again
+    if checkpoint is not None:
+        checkpoint.clear()
+
+
+class PageSize:
+    """
+    Number of rows requested per page. With auto_tune it is moved towards the size that keeps
+    each response within target_bytes and target_seconds, measured from the pages so far
+    """
+
+    def __init__(
+        self,
+        size=SAP_PAGE_SIZE,
+        auto_tune=False,
+        min_size=SAP_MIN_PAGE_SIZE,
+        max_size=SAP_MAX_PAGE_SIZE,
+        target_bytes=SAP_TARGET_PAGE_BYTES,
+        target_seconds=SAP_TARGET_PAGE_SECONDS,
+    ):
+        self.size = size
+        self.auto_tune = auto_tune
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_seconds = target_seconds
+        # pages are measured from several threads when they are fetched concurrently
+        self.lock = threading.Lock()
+
+    def update(self, rows, content_bytes, seconds):
+        """adjust the size from a page of rows that took content_bytes and seconds"""
+        if not self.auto_tune or rows == 0:
+            return
+
+        with self.lock:
+            size = min(
+                self.target_bytes * rows / max(content_bytes, 1),
+                self.target_seconds * rows / max(seconds, 0.001),
+            )
+            # at most double or halve per page so one slow response doesn't swing the size
+            size = max(self.size / 2, min(self.size * 2, size))
+            self.size = int(max(self.min_size, min(self.max_size, size)))
+
+
+def get_page_size(sap_table_name):
+    """page size for a table from SAP_PAGE_SIZES, else SAP_PAGE_SIZE"""
+    return PageSize(
+        SAP_PAGE_SIZES.get(sap_table_name, SAP_PAGE_SIZE), auto_tune=SAP_AUTO_PAGE_SIZE
+    )
+
+
+def iter_pages(get_page, page_size, row_skips=0):
+    """Fetch one RowSkips window after the other until a page is empty"""
+    while True:
+        page = get_page(row_skips, page_size.size)
+        if not page:
+            break
+        yield page
+
+        # SAP PI can cap a response below the rows requested, so only an empty page is the last
+        row_skips += len(page)
+
+
+def iter_pages_concurrently(get_page, page_size, max_workers, row_skips=0):
+    """
+    Fetch up to max_workers RowSkips windows at once and yield the pages in order, until a page
+    is empty. A page with less rows than requested may have been capped by SAP PI, so the
+    windows past it are discarded and requested again from where it ended, no larger than it
+    """
+    pages = deque()
+    limit = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                # keep the pool busy with the next windows, each sized when it is requested
+                while len(pages) < max_workers:
+                    row_count = page_size.size if limit is None else min(page_size.size, limit)
+                    page = executor.submit(get_page, row_skips, row_count)
+                    pages.append((row_skips, row_count, page))
+                    row_skips += row_count
+
+                # pages can finish in any order, but we consume them in RowSkips order
+                start, row_count, page = pages.popleft()
+                page = page.result()
+                if not page:
+                    break
+                yield page
+
+                if len(page) < row_count:
+                    for _, _, later in pages:
+                        later.cancel()
+                    pages.clear()
+                    row_skips = start + len(page)
+                    limit = len(page)
+        finally:
+            for _, _, page in pages:
+                page.cancel()
+
+
+def fetch_concurrently(*reads):
+    """
+    Runs the independent table reads of one extract at the same time, so the extract takes as
+    long as the slowest table rather than the sum of them. Each read is called without arguments
+    and the results are returned in the same order.
+
+    Reads that stream rows (iter_sap_rows) keep paging in the background while the other reads
+    finish, and are handed back as an iterator over the rows fetched so far. They only page
+    SAP_READ_AHEAD pages ahead of the consumer, and stop paging once the iterator is closed,
+    garbage collected or another read fails
+    """
+    queues = [Queue(maxsize=SAP_READ_AHEAD + 1) for _ in reads]
+    stops = [threading.Event() for _ in reads]
+
+    executor = ThreadPoolExecutor(max_workers=len(reads))
+    for read, queue, stop in zip(reads, queues, stops):
+        executor.submit(run_read, read, queue, stop)
+    executor.shutdown(wait=False)
+
+    try:
+        return [get_read_result(queue, stop) for queue, stop in zip(queues, stops)]
+    except Exception as e:
+        for stop in stops:
+            stop.set()
+        raise e
+
+
+def run_read(read, queue, stop):
+    """run a single table read, passing its result or its rows one page at a time to the queue"""
+    result = None
+    try:
+        result = read()
+        if not isinstance(result, Iterator):
+            put_until_stopped(queue, stop, ("result", result))
+            return
+
+        # rows are handed over in batches to keep the queue overhead per row low
+        if not put_until_stopped(queue, stop, ("rows", None)):
+            return
+        page = []
+        for row in result:
+            page.append(row)
+            if len(page) == SAP_PAGE_SIZE:
+                if not put_until_stopped(queue, stop, ("page", page)):
+                    return
+                page = []
+        put_until_stopped(queue, stop, ("page", page))
+        put_until_stopped(queue, stop, ("done", None))
+    except Exception as e:
+        put_until_stopped(queue, stop, ("error", e))
+    finally:
+        # an abandoned iter_sap_rows stops paging SAP and shuts down its own workers
+        if hasattr(result, "close"):
+            result.close()
+
+
+def put_until_stopped(queue, stop, item):
+    """put item on the bounded queue, waiting for room. False once the reader has stopped"""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=SAP_READ_STOP_POLL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def get_read_result(queue, stop):
+    """wait for the result of run_read, streamed reads return a StreamedRows over their pages"""
+    kind, value = queue.get()
+    if kind == "error":
+        raise value
+    if kind == "result":
+        return value
+    return StreamedRows(queue, stop)
+
+
+class StreamedRows(Iterator):
+    """Rows of a streamed read, closing it (or dropping it) stops the read"""
+
+    def __init__(self, queue, stop):
+        self.queue = queue
+        self.stop = stop
+        self.page = iter(())
+
+    def __next__(self):
+        while True:
+            for row in self.page:
+                return row
+            if self.stop.is_set():
+                raise StopIteration
+
+            kind, value = self.queue.get()
+            if kind == "error":
+                self.close()
+                raise value
+            if kind == "done":
+                self.close()
+                raise StopIteration
+            self.page = iter(value)
+
+    def close(self):
+        self.stop.set()
+        self.page = iter(())
+
+    def __del__(self):
+        self.close()
 
 
 def setup_sap_soap(
@@ -132,6 +530,7 @@ def setup_sap_soap(
     sap_select_fields,
     sap_where_field,
     row_skips,
+    row_count=0,
 ):
     """populates the SOAP xml with input parameters to form request to SAP"""
     headers = {
@@ -150,7 +549,7 @@ def setup_sap_soap(
                         <ApplicationID>{sap_application_id}</ApplicationID>\r\n
                         <SelectFields>{sap_select_fields.replace(" ", "")}</SelectFields>\r\n
                         <WhereField>{sap_where_field}</WhereField>\r\n
-                        <RowCount>0</RowCount>\r\n
+                        <RowCount>{row_count}</RowCount>\r\n
                         <RowSkips>{row_skips}</RowSkips>\r\n
                     </ReadData>\r\n
                 </gpdb:MT_TablesRead_Request>\r\n
@@ -164,37 +563,70 @@ def setup_sap_soap(
 def process_response(response, results, field_mapping):
     """processes a result of an SAP SOAP call. returns the total count"""
 
-    # process the SOAP response as a dict
-    resp_dict = xmltodict.parse(response.content)
-    body = resp_dict["SOAP:Envelope"]["SOAP:Body"]["ns1:MT_TablesRead_Response"]
-    fields = body["FieldDetails"]
-    rows = body["Data"]["Values"]["Item"]
-
     # update the SAP header fields to match Workday formatting downstream
-    column_names = map_columns(fields, field_mapping)
+    column_names, rows = decode_response(response.content, field_mapping)
 
-    # write out the rows as dictionary with field names
-    for row in rows:
-        column_values = [value.strip() for value in row.split("|")]
-        results.append(dict(zip(column_names, column_values)))
+    # write out the rows as dict-like rows sharing one header of field names
+    header = get_header(column_names)
+    count = 0
+    for column_values in rows:
+        results.append(Row(header, column_values))
+        count += 1
+
+    # return the number of results in this page, an empty page is the last page
+    return count
+
+
+def decode_response(content, field_mapping):
+    """
+    Incrementally decodes a MT_TablesRead_Response without building the whole document.
+    Returns the mapped column names and a generator that yields a tuple of values per Item
+    """
+    if isinstance(content, str):
+        content = content.encode()
+
+    events = etree.iterparse(
+        BytesIO(content),
+        events=("start", "end"),
+        tag=("FieldDetails", "Data", "Item"),
+        resolve_entities=False,
+    )
+
+    # FieldDetails always come before the Data, so the header is complete once Data starts
+    fields = []
+    for event, element in events:
+        if element.tag == "Data":
+            break
+        if event == "end":
+            fields.append({child.tag: child.text for child in element})
+            element.clear()
+
+    column_names = map_columns(fields or None, field_mapping)
+
+    def rows():
+        for event, element in events:
+            if event == "end" and element.tag == "Item":
+                yield tuple(value.strip() for value in (element.text or "").split("|"))
 
-    # return the number of results in this page, anything under 1000 means it's last page
-    return len(rows)
+                # drop rows already processed so only one Item is held in memory
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    return column_names, rows()
 
 
 def map_columns(fields, field_mapping):
-    """"maps the SAP column names to whatever the WD field mapping is - doesn't work on single field single result"""
+    """"maps the SAP column names to whatever the WD field mapping is"""
     try:
-        if len(fields) > 2:
-            if field_mapping:
-                return [field_mapping[field["FieldName"]] for field in fields]
-            else:
-                return [field["FieldName"] for field in fields]
+        # a single FieldDetails is a dict rather than a list of them
+        if isinstance(fields, dict):
+            fields = [fields]
+
+        if field_mapping:
+            return [field_mapping[field["FieldName"]] for field in fields]
         else:
-            if field_mapping:
-                return [field_mapping[fields["FieldName"]]]
-            else:
-                return [fields["FieldName"]]
+            return [field["FieldName"] for field in fields]
 
     except KeyError:
         raise Exception("unknown field header mapping, please update")
@@ -202,24 +634,507 @@ def map_columns(fields, field_mapping):
         raise Exception("no field headers?")
 
 
-def write_sap_json(results, output_path):
-    """write locally the SAP output into a JSON format that Athena can read"""
-    with open(output_path, "w") as f:
-        for row in results:
-            f.write(json.dumps(row, separators=(",", ":")))
-            f.write("\n")
+def write_sap_json(results, output_path, format=OUTPUT_FORMAT):
+    """write locally the SAP output into a JSON (or parquet) format that Athena can read"""
+    if format == "parquet":
+        write_parquet(results, output_path)
+        return
+
+    reader = JsonRowsReader(results, get_compressor(format))
+    with open(output_path, "wb") as f:
+        shutil.copyfileobj(reader, f)
+
+
+def get_output_filename(filename, format=OUTPUT_FORMAT):
+    """filename with the extension of the output format, e.g. site.json -> site.json.gz"""
+    if format not in OUTPUT_EXTENSIONS:
+        raise Exception(f"unknown output format {format}")
+    if filename.endswith(".json"):
+        filename = filename[: -len(".json")]
+    return filename + OUTPUT_EXTENSIONS[format]
 
 
-def upload_file(input, bucket, prefix, filename):
-    """upload a local file to  specified s3 prefix"""
-    logger.info(f"Uploading {filename} to {bucket}/{prefix}")
+def get_compressor(format):
+    """compressobj for the output format, None for plain JSON and parquet"""
+    if format not in OUTPUT_EXTENSIONS:
+        raise Exception(f"unknown output format {format}")
+    if format == "json.gz":
+        # wbits=31 writes a gzip header so Athena and gunzip can read it
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if format == "json.zst":
+        if zstandard is None:
+            raise Exception("zstandard is needed for the json.zst output format")
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
+def write_parquet(rows, output):
+    """write rows to a parquet file (path or file object) one row group at a time"""
+    if pyarrow is None:
+        raise Exception("pyarrow is needed for the parquet output format")
+
+    rows = iter(rows)
+    writer = None
+    count = 0
+    try:
+        while True:
+            batch = [row for _, row in zip(range(PARQUET_ROW_GROUP_SIZE), rows)]
+            if not batch and writer is not None:
+                break
+
+            if writer is None:
+                table = pyarrow.Table.from_pylist(batch)
+                writer = pyarrow.parquet.ParquetWriter(output, table.schema)
+            else:
+                table = pyarrow.Table.from_pylist(batch, schema=writer.schema)
+            writer.write_table(table)
+            count += len(batch)
+
+            if len(batch) < PARQUET_ROW_GROUP_SIZE:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return count
+
+
+def iter_json_file(input):
+    """yield the rows of a local file written one JSON object per line"""
+    with open(input) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ChunksReader(RawIOBase):
+    """Read-only file object over byte chunks, optionally compressed as it is read"""
+
+    def __init__(self, chunks, compressor=None):
+        self.chunks = iter(chunks)
+        self.compressor = compressor
+        self.buffer = bytearray()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # only read as many chunks as needed to fill the requested chunk
+        while len(self.buffer) < len(b) and self.chunks is not None:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.chunks = None
+                if self.compressor is not None:
+                    self.buffer += self.compressor.flush()
+                break
+            if self.compressor is not None:
+                chunk = self.compressor.compress(chunk)
+            self.buffer += chunk
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+
+class JsonRowsReader(ChunksReader):
+    """Read-only file object that formats rows one JSON object per line as it is read"""
+
+    def __init__(self, rows, compressor=None):
+        self.manifest = Manifest()
+        super(JsonRowsReader, self).__init__(self.format_rows(rows), compressor)
+
+    @property
+    def count(self):
+        return self.manifest.count
+
+    def format_rows(self, rows):
+        for row in add_to_manifest(rows, self.manifest):
+            yield row_json(row).encode() + b"\n"
+
+
+def add_to_manifest(rows, manifest):
+    """yield rows, adding each one to the manifest the same way JsonRowsReader formats it"""
+    for row in rows:
+        manifest.add_columns(row)
+        manifest.update(row_json(row).encode() + b"\n")
+        yield row
+
+
+def get_file_manifest(input):
+    """manifest of a local JSON file, the same as the manifest of its rows"""
+    manifest = Manifest()
+    with open(input, "rb") as f:
+        first = f.readline()
+        if first.strip():
+            manifest.add_columns(json.loads(first))
+        manifest.update(first)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            manifest.update(chunk)
+    return manifest
+
+
+def get_prev_run_prefix(prefix):
+    """site_new_run/ -> site_prev_run/"""
+    return prefix.replace("_new_run", "_prev_run")
+
+
+def get_stored_hash(client, bucket, key):
+    """content hash stored on an uploaded object, None when there is no object or no hash"""
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return None
+    return response.get("Metadata", {}).get(CONTENT_HASH_METADATA)
+
+
+def get_staging_key(prefix, filename):
+    """site_new_run/ -> site_staging/, outside the prefixes that trigger a step function"""
+    return f"{prefix.rstrip('/').replace('_new_run', '')}_staging/{filename}"
+
+
+def is_unchanged(client, bucket, prefix, filename, manifest):
+    """
+    True when the previous run already has this content, either still waiting in new_run/ or
+    already processed into prev_run/. A prev_run/ object is copied back to new_run/ within S3, so
+    step functions chained from another hierarchy still find a file to compare
+    """
+    content_hash = manifest.content_hash.hexdigest()
+    key = f"{prefix}{filename}"
+    if get_stored_hash(client, bucket, key) == content_hash:
+        return True
+
+    prev_key = f"{get_prev_run_prefix(prefix)}{filename}"
+    if prev_key == key or get_stored_hash(client, bucket, prev_key) != content_hash:
+        return False
+
+    copy_object(client, bucket, prev_key, key, manifest.metadata())
+    return True
+
+
+def upload_file(input, bucket, prefix, filename, format=OUTPUT_FORMAT):
+    """
+    upload a local JSON file to specified s3 prefix, other output formats are converted as
+    the file is uploaded and the extension of filename changed to match. the object's metadata
+    holds the manifest of the rows, see lambda_common.manifest.
+    returns False, without uploading, when the content is the same as the previous run's
+    """
+    filename = get_output_filename(filename, format)
     client = boto3.client("s3")
     try:
-        client.upload_file(
-            Filename=input,
-            Bucket=bucket,
-            Key=f"{prefix}{filename}",
-            ExtraArgs={"ServerSideEncryption": "AES256", "ACL": "private"},
-        )
+        manifest = get_file_manifest(input)
+        if SKIP_UNCHANGED and is_unchanged(client, bucket, prefix, filename, manifest):
+            logger.info(f"No change to {bucket}/{prefix}{filename}, skipping upload")
+            return False
+
+        logger.info(f"Uploading {filename} ({manifest.count} rows) to {bucket}/{prefix}")
+        metadata = manifest.metadata()
+        if format == "parquet":
+            with TemporaryFile() as f:
+                write_parquet(iter_json_file(input), f)
+                f.seek(0)
+                upload_fileobj(client, f, bucket, f"{prefix}{filename}", metadata)
+        else:
+            with open(input, "rb") as f:
+                fileobj = f
+                if format != "json":
+                    chunks = iter(lambda: f.read(1024 * 1024), b"")
+                    fileobj = ChunksReader(chunks, get_compressor(format))
+                upload_fileobj(client, fileobj, bucket, f"{prefix}{filename}", metadata)
     except (ClientError, ParamValidationError) as e:
         raise e
+
+    return True
+
+
+def upload_rows(rows, bucket, prefix, filename, format=OUTPUT_FORMAT):
+    """
+    stream rows in a JSON format that Athena can read to the specified s3 prefix as a multipart
+    upload, without holding them in memory or writing them to /tmp. returns the number of rows.
+    the manifest of the rows is only known once every row was read, so the rows are streamed to a
+    staging key and copied within S3 with the manifest as metadata, unless SKIP_UNCHANGED finds
+    they haven't changed
+    """
+    filename = get_output_filename(filename, format)
+    client = boto3.client("s3")
+    key = f"{prefix}{filename}"
+    try:
+        staging_key = get_staging_key(prefix, filename)
+        logger.info(f"Streaming {filename} to {bucket}/{staging_key}")
+        manifest = stream_rows(client, rows, bucket, staging_key, format)
+        try:
+            if SKIP_UNCHANGED and is_unchanged(client, bucket, prefix, filename, manifest):
+                logger.info(f"No change to {bucket}/{key}, skipping upload")
+            else:
+                copy_object(client, bucket, staging_key, key, manifest.metadata())
+        finally:
+            client.delete_object(Bucket=bucket, Key=staging_key)
+    except (ClientError, ParamValidationError) as e:
+        raise e
+
+    return manifest.count
+
+
+def stream_rows(client, rows, bucket, key, format):
+    """upload rows in the output format, returns the manifest of the rows"""
+    if format == "parquet":
+        # parquet needs its footer written before it can be read, so it is spooled to /tmp first
+        manifest = Manifest()
+        with TemporaryFile() as f:
+            write_parquet(add_to_manifest(rows, manifest), f)
+            f.seek(0)
+            upload_fileobj(client, f, bucket, key)
+        return manifest
+
+    reader = JsonRowsReader(rows, get_compressor(format))
+    upload_fileobj(client, reader, bucket, key)
+    return reader.manifest
+
+
+def sap_incremental_req(
+    sap_table_name,
+    sap_select_fields,
+    sap_where_field,
+    field_mapping,
+    key,
+    watermark_field,
+    bucket,
+    prefix,
+    local=False,
+    full_refresh=False,
+):
+    """
+    Incremental version of sap_post_req. Only the rows changed since the previous run (where the
+    SAP date field watermark_field is on or after the stored watermark) are read from SAP and
+    merged by key into the previous snapshot of the table. Rows deleted in SAP are only dropped
+    by a full refresh, which is also used when there is no watermark or the query has changed.
+
+    The table snapshot and watermark are kept under <hierarchy>_snapshot/ next to the new_run/
+    prefix, not in it, so they aren't read by Athena or trigger the step function
+    """
+    client = boto3.client("s3")
+    snapshot_prefix = get_snapshot_prefix(prefix)
+    snapshot_file = f"{sap_table_name}.json"
+    watermark_key = f"{snapshot_prefix}{sap_table_name}.watermark.json"
+
+    # rows can still change later on the day of this run, so the next run starts from today
+    run_date = datetime.now(timezone.utc).strftime("%Y%m%d")
+    query = {"select_fields": sap_select_fields, "where_field": sap_where_field}
+
+    watermark = None
+    rows = None
+    if not full_refresh:
+        watermark = get_watermark(client, bucket, watermark_key, query)
+    if watermark:
+        rows = read_snapshot(client, bucket, f"{snapshot_prefix}{snapshot_file}", key)
+
+    if rows is None:
+        logger.info(f"Reading all of {sap_table_name}")
+        rows = build_index(
+            iter_sap_rows(
+                sap_table_name, sap_select_fields, sap_where_field, field_mapping, local
+            ),
+            key,
+        )
+    else:
+        logger.info(f"Reading {sap_table_name} rows changed since {watermark}")
+        changed_where_field = get_changed_where_field(
+            sap_where_field, watermark_field, watermark
+        )
+        changed_rows = iter_sap_rows(
+            sap_table_name, sap_select_fields, changed_where_field, field_mapping, local
+        )
+        for row in changed_rows:
+            rows[key(row)] = row
+
+    # only move the watermark once the merged snapshot has been stored
+    # snapshots stay plain JSON, read_snapshot reads them back line by line
+    upload_rows(rows.values(), bucket, snapshot_prefix, snapshot_file, format="json")
+    client.put_object(
+        Bucket=bucket,
+        Key=watermark_key,
+        Body=json.dumps({"watermark": run_date, **query}),
+        ServerSideEncryption="AES256",
+        ACL="private",
+    )
+
+    return list(rows.values())
+
+
+def get_snapshot_prefix(prefix):
+    """site_new_run/ -> site_snapshot/"""
+    return prefix.rstrip("/").replace("_new_run", "") + "_snapshot/"
+
+
+def get_changed_where_field(sap_where_field, watermark_field, watermark):
+    """add a condition on the change date to the WhereField of a query"""
+    changed = f"{watermark_field} GE '{watermark}'"
+    if not sap_where_field:
+        return changed
+    return f"{sap_where_field} AND {changed}"
+
+
+def get_watermark(client, bucket, watermark_key, query):
+    """returns the stored watermark of a table, None if there isn't one for this query"""
+    try:
+        response = client.get_object(Bucket=bucket, Key=watermark_key)
+    except ClientError as e:
+        logger.warning(f"No watermark at {bucket}/{watermark_key}: {e}")
+        return None
+
+    stored = json.loads(response["Body"].read())
+    if any(stored.get(field) != value for field, value in query.items()):
+        logger.warning(f"Query changed since watermark {bucket}/{watermark_key}")
+        return None
+
+    return stored["watermark"]
+
+
+def read_snapshot(client, bucket, snapshot_key, key):
+    """read a table snapshot written by upload_rows into an index by key, None if it's missing"""
+    try:
+        response = client.get_object(Bucket=bucket, Key=snapshot_key)
+    except ClientError as e:
+        logger.warning(f"No snapshot at {bucket}/{snapshot_key}: {e}")
+        return None
+
+    rows = (json.loads(line) for line in response["Body"].iter_lines() if line)
+    return build_index(rows, key)
+
+
+def sap_cached_req(
+    sap_table_name,
+    sap_select_fields,
+    sap_where_field,
+    field_mapping,
+    local=False,
+    bucket=None,
+    ttl=None,
+):
+    """
+    Cached version of iter_sap_rows for tables read by several extracts in a cycle, e.g. T001W
+    for sites and buildings. The first read stores the table in S3 with the SAP field names,
+    keyed by table, where clause and run date. Later reads project their fields from it while
+    it is younger than SAP_CACHE_TTL and has all of them, otherwise the table is read again with
+    the fields of both. Without SAP_CACHE_PREFIX (or a bucket) it is the same as iter_sap_rows
+    """
+    bucket = bucket or os.environ.get("BUCKET")
+    if not SAP_CACHE_PREFIX or not bucket:
+        return iter_sap_rows(
+            sap_table_name, sap_select_fields, sap_where_field, field_mapping, local
+        )
+
+    client = boto3.client("s3")
+    fields = [field.strip() for field in sap_select_fields.split(",") if field.strip()]
+    cache_key = get_cache_key(sap_table_name, sap_where_field)
+    cached_fields, rows = read_cache(
+        client, bucket, cache_key, SAP_CACHE_TTL if ttl is None else ttl
+    )
+
+    if rows is None or not set(fields) <= set(cached_fields):
+        # read the fields wanted by every extract so far, so the next one can use the cache
+        cached_fields = cached_fields + [field for field in fields if field not in cached_fields]
+        logger.info(f"Reading {sap_table_name} into the cache with {','.join(cached_fields)}")
+        rows = sap_post_req(sap_table_name, ",".join(cached_fields), sap_where_field, None, local)
+        write_cache(client, bucket, cache_key, cached_fields, rows)
+    else:
+        logger.info(f"Reading {sap_table_name} from the cache at {bucket}/{cache_key}")
+
+    return project_rows(rows, fields, field_mapping)
+
+
+def get_cache_key(sap_table_name, sap_where_field):
+    """cache of a table read for today's run, e.g. sap_cache/20240101/T001W/<where hash>.json"""
+    run_date = datetime.now(timezone.utc).strftime("%Y%m%d")
+    where = hashlib.sha1(sap_where_field.encode()).hexdigest()[:16]
+    return f"{SAP_CACHE_PREFIX}{run_date}/{sap_table_name}/{where}.json"
+
+
+def read_cache(client, bucket, cache_key, ttl):
+    """returns the fields and rows of a cached table read, no rows when missing or expired"""
+    try:
+        response = client.get_object(Bucket=bucket, Key=cache_key)
+    except ClientError as e:
+        logger.warning(f"No cached table at {bucket}/{cache_key}: {e}")
+        return [], None
+
+    fields = response["Metadata"].get("fields", "").split(",")
+    age = datetime.now(timezone.utc) - response["LastModified"]
+    if age.total_seconds() > ttl:
+        logger.warning(f"Cached table at {bucket}/{cache_key} has expired")
+        response["Body"].close()
+        return fields, None
+
+    rows = [json.loads(line) for line in response["Body"].iter_lines() if line]
+    return fields, rows
+
+
+def write_cache(client, bucket, cache_key, fields, rows):
+    """store a table read in the cache, the field names are kept in the object metadata"""
+    try:
+        metadata = {"fields": ",".join(fields)}
+        upload_fileobj(client, JsonRowsReader(rows), bucket, cache_key, metadata)
+    except (ClientError, ParamValidationError) as e:
+        # the extract can carry on without the cache, the next one reads SAP PI itself
+        logger.warning(f"Could not cache the table at {bucket}/{cache_key}: {e}")
+
+
+def project_rows(rows, fields, field_mapping):
+    """yield rows with only fields, renamed by field_mapping the same way as map_columns"""
+    header = get_header(map_columns([{"FieldName": field} for field in fields], field_mapping))
+    for row in rows:
+        yield Row(header, [row[field] for field in fields])
+
+
+def iter_sap_rows_in(
+    sap_table_name,
+    sap_select_fields,
+    sap_where_field,
+    field_mapping,
+    key_field,
+    keys,
+    local=False,
+    max_workers=SAP_MAX_WORKERS,
+    batch_size=SAP_IN_LIST_SIZE,
+    max_keys=SAP_IN_LIST_MAX_KEYS,
+):
+    """
+    yields only the rows whose key_field is one of keys, e.g. the ADRC addresses of the T001W
+    sites, by adding the keys to the WhereField as IN-lists of batch_size keys. The batches are
+    read max_workers at a time, rows are returned in the order of the batches
+    """
+    keys = sorted(set(keys))
+    if len(keys) > max_keys:
+        # the IN-lists would take more requests than paging through the table
+        logger.info(f"Reading all of {sap_table_name} for {len(keys)} keys")
+        key_name = (field_mapping or {}).get(key_field, key_field)
+        rows = iter_sap_rows(
+            sap_table_name, sap_select_fields, sap_where_field, field_mapping, local, max_workers
+        )
+        yield from semi_join(rows, set(keys), lambda row: row[key_name])
+        return
+
+    where_fields = [
+        get_in_where_field(sap_where_field, key_field, keys[i : i + batch_size])
+        for i in range(0, len(keys), batch_size)
+    ]
+    logger.info(f"Reading {sap_table_name} for {len(keys)} keys in {len(where_fields)} batches")
+
+    def read(where_field):
+        return sap_post_req(
+            sap_table_name, sap_select_fields, where_field, field_mapping, local, max_workers=1
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for rows in executor.map(read, where_fields):
+            yield from rows
+
+
+def get_in_where_field(sap_where_field, key_field, keys):
+    """WhereField limited to keys, e.g. ADDR_GROUP EQ 'CA01' AND ADDRNUMBER IN ( '1', '2' )"""
+    values = ", ".join("'" + key.replace("'", "''") + "'" for key in keys)
+    in_list = f"{key_field} IN ( {values} )"
+    if not sap_where_field:
+        return in_list
+    return f"{sap_where_field} AND {in_list}"
@@ -0,0 +1,54 @@
+"""
+Hash joins for the SAP extracts. The smaller table is loaded into a dict/set index once, the
+larger table is streamed past it, so each join costs one lookup per row instead of a scan of
+the other table. Rows without a match can be collected in an unmatched list (e.g. adrc_failures)
+"""
+
+
+def key_field(field, length=None):
+    """key function on a field of a row, optionally only the first characters e.g. GEBNR[:4]"""
+    if length is None:
+        return lambda row: row[field]
+    return lambda row: row[field][:length]
+
+
+def build_index(rows, key, value=None):
+    """hash index of rows by key, a later row with the same key replaces the earlier one"""
+    if value is None:
+        return {key(row): row for row in rows}
+    return {key(row): value(row) for row in rows}
+
+
+def build_keys(rows, key=None):
+    """set of keys for a semi-join, rows can already be the keys"""
+    if key is None:
+        return set(rows)
+    return {key(row) for row in rows}
+
+
+def inner_join(rows, index, key, merge, unmatched=None):
+    """yields merge(row, match) for each row with a match in the index"""
+    for row in rows:
+        match = index.get(key(row))
+        if match is not None:
+            yield merge(row, match)
+        elif unmatched is not None:
+            unmatched.append(row)
+
+
+def left_join(rows, index, key, merge, unmatched=None):
+    """yields merge(row, match) for every row, match is None when it's not in the index"""
+    for row in rows:
+        match = index.get(key(row))
+        if match is None and unmatched is not None:
+            unmatched.append(row)
+        yield merge(row, match)
+
+
+def semi_join(rows, keys, key, unmatched=None):
+    """yields the rows whose key is in keys (a set or index)"""
+    for row in rows:
+        if key(row) in keys:
+            yield row
+        elif unmatched is not None:
+            unmatched.append(row)
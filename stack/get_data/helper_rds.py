@@ -0,0 +1,128 @@
+"""
+Streaming reads of the hierarchy queries (queries/rds_*.sql) from the Oracle RDS. Each query
+returns one JSON object per row. Rows are fetched RDS_ARRAYSIZE at a time and written to the
+output file as they arrive, so memory doesn't grow with the size of the hierarchy.
+
+With RDS_PARTITIONS above 1 the query is split by RDS_PARTITION_SQL into partitions of its
+keys, each read in parallel on its own connection. The partitions are written one after
+another, so the output is the same for every run.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import cx_Oracle
+except ImportError:
+    # only in the oracle_instant_client layer
+    cx_Oracle = None
+
+try:
+    from shared.helper import logger
+    from lambda_common.secrets_cache import get_secrets
+except ModuleNotFoundError:
+    import sys
+
+    sys.path.append("../")
+    from shared.helper import logger
+    from lambda_common.secrets_cache import get_secrets
+
+# rows fetched per round trip, and prefetched with the execute
+RDS_ARRAYSIZE = int(os.environ.get("RDS_ARRAYSIZE", 5000))
+
+# partitions of the query read in parallel, 1 reads the whole query on one connection
+RDS_PARTITIONS = int(os.environ.get("RDS_PARTITIONS", 1))
+
+# wraps a query to read one partition of it, :partitions and :partition are bound
+RDS_PARTITION_SQL = os.environ.get(
+    "RDS_PARTITION_SQL",
+    "SELECT JSON FROM ({query}) "
+    "WHERE ORA_HASH(JSON_VALUE(JSON, '$.ID'), :partitions - 1) = :partition",
+)
+
+
+def connect_rds():
+    """connection to the RDS from the secrets"""
+    if cx_Oracle is None:
+        raise Exception("cx_Oracle is needed to read from RDS")
+
+    secrets = get_secrets(False)
+    dsn = cx_Oracle.makedsn(secrets["rds_host"], secrets["rds_port"], secrets["rds_db_name"])
+    return cx_Oracle.connect(
+        user=secrets["rds_username"], password=secrets["rds_password"], dsn=dsn
+    )
+
+
+def get_rds(
+    query_path,
+    output_path,
+    connect=connect_rds,
+    arraysize=RDS_ARRAYSIZE,
+    partitions=RDS_PARTITIONS,
+    partition_sql=RDS_PARTITION_SQL,
+):
+    """connect to RDS and write the JSON rows of a query to output_path, returns the row count"""
+    with open(query_path) as f:
+        query = f.read().strip().rstrip(";")
+
+    if partitions <= 1:
+        with open(output_path, "w") as output:
+            count = write_query(connect, query, {}, output, arraysize)
+        logger.info(f"Read {count} rows from {query_path}")
+        return count
+
+    # each partition is written to its own file, then joined in order
+    query = partition_sql.format(query=query)
+    part_paths = [f"{output_path}.{partition}" for partition in range(partitions)]
+
+    def read_partition(partition):
+        params = {"partitions": partitions, "partition": partition}
+        with open(part_paths[partition], "w") as output:
+            return write_query(connect, query, params, output, arraysize)
+
+    try:
+        with ThreadPoolExecutor(max_workers=partitions) as executor:
+            count = sum(executor.map(read_partition, range(partitions)))
+
+        with open(output_path, "w") as output:
+            for part_path in part_paths:
+                with open(part_path) as part:
+                    shutil.copyfileobj(part, output)
+    finally:
+        for part_path in part_paths:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    logger.info(f"Read {count} rows from {query_path} in {partitions} partitions")
+    return count
+
+
+def write_query(connect, query, params, output, arraysize):
+    """execute the query on a new connection and write its rows, one batch at a time"""
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.arraysize = arraysize
+        if hasattr(cursor, "prefetchrows"):
+            # the first batch comes back with the execute, saving a round trip
+            cursor.prefetchrows = arraysize + 1
+        cursor.execute(query, params)
+
+        count = 0
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            output.writelines(format_row(row[0]) for row in rows)
+            count += len(rows)
+        return count
+    finally:
+        conn.close()
+
+
+def format_row(value):
+    """a JSON row of the query, nulls are written as empty strings for Athena"""
+    if hasattr(value, "read"):
+        # json_object can return a CLOB
+        value = value.read()
+    return value.replace("null", '""') + "\n"
@@ -0,0 +1,120 @@
+"""
+Compact rows for the SAP extracts. All the rows of a table share one Header with the column
+names, and each Row only holds a list of its values, rather than a dict repeating every key.
+
+Rows behave like dicts for the handlers. Adding or removing a key moves the row to a derived
+header. Derived headers are cached, so rows changed the same way keep sharing one header.
+"""
+import json
+from collections.abc import MutableMapping
+from json.encoder import encode_basestring_ascii
+
+
+class Header:
+    """column names of a table and their position in each row"""
+
+    __slots__ = ("names", "index", "json_keys", "added", "removed")
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        # keys already formatted the way json.dumps writes them, e.g. "ID":
+        self.json_keys = tuple(encode_basestring_ascii(name) + ":" for name in self.names)
+        self.added = {}
+        self.removed = {}
+
+    def add(self, name):
+        """header with name added at the end"""
+        header = self.added.get(name)
+        if header is None:
+            header = self.added.setdefault(name, Header(self.names + (name,)))
+        return header
+
+    def remove(self, name):
+        """header without name"""
+        header = self.removed.get(name)
+        if header is None:
+            names = tuple(column for column in self.names if column != name)
+            header = self.removed.setdefault(name, Header(names))
+        return header
+
+
+# one header per set of column names, so every page of a table shares the same one
+headers = {}
+
+
+def get_header(names):
+    """shared header for the column names"""
+    names = tuple(names)
+    header = headers.get(names)
+    if header is None:
+        header = headers.setdefault(names, Header(names))
+    return header
+
+
+class Row(MutableMapping):
+    """dict-like view of one row's values through the header of its table"""
+
+    __slots__ = ("_header", "_values")
+
+    def __init__(self, header, values):
+        self._header = header
+        self._values = list(values)
+
+    def __getitem__(self, key):
+        return self._values[self._header.index[key]]
+
+    def __setitem__(self, key, value):
+        i = self._header.index.get(key)
+        if i is None:
+            self._header = self._header.add(key)
+            self._values.append(value)
+        else:
+            self._values[i] = value
+
+    def __delitem__(self, key):
+        i = self._header.index[key]
+        self._header = self._header.remove(key)
+        del self._values[i]
+
+    def __contains__(self, key):
+        return key in self._header.index
+
+    def __iter__(self):
+        return iter(self._header.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        i = self._header.index.get(key)
+        return default if i is None else self._values[i]
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def select(row, names):
+    """new Row with only the names columns of row, e.g. the fields needed from an index"""
+    header = get_header(names)
+    return Row(header, [row[name] for name in header.names])
+
+
+def row_json(row):
+    """a row (Row or dict) formatted the same as json.dumps(row, separators=(",", ":"))"""
+    if not isinstance(row, Row):
+        return json.dumps(row, separators=(",", ":"))
+
+    return (
+        "{"
+        + ",".join(
+            key
+            + (
+                encode_basestring_ascii(value)
+                if type(value) is str
+                else json.dumps(value, separators=(",", ":"))
+            )
+            for key, value in zip(row._header.json_keys, row._values)
+        )
+        + "}"
+    )
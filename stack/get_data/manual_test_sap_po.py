@@ -10,7 +10,7 @@ def main():
     """True for local ssl cert"""
 
     # T001
-    companies = get_companies(True)
+    companies = list(get_companies(True))
     print(companies)
 
     # T001Z
@@ -18,7 +18,7 @@ def main():
     print(companies_to_keep)
 
     # T001W
-    sites = get_t001w(True)
+    sites = list(get_t001w(True))
     print(sites)
 
     # ADRC
@@ -26,7 +26,7 @@ def main():
     print(adrc)
 
     # ZTXXETBLDG
-    buildings = get_buildings(True)
+    buildings = list(get_buildings(True))
     print(buildings)
 
     # T001W
@@ -0,0 +1,178 @@
+"""
+Micro-benchmarks of decoding SAP PI responses and writing them out: process_response,
+map_columns and write_sap_json, on generated MT_TablesRead responses of increasing size and width.
+Each case reports rows (or calls) per second and peak python memory.
+
+The results are compared with the baseline in tests/data/benchmark_decode_baseline.json. Machines
+differ, so only a large drop in throughput or a large increase in memory is reported as a
+regression. Run from the stack folder:
+
+    python -m get_data.tests.benchmark_decode            # compare with the baseline
+    python -m get_data.tests.benchmark_decode --update   # write a new baseline
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from get_data.tests.data import Response, get_local_file
+from get_data.tests.fake_sap import get_tables_read_response
+
+BASELINE_PATH = get_local_file("benchmark_decode_baseline.json")
+
+ROWS = [100, 1000, 10000]
+WIDTHS = [1, 5, 20]
+
+# a case is a regression when it is this much slower or uses this much more memory
+MAX_SLOWDOWN = 0.5
+MAX_MEMORY_INCREASE = 1.5
+
+
+def get_fields(width):
+    return [f"FIELD{i:02}" for i in range(width)]
+
+
+def get_field_mapping(width):
+    return {field: f"Workday_Field_{i}" for i, field in enumerate(get_fields(width))}
+
+
+def value(field, row):
+    return f"{field}_{row:010}"
+
+
+def bench_process_response(rows, width):
+    """decode one page of rows"""
+    from get_data.helper_get import process_response
+
+    response = Response(
+        get_tables_read_response(get_fields(width), range(rows), value).encode(), 200
+    )
+    field_mapping = get_field_mapping(width)
+
+    def run():
+        process_response(response, [], field_mapping)
+
+    return run, rows
+
+
+def bench_map_columns(rows, width):
+    """map the FieldDetails of a page, counted per call rather than per row"""
+    from get_data.helper_get import map_columns
+
+    fields = [{"FieldName": field, "FieldText": field} for field in get_fields(width)]
+    field_mapping = get_field_mapping(width)
+
+    def run():
+        for _ in range(rows):
+            map_columns(fields, field_mapping)
+
+    return run, rows
+
+
+def bench_write_sap_json(rows, width):
+    """write already decoded rows to a local JSON file"""
+    from get_data.helper_get import write_sap_json
+    from get_data.helper_table import Row, get_header
+
+    header = get_header(get_field_mapping(width).values())
+    results = [Row(header, [value(f, row) for f in get_fields(width)]) for row in range(rows)]
+    output_path = os.path.join(tempfile.gettempdir(), "benchmark_decode.json")
+
+    def run():
+        write_sap_json(results, output_path, "json")
+
+    return run, rows
+
+
+benchmarks = {
+    "process_response": bench_process_response,
+    "map_columns": bench_map_columns,
+    "write_sap_json": bench_write_sap_json,
+}
+
+
+def measure(benchmark, rows, width, min_seconds=0.2):
+    """best rows/sec over repeated runs lasting at least min_seconds, and peak memory of one run"""
+    run, count = benchmarks[benchmark](rows, width)
+
+    best = None
+    total = 0
+    while total < min_seconds or best is None:
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        total += seconds
+        best = seconds if best is None else min(best, seconds)
+
+    # measured separately, tracemalloc slows everything down
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"per_sec": round(count / best), "peak_kb": round(peak / 1024)}
+
+
+def run_benchmarks(rows=ROWS, widths=WIDTHS, min_seconds=0.2):
+    """results of every benchmark by case name, e.g. process_response/1000x5"""
+    results = {}
+    for benchmark in benchmarks:
+        for row_count in rows:
+            for width in widths:
+                name = f"{benchmark}/{row_count}x{width}"
+                results[name] = measure(benchmark, row_count, width, min_seconds)
+    return results
+
+
+def compare(results, baseline):
+    """descriptions of the cases that regressed against the baseline"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        if result["per_sec"] < expected["per_sec"] * MAX_SLOWDOWN:
+            regressions.append(f"{name}: {result['per_sec']}/sec, baseline {expected['per_sec']}")
+        if result["peak_kb"] > expected["peak_kb"] * MAX_MEMORY_INCREASE + 64:
+            regressions.append(f"{name}: {result['peak_kb']} KB, baseline {expected['peak_kb']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="write a new baseline")
+    parser.add_argument("--rows", type=int, nargs="+", default=ROWS)
+    parser.add_argument("--widths", type=int, nargs="+", default=WIDTHS)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.rows, args.widths)
+
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+
+    print(f"{'case':<32}{'per sec':>12}{'baseline':>12}{'peak KB':>10}{'baseline':>10}")
+    for name, result in results.items():
+        expected = baseline.get(name, {})
+        print(
+            f"{name:<32}{result['per_sec']:>12}{expected.get('per_sec', ''):>12}"
+            f"{result['peak_kb']:>10}{expected.get('peak_kb', ''):>10}"
+        )
+
+    if args.update:
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Throughput of the SAP PI extracts against the local FakeSapServer, no SAP system needed.
+S3 and Secrets Manager are mocked with moto, so handler timings include moto's upload overhead.
+
+Run from the stack folder:
+
+    python -m get_data.tests.benchmark_extract --rows 10000 100000 1000000
+    python -m get_data.tests.benchmark_extract --extract buildings --workers 1 4 --latency 0.2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from functools import partial
+
+import boto3
+from moto import mock_s3, mock_secretsmanager
+
+from get_data.tests.fake_sap import FakeSapServer
+
+field_mapping_adrc = {
+    "STR_SUPPL3": "City_Subdivision_1",
+    "CITY2": "Region_Subdivision_1",
+    "ADDRNUMBER": "join_field",
+}
+
+
+def benchmark_value(field, row):
+    """synthetic values that join the way the real tables do, e.g. GEBNR[:4] to WERKS"""
+    if field in ("WERKS", "BUKRS"):
+        return f"{row % 10000:04}"
+    if field == "GEBNR":
+        return f"{row % 10000:04}{row // 10000 % 100:02}"
+    if field in ("ADDRNUMBER", "ADRNR"):
+        return f"{row:010}"
+    return f"{field}_{row}"
+
+
+def read_adrc(max_workers, page_size):
+    """only read the ADRC table, returns the number of rows"""
+    from get_data.helper_get import iter_sap_rows
+
+    rows = iter_sap_rows(
+        "ADRC",
+        "ADDRNUMBER,STR_SUPPL3,CITY2",
+        "",
+        field_mapping_adrc,
+        max_workers=max_workers,
+        page_size=page_size,
+    )
+    return sum(1 for _ in rows)
+
+
+def run_handler(module, max_workers, page_size):
+    """run an extract's lambda_handler, the tables are read with max_workers and page_size"""
+    import importlib
+    from get_data import helper_get
+
+    handler = importlib.import_module(f"get_data.{module}").lambda_handler
+    iter_sap_rows = helper_get.iter_sap_rows
+
+    def read(*args, **kwargs):
+        kwargs.update(max_workers=max_workers, page_size=page_size)
+        return iter_sap_rows(*args[:5], **kwargs)
+
+    # the extract modules import iter_sap_rows by name
+    extract = sys.modules[f"get_data.{module}"]
+    extract.iter_sap_rows = read
+    try:
+        handler({"mode": "benchmark"}, None)
+    finally:
+        extract.iter_sap_rows = iter_sap_rows
+
+
+extracts = {
+    "adrc": read_adrc,
+    "buildings": partial(run_handler, "get_buildings"),
+    "company_code": partial(run_handler, "get_company_code"),
+    "location_site": partial(run_handler, "get_location_site"),
+}
+
+
+def benchmark(extract, rows, max_workers, page_size, latency):
+    """seconds and peak python memory of one extract of rows rows per table"""
+    with FakeSapServer(rows=rows, latency=latency, value=benchmark_value) as sap:
+        with mock_secretsmanager(), mock_s3():
+            boto3.client("secretsmanager").create_secret(
+                Name="fakesap", SecretString=json.dumps(sap.secrets)
+            )
+            boto3.client("s3").create_bucket(Bucket=os.environ["BUCKET"])
+
+            from lambda_common.secrets_cache import secrets_cache
+
+            secrets_cache.invalidate()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            extracts[extract](max_workers, page_size)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        return seconds, peak, len(sap.requests)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--extract", choices=sorted(extracts), default="adrc")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per page")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ["SECRETS"] = "fakesap"
+    os.environ["BUCKET"] = "benchmark"
+    for prefix in ("SITE_NEW", "BUILDING_NEW", "COMPANYCODE_NEW"):
+        os.environ[prefix] = f"{prefix.lower()}/"
+
+    print(f"{'extract':<14}{'rows':>10}{'workers':>9}{'requests':>10}{'seconds':>10}", end="")
+    print(f"{'rows/sec':>12}{'peak MB':>10}")
+    for rows in args.rows:
+        for max_workers in args.workers:
+            seconds, peak, requests = benchmark(
+                args.extract, rows, max_workers, args.page_size, args.latency
+            )
+            print(
+                f"{args.extract:<14}{rows:>10}{max_workers:>9}{requests:>10}{seconds:>10.2f}"
+                f"{rows / seconds:>12.0f}{peak / 1024 / 1024:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
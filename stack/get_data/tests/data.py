@@ -1,4 +1,5 @@
 import os
+import re
 
 SAP_URL = "https://sap.host.com/SENDSOAP"
 
@@ -18,3 +19,33 @@ def get_xml(file):
     path = get_local_file(file)
     with open(path, "r") as f:
         return f.read().strip()
+
+
+def get_sap_response(field_names, rows):
+    """build a MT_TablesRead_Response with the given field names and rows of values"""
+    fields = "".join(
+        f"<FieldDetails><FieldName>{name}</FieldName><FieldText>{name}</FieldText></FieldDetails>"
+        for name in field_names
+    )
+    items = "".join(f"<Item>{'|'.join(row)}</Item>" for row in rows)
+    return (
+        "<SOAP:Envelope xmlns:SOAP='http://schemas.xmlsoap.org/soap/envelope/'><SOAP:Header/>"
+        "<SOAP:Body><ns1:MT_TablesRead_Response xmlns:ns1='http://pg.com/xi/MDM/a2a/global/gedb'>"
+        f"{fields}<Data><Values>{items}</Values></Data>"
+        "</ns1:MT_TablesRead_Response></SOAP:Body></SOAP:Envelope>"
+    )
+
+
+def get_row_skips(request):
+    """read RowSkips from a MT_TablesRead_Request payload"""
+    return int(re.search(r"<RowSkips>(\d+)</RowSkips>", request.text).group(1))
+
+
+def get_row_count(request, default=1000):
+    """read RowCount from a MT_TablesRead_Request payload, SAP PI returns 1000 rows for 0"""
+    return int(re.search(r"<RowCount>(\d+)</RowCount>", request.text).group(1)) or default
+
+
+def get_where_field(request):
+    """read WhereField from a MT_TablesRead_Request payload"""
+    return re.search(r"<WhereField>(.*)</WhereField>", request.text).group(1)
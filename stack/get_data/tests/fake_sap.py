@@ -0,0 +1,258 @@
+"""
+Local stand-in for the SAP PI MT_TablesRead service, used by the tests and benchmarks that need
+a real HTTPS endpoint rather than a mocked response.
+
+Every table has a configurable number of synthetic rows for whatever SelectFields are asked for.
+RowSkips and RowCount are honoured the same way as SAP PI (RowCount 0 returns 1000 rows), and
+so is a FIELD IN ( ... ) list in the WhereField. A server-side cap on the rows of a response,
+below the RowCount asked for, can be set with max_rows. Latency and errors can be injected per page.
+
+    with FakeSapServer(rows={"ADRC": 100000}, latency=0.05) as sap:
+        secrets = sap.secrets  # store in Secrets Manager (or moto) as the SECRETS secret
+"""
+import os
+import re
+import ssl
+import time
+import random
+import tempfile
+import threading
+import ipaddress
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+SAP_URL = "/SENDSOAP"
+
+# rows returned by SAP PI when RowCount is 0
+SAP_DEFAULT_ROW_COUNT = 1000
+
+ERROR_RESPONSE = (
+    "<SOAP:Envelope xmlns:SOAP='http://schemas.xmlsoap.org/soap/envelope/'><SOAP:Body>"
+    "<SOAP:Fault><faultcode>SOAP:Server</faultcode><faultstring>injected error</faultstring>"
+    "</SOAP:Fault></SOAP:Body></SOAP:Envelope>"
+)
+
+
+def default_value(field, row):
+    """synthetic value of a field, every field of a row has the row number so joins match"""
+    return f"{row:010}"
+
+
+class FakeSapServer:
+    """
+    Threaded HTTPS server answering MT_TablesRead_Request with synthetic rows
+
+    rows: number of rows of every table, or a dict of table name to number of rows
+    latency: seconds to wait before answering each page
+    error_rate: fraction of pages answered with a 500 SOAP fault
+    errors: RowSkips values that are always answered with a 500 SOAP fault
+    status_code: answer every page with this status code instead, e.g. 401
+    value: function(field, row) returning the value of a field
+    max_rows: most rows answered per page, whatever the RowCount
+    """
+
+    def __init__(
+        self,
+        rows=10000,
+        latency=0,
+        error_rate=0,
+        errors=(),
+        status_code=None,
+        value=default_value,
+        seed=0,
+        max_rows=None,
+    ):
+        self.rows = rows
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = set(errors)
+        self.status_code = status_code
+        self.value = value
+        self.max_rows = max_rows
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.cert_dir = None
+        self.httpd = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """start serving on a free local port"""
+        self.cert_dir = tempfile.TemporaryDirectory(prefix="fake_sap")
+        self.cert_path, self.key_path = write_self_signed_cert(self.cert_dir.name)
+
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(self.cert_path, self.key_path)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), get_handler(self))
+        self.httpd.daemon_threads = True
+        self.httpd.socket = ssl_context.wrap_socket(self.httpd.socket, server_side=True)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.cert_dir.cleanup()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def secrets(self):
+        """the SAP PI secrets to point get_sap_client at this server"""
+        with open(self.cert_path) as f:
+            cert = f.read()
+        with open(self.key_path) as f:
+            key = f.read()
+
+        return {
+            "sap_host": f"127.0.0.1:{self.port}",
+            "sap_url": SAP_URL,
+            "sap_target_system": "ABC",
+            "sap_application_id": "12345678",
+            "sap_username": "username",
+            "sap_password": "password",
+            # absolute, so it isn't looked up in the certificates folder
+            "sap_ssl_cert": self.cert_path,
+            # the server doesn't ask for a client certificate, any valid pair will do
+            "sap_client_cert": cert,
+            "sap_client_private_key": key,
+        }
+
+    def get_row_total(self, table):
+        if isinstance(self.rows, dict):
+            return self.rows.get(table, 0)
+        return self.rows
+
+    def respond(self, request):
+        """status code and body for a MT_TablesRead_Request payload"""
+        table = read_tag(request, "TableName")
+        where = read_tag(request, "WhereField")
+        fields = read_tag(request, "SelectFields").split(",")
+        row_skips = int(read_tag(request, "RowSkips"))
+        row_count = int(read_tag(request, "RowCount") or 0) or SAP_DEFAULT_ROW_COUNT
+        if self.max_rows is not None:
+            row_count = min(row_count, self.max_rows)
+
+        with self.lock:
+            self.requests.append(
+                {"table": table, "where": where, "row_skips": row_skips}
+            )
+            failed = row_skips in self.errors or self.random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.status_code is not None:
+            return self.status_code, f"<html>{self.status_code}</html>"
+        if failed:
+            return 500, ERROR_RESPONSE
+
+        rows = self.get_rows(table, where)[row_skips : row_skips + row_count]
+        return 200, get_tables_read_response(fields, rows, self.value)
+
+    def get_rows(self, table, where):
+        """row numbers of the table, only those with a value in the IN-list if there is one"""
+        rows = range(self.get_row_total(table))
+        match = re.search(r"(\w+) IN \( (.*?) \)", where)
+        if match is None:
+            return rows
+
+        field = match.group(1)
+        keys = {key.replace("''", "'") for key in re.findall(r"'((?:[^']|'')*)'", match.group(2))}
+        return [row for row in rows if self.value(field, row) in keys]
+
+
+def get_handler(server):
+    """request handler class bound to a FakeSapServer"""
+
+    class FakeSapHandler(BaseHTTPRequestHandler):
+        # keep-alive, like SAP PI
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            status_code, body = server.respond(request)
+            body = body.encode()
+
+            self.send_response(status_code)
+            self.send_header("Content-Type", "text/xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeSapHandler
+
+
+def read_tag(request, tag):
+    match = re.search(rf"<{tag}>(.*?)</{tag}>", request)
+    return match.group(1) if match else ""
+
+
+def get_tables_read_response(fields, rows, value=default_value):
+    """MT_TablesRead_Response for the rows numbers in rows, values are separated by |"""
+    field_details = "".join(
+        f"<FieldDetails><FieldName>{field}</FieldName>"
+        f"<FieldText>{field}</FieldText></FieldDetails>"
+        for field in fields
+    )
+    items = "".join(
+        f"<Item>{escape('|'.join(value(field, row) for field in fields))}</Item>" for row in rows
+    )
+    return (
+        "<SOAP:Envelope xmlns:SOAP='http://schemas.xmlsoap.org/soap/envelope/'><SOAP:Header/>"
+        "<SOAP:Body><ns1:MT_TablesRead_Response xmlns:ns1='http://pg.com/xi/MDM/a2a/global/gedb'>"
+        f"{field_details}<Data><Values>{items}</Values></Data>"
+        "</ns1:MT_TablesRead_Response></SOAP:Body></SOAP:Envelope>"
+    )
+
+
+def write_self_signed_cert(directory):
+    """write a certificate and key for 127.0.0.1, returns their paths"""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    cert_path = os.path.join(directory, "server.pem")
+    key_path = os.path.join(directory, "server.key")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
@@ -0,0 +1,24 @@
+def test_run_benchmarks():
+    """Every decoding benchmark runs and reports its throughput and memory"""
+    from get_data.tests.benchmark_decode import run_benchmarks, benchmarks
+
+    results = run_benchmarks(rows=[10], widths=[2], min_seconds=0)
+
+    assert sorted(results) == sorted(f"{benchmark}/10x2" for benchmark in benchmarks)
+    assert all(result["per_sec"] > 0 for result in results.values())
+
+
+def test_compare_baseline():
+    """Only a large slowdown or memory increase is a regression"""
+    from get_data.tests.benchmark_decode import compare, BASELINE_PATH
+    import json
+
+    baseline = {"a/10x2": {"per_sec": 1000, "peak_kb": 100}}
+
+    assert compare({"a/10x2": {"per_sec": 600, "peak_kb": 150}}, baseline) == []
+    assert compare({"b/10x2": {"per_sec": 1, "peak_kb": 100000}}, baseline) == []
+    assert len(compare({"a/10x2": {"per_sec": 400, "peak_kb": 500}}, baseline)) == 2
+
+    # the checked in baseline covers every case of the default run
+    with open(BASELINE_PATH) as f:
+        assert "process_response/1000x5" in json.load(f)
@@ -0,0 +1,92 @@
+import pytest
+import os
+import json
+import boto3
+from moto import mock_secretsmanager
+
+from get_data.tests.fake_sap import FakeSapServer
+
+field_mapping_adrc = {
+    "STR_SUPPL3": "City_Subdivision_1",
+    "CITY2": "Region_Subdivision_1",
+    "ADDRNUMBER": "join_field",
+}
+
+
+@pytest.fixture(scope="function")
+def fake_sap(aws_credentials):
+    """starts a FakeSapServer and stores its secrets as the SECRETS secret"""
+
+    def start(**kwargs):
+        server = FakeSapServer(**kwargs)
+        server.start()
+        servers.append(server)
+
+        conn = boto3.client("secretsmanager", region_name="us-east-1")
+        conn.create_secret(Name="fakesap", SecretString=json.dumps(server.secrets))
+        os.environ["SECRETS"] = "fakesap"
+
+        from lambda_common.secrets_cache import secrets_cache
+
+        secrets_cache.invalidate()
+        return server
+
+    servers = []
+    with mock_secretsmanager():
+        yield start
+
+    for server in servers:
+        server.stop()
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_sap_post_req_fake_sap(fake_sap, max_workers):
+    """All rows are read over HTTPS from the fake SAP PI, one RowSkips window at a time"""
+    sap = fake_sap(rows={"ADRC": 2500})
+
+    from get_data.helper_get import sap_post_req
+
+    results = sap_post_req(
+        "ADRC",
+        "ADDRNUMBER,STR_SUPPL3,CITY2",
+        "",
+        field_mapping_adrc,
+        max_workers=max_workers,
+        page_size=1000,
+    )
+
+    assert len(results) == 2500
+    assert results[-1] == {
+        "join_field": "0000002499",
+        "City_Subdivision_1": "0000002499",
+        "Region_Subdivision_1": "0000002499",
+    }
+    assert sorted(request["row_skips"] for request in sap.requests)[:3] == [0, 1000, 2000]
+
+
+def test_sap_post_req_fake_sap_error(fake_sap):
+    """An error injected on one page is raised to the caller"""
+    fake_sap(rows=2500, errors={1000})
+
+    from get_data.helper_get import sap_post_req
+
+    with pytest.raises(Exception) as exc_info:
+        sap_post_req("ADRC", "ADDRNUMBER", "", {"ADDRNUMBER": "id"})
+
+    assert "injected error" in str(exc_info.value)
+
+
+def test_sap_post_req_fake_sap_latency(fake_sap):
+    """Concurrent pages overlap their latency"""
+    import time
+
+    fake_sap(rows=4000, latency=0.2)
+
+    from get_data.helper_get import sap_post_req
+
+    start = time.monotonic()
+    results = sap_post_req("ADRC", "ADDRNUMBER", "", {"ADDRNUMBER": "id"}, max_workers=5)
+
+    assert len(results) == 4000
+    # 5 pages (the last one is empty) take one round of latency instead of five
+    assert time.monotonic() - start < 0.2 * 4
@@ -62,7 +62,7 @@ def test_get_buildings(aws_credentials, s3_data_bucket, secrets_manager, request
 
     from get_data.get_buildings import get_buildings
 
-    assert get_buildings() == [
+    assert list(get_buildings()) == [
         {"id": "000901", "name": "October 6 Plant", "country": "EG"},
         {"id": "001400", "name": "Rio de Janeiro Plant", "country": "BR"},
         {"id": "000000", "name": "Beijing Innovation Ctr-Tianzhu", "country": "CN"},
@@ -67,7 +67,7 @@ def test_get_companies(aws_credentials, s3_data_bucket, secrets_manager, request
 
     from get_data.get_company_code import get_companies
 
-    assert get_companies() == [
+    assert list(get_companies()) == [
         {"id": "001", "name": "The P&G Company", "currencycode": "USD"},
         {"id": "002", "name": "P&G Manufacturing Co.", "currencycode": "USD"},
         {"id": "003", "name": "The P&G Distributing LLC", "currencycode": "USD"},
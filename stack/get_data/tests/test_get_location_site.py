@@ -118,6 +118,28 @@ def test_get_adrc(aws_credentials, s3_data_bucket, secrets_manager, requests_moc
     }
 
 
+def test_get_adrc_address_numbers(aws_credentials, s3_data_bucket, secrets_manager, requests_mock):
+    """Only the addresses of the sites are requested from ADRC"""
+    from get_data.tests.data import get_where_field
+
+    where_fields = []
+
+    def callback(request, context):
+        where_fields.append(get_where_field(request))
+        context.status_code = 200
+        return adrc_response
+
+    requests_mock.register_uri("POST", SAP_URL, text=callback)
+    from get_data.get_location_site import get_adrc
+
+    adrc = get_adrc(address_numbers={"0000000002", "0000000001"})
+
+    assert where_fields[0] == (
+        "ADDR_GROUP EQ 'CA01' AND ADDRNUMBER IN ( '0000000001', '0000000002' )"
+    )
+    assert "0000000001" in adrc
+
+
 def test_get_companies_to_keep(
     aws_credentials, s3_data_bucket, secrets_manager, requests_mock
 ):
@@ -128,7 +150,7 @@ def test_get_companies_to_keep(
 
     from get_data.get_location_site import get_t001w
 
-    assert get_t001w() == [
+    assert list(get_t001w()) == [
         {
             "ID": "0009",
             "Name": "6TH OF OCTOBER CITY PLANT",
@@ -189,7 +211,8 @@ def test_lambda_handler(
     from get_data.get_location_site import lambda_handler
 
     # can only mock one request to endpoint so patching post request to ADRC
-    def get_adrc_modified(local):
+    def get_adrc_modified(local, address_numbers=None):
+        assert address_numbers == {"0000000001", "0000000002", "0000000003"}
         return {
             "0000000001": {
                 "City_Subdivision_1": "CITY_SUBDIVISION_1",
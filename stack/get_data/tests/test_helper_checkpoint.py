@@ -0,0 +1,129 @@
+import pytest
+import os
+import boto3
+from mock import patch
+
+from get_data.tests.data import SAP_URL, get_sap_response, get_row_skips, get_row_count
+
+field_mapping_adrc = {
+    "STR_SUPPL3": "City_Subdivision_1",
+    "CITY2": "Region_Subdivision_1",
+    "ADDRNUMBER": "join_field",
+}
+
+
+def failing_callback(total_rows, requested, fail_at):
+    """requests_mock callback paging total_rows ADRC rows that fails once at RowSkips fail_at"""
+
+    failed = []
+
+    def callback(request, context):
+        row_skips = get_row_skips(request)
+        requested.append(row_skips)
+        if row_skips == fail_at and not failed:
+            failed.append(row_skips)
+            context.status_code = 500
+            return "timed out"
+
+        context.status_code = 200
+        rows = [
+            (f"{i:010}", f"CITY_{i}", f"REGION_{i}")
+            for i in range(row_skips, min(row_skips + get_row_count(request), total_rows))
+        ]
+        return get_sap_response(["ADDRNUMBER", "STR_SUPPL3", "CITY2"], rows)
+
+    return callback
+
+
+def get_checkpoint(path):
+    from get_data.helper_checkpoint import PageCheckpoint
+
+    return PageCheckpoint(path, "ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", "20240101")
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_resume_from_checkpoint(
+    aws_credentials, secrets_manager, requests_mock, tmp_path, max_workers
+):
+    """A retried read replays the saved pages and only requests the rest of the table"""
+    from get_data.helper_get import sap_post_req
+
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=failing_callback(3500, requested, 2000))
+
+    def read():
+        return sap_post_req(
+            "ADRC",
+            "ADDRNUMBER,STR_SUPPL3,CITY2",
+            "",
+            field_mapping_adrc,
+            max_workers=max_workers,
+            checkpoint=get_checkpoint(str(tmp_path)),
+        )
+
+    with pytest.raises(Exception) as exc_info:
+        read()
+    assert str(exc_info.value) == "b'timed out'"
+    assert get_checkpoint(str(tmp_path)).list_pages() == ["000000000000.json", "000000001000.json"]
+
+    requested.clear()
+    results = read()
+
+    assert sorted(requested)[:2] == [2000, 3000]
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(3500)]
+    assert results[0] == {
+        "join_field": "0000000000",
+        "City_Subdivision_1": "CITY_0",
+        "Region_Subdivision_1": "REGION_0",
+    }
+
+    # the checkpoint is removed once every row was read
+    assert get_checkpoint(str(tmp_path)).list_pages() == []
+
+
+def test_checkpoint_s3(aws_credentials, s3_data_bucket):
+    """Pages can be saved to S3 so a retry in another container can resume"""
+    bucket = os.environ.get("BUCKET")
+    checkpoint = get_checkpoint(f"s3://{bucket}/sap_checkpoints")
+
+    checkpoint.save_page([{"id": "1"}, {"id": "2"}])
+    checkpoint.save_page([])
+    checkpoint.save_page([{"id": "3"}])
+
+    response = boto3.client("s3").list_objects_v2(Bucket=bucket, Prefix="sap_checkpoints/")
+    keys = [item["Key"] for item in response["Contents"]]
+    assert len(keys) == 2
+    assert keys[0].startswith("sap_checkpoints/ADRC/20240101/")
+
+    resumed = get_checkpoint(f"s3://{bucket}/sap_checkpoints")
+    assert list(resumed.iter_saved_rows()) == [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+    assert resumed.offset == 3
+
+    resumed.clear()
+    assert get_checkpoint(f"s3://{bucket}/sap_checkpoints").list_pages() == []
+
+
+def test_checkpoint_keyed_by_query(tmp_path):
+    """A different query or run date does not resume from another read's pages"""
+    from get_data.helper_checkpoint import PageCheckpoint
+
+    get_checkpoint(str(tmp_path)).save_page([{"id": "1"}])
+
+    select = "ADDRNUMBER,STR_SUPPL3,CITY2"
+    other_where = PageCheckpoint(str(tmp_path), "ADRC", select, "X", "20240101")
+    other_date = PageCheckpoint(str(tmp_path), "ADRC", select, "", "20240102")
+
+    assert other_where.list_pages() == []
+    assert other_date.list_pages() == []
+    assert get_checkpoint(str(tmp_path)).list_pages() == ["000000000000.json"]
+
+
+def test_no_checkpoint_by_default():
+    """Checkpoints are only used when SAP_CHECKPOINT_PATH is set"""
+    from get_data.helper_checkpoint import get_checkpoint
+
+    assert get_checkpoint("ADRC", "ADDRNUMBER", "") is None
+
+    with patch("get_data.helper_checkpoint.SAP_CHECKPOINT_PATH", "/tmp/sap_checkpoints"):
+        checkpoint = get_checkpoint("ADRC", "ADDRNUMBER", "")
+        assert checkpoint.prefix.startswith("/tmp/sap_checkpoints/ADRC/")
@@ -1,14 +1,28 @@
 import pytest
 import json
 import os
+import tempfile
 import requests
 import moto
 from mock import patch
 import boto3
 
-from get_data.tests.data import SAP_URL, Response
+from get_data.tests.data import (
+    SAP_URL,
+    Response,
+    get_sap_response,
+    get_row_skips,
+    get_row_count,
+    get_where_field,
+    get_xml,
+)
+
+
+def has_module(name):
+    import importlib.util
+
+    return importlib.util.find_spec(name) is not None
 
-# doesn't test for paging results from SAP.
 
 adrc_response = """<SOAP:Envelope xmlns:SOAP='http://schemas.xmlsoap.org/soap/envelope/'>
     <SOAP:Header/>
@@ -205,6 +219,71 @@ def test_process_response_bad_mapping():
     assert str(exc_info.value) == "unknown field header mapping, please update"
 
 
+def test_process_response_singlefield_singlerow():
+    """A single Item in the response is still one row rather than a row per character"""
+    from get_data.helper_get import process_response
+
+    results = []
+    response = get_sap_response(["GEBNR"], [("000901",)])
+
+    num_responses = process_response(Response(response, 200), results, {"GEBNR": "COLUMN"})
+
+    assert num_responses == 1
+    assert results == [{"COLUMN": "000901"}]
+
+
+def test_process_response_twofields():
+    """Two FieldDetails are mapped like any other number of fields"""
+    from get_data.helper_get import process_response
+
+    results = []
+    response = get_sap_response(["BUKRS", "BUTXT"], [("001 ", "The P&#38;G Company  ")])
+
+    num_responses = process_response(Response(response, 200), results, None)
+
+    assert num_responses == 1
+    assert results == [{"BUKRS": "001", "BUTXT": "The P&G Company"}]
+
+
+def test_process_response_empty_page():
+    """A page past the end of the table has headers but no Items"""
+    from get_data.helper_get import process_response
+
+    results = []
+    response = get_sap_response(["GEBNR"], [])
+
+    assert process_response(Response(response, 200), results, None) == 0
+    assert results == []
+
+
+def test_decode_response():
+    """Column names are read once and values are yielded as tuples per Item"""
+    from get_data.helper_get import decode_response
+
+    column_names, rows = decode_response(get_xml("one_field_single_response.xml"), None)
+
+    assert column_names == ["GEBNR"]
+    assert list(rows) == [("000901",), ("000902",), ("000905",)]
+
+    column_names, rows = decode_response(adrc_response.encode(), field_mapping_adrc)
+
+    assert column_names == ["join_field", "City_Subdivision_1", "Region_Subdivision_1"]
+    assert next(rows) == ("0000000001", "CITY_SUBDIVISION_1", "REGION_SUBDIVISION_1")
+    assert len(list(rows)) == 2
+
+
+def test_decode_response_no_fields():
+    """A response without FieldDetails can't be mapped"""
+    from get_data.helper_get import decode_response
+
+    response = get_sap_response([], [("000901",)])
+
+    with pytest.raises(Exception) as exc_info:
+        decode_response(response, None)
+
+    assert str(exc_info.value) == "no field headers?"
+
+
 @pytest.mark.dependency()
 def test_write_sap_json():
     """Format the response from SAP and write in Athena readable format into local temp file"""
@@ -266,6 +345,298 @@ def test_upload_file_error(aws_credentials, s3_data_bucket):
     assert "Parameter validation failed:" in str(exc_info.value)
 
 
+@pytest.mark.dependency(depends=["test_write_sap_json"])
+def test_upload_rows(aws_credentials, s3_data_bucket):
+    """Rows streamed to S3 are formatted the same way as write_sap_json"""
+    from get_data.helper_get import upload_rows
+
+    input_file = "stack/get_data/tests/data/test.json"
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    filename = "test.json"
+    rows = [
+        {
+            "join_field": "0000000001",
+            "City_Subdivision_1": "CITY_SUBDIVISION_1",
+            "Region_Subdivision_1": "REGION_SUBDIVISION_1",
+        },
+        {
+            "join_field": "0000000002",
+            "City_Subdivision_1": "CITY_SUBDIVISION_2",
+            "Region_Subdivision_1": "REGION_SUBDIVISION_2",
+        },
+        {
+            "join_field": "0000000004",
+            "City_Subdivision_1": "CITY_SUBDIVISION_3",
+            "Region_Subdivision_1": "REGION_SUBDIVISION_3",
+        },
+    ]
+
+    # rows can come from a generator so they never have to be held in memory together
+    assert upload_rows((row for row in rows), bucket, prefix, filename) == 3
+
+    client = boto3.client("s3")
+    response = client.get_object(Bucket=bucket, Key=f"{prefix}{filename}")
+    assert response["ServerSideEncryption"] == "AES256"
+    with open(input_file, "r") as f:
+        assert f.read() == response["Body"].read().decode("utf-8")
+
+
+def test_upload_rows_multipart(aws_credentials, s3_data_bucket):
+    """Large outputs are uploaded in multiple parts"""
+    from boto3.s3.transfer import TransferConfig
+    from get_data.helper_get import upload_rows
+
+    # 5MB is the smallest part size S3 allows
+    part_size = 5 * 1024 * 1024
+    config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    rows = ({"id": f"{i:06}", "name": "x" * 100} for i in range(100000))
+
+    with patch("lambda_common.s3_transfer.transfer_config", config):
+        assert upload_rows(rows, bucket, prefix, "big.json") == 100000
+
+    client = boto3.client("s3")
+    # multipart uploads have an ETag ending with the number of parts
+    etag = client.head_object(Bucket=bucket, Key=f"{prefix}big.json")["ETag"]
+    assert int(etag.strip('"').split("-")[1]) > 1
+    lines = client.get_object(Bucket=bucket, Key=f"{prefix}big.json")["Body"].read().splitlines()
+    assert len(lines) == 100000
+    assert json.loads(lines[-1]) == {"id": "099999", "name": "x" * 100}
+
+
+def test_upload_rows_error(aws_credentials, s3_data_bucket):
+    """Error streaming the rows to S3"""
+    from get_data.helper_get import upload_rows
+
+    with pytest.raises(Exception) as exc_info:
+        upload_rows([{"id": "1"}], "UNKNOWN BUCKET", os.environ.get("SITE_NEW"), "test.json")
+
+    assert "Parameter validation failed:" in str(exc_info.value)
+
+
+def test_json_rows_reader():
+    """Rows are only formatted as they are read"""
+    from get_data.helper_get import JsonRowsReader
+
+    rows = iter([{"a": "1"}, {"a": "2"}, {"a": "3"}])
+    reader = JsonRowsReader(rows)
+
+    assert reader.read(4) == b'{"a"'
+    assert reader.count == 1
+    assert reader.read(8) == b':"1"}\n{"'
+    assert reader.count == 2
+    assert reader.read() == b'a":"2"}\n{"a":"3"}\n'
+    assert reader.count == 3
+    assert reader.read(10) == b""
+
+
+def decode_output(body, format):
+    """rows of an extract written in any of the output formats"""
+    import io
+    import gzip
+
+    if format == "parquet":
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(io.BytesIO(body)).to_pylist()
+    if format == "json.gz":
+        body = gzip.decompress(body)
+    if format == "json.zst":
+        import zstandard
+
+        body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read()
+    return [json.loads(line) for line in body.splitlines()]
+
+
+output_formats = [
+    "json",
+    "json.gz",
+    pytest.param("json.zst", marks=pytest.mark.skipif(not has_module("zstandard"), reason="")),
+    pytest.param("parquet", marks=pytest.mark.skipif(not has_module("pyarrow"), reason="")),
+]
+
+
+@pytest.mark.parametrize("format", output_formats)
+def test_write_sap_json_format(tmp_path, format):
+    """Extracts can be written compressed or as parquet"""
+    from get_data.helper_get import write_sap_json
+
+    rows = [{"id": f"{i:06}", "name": "x" * 100} for i in range(1000)]
+    output_path = tmp_path / "test"
+    write_sap_json(iter(rows), output_path, format)
+
+    assert decode_output(output_path.read_bytes(), format) == rows
+    if format != "json":
+        assert output_path.stat().st_size < len(json.dumps(rows)) / 4
+
+
+@pytest.mark.parametrize("format", output_formats)
+def test_upload_rows_format(aws_credentials, s3_data_bucket, format):
+    """Rows are uploaded in the output format, with its extension"""
+    from get_data.helper_get import upload_rows
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    rows = [{"id": f"{i:06}", "name": "x" * 100} for i in range(1000)]
+
+    assert upload_rows(iter(rows), bucket, prefix, "test.json", format) == 1000
+
+    key = {
+        "json": "test.json",
+        "json.gz": "test.json.gz",
+        "json.zst": "test.json.zst",
+        "parquet": "test.parquet",
+    }[format]
+    body = boto3.client("s3").get_object(Bucket=bucket, Key=f"{prefix}{key}")["Body"].read()
+    assert decode_output(body, format) == rows
+
+
+@pytest.mark.parametrize("format", output_formats)
+def test_upload_file_format(aws_credentials, s3_data_bucket, tmp_path, format):
+    """A local JSON file is converted to the output format as it is uploaded"""
+    from get_data.helper_get import upload_file, write_sap_json, get_output_filename
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    rows = [{"id": f"{i:06}", "name": "x" * 100} for i in range(1000)]
+    input_file = tmp_path / "test.json"
+    write_sap_json(rows, input_file, "json")
+
+    upload_file(str(input_file), bucket, prefix, "test.json", format)
+
+    key = f"{prefix}{get_output_filename('test.json', format)}"
+    body = boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+    assert decode_output(body, format) == rows
+
+
+@pytest.mark.parametrize("format", output_formats)
+def test_upload_rows_unchanged(aws_credentials, s3_data_bucket, format):
+    """Rows the same as the ones already waiting in new_run/ are not uploaded again"""
+    from get_data.helper_get import upload_rows, get_output_filename
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    key = f"{prefix}{get_output_filename('test.json', format)}"
+    rows = [{"id": f"{i:06}", "name": "x" * 100} for i in range(1000)]
+    client = boto3.client("s3")
+
+    assert upload_rows(iter(rows), bucket, prefix, "test.json", format) == 1000
+    first = client.head_object(Bucket=bucket, Key=key)
+    assert len(first["Metadata"]["content-sha256"]) == 64
+
+    # the same rows again are counted but not copied from their staging key
+    with patch("get_data.helper_get.copy_object") as copy_object:
+        assert upload_rows(iter(rows), bucket, prefix, "test.json", format) == 1000
+    assert copy_object.call_count == 0
+    staging = client.list_objects_v2(Bucket=bucket, Prefix="site_staging/")
+    assert staging["KeyCount"] == 0
+
+    # changed rows are uploaded
+    rows[0]["name"] = "changed"
+    assert upload_rows(iter(rows), bucket, prefix, "test.json", format) == 1000
+    second = client.head_object(Bucket=bucket, Key=key)
+    assert second["Metadata"]["content-sha256"] != first["Metadata"]["content-sha256"]
+
+
+def test_upload_file_unchanged(aws_credentials, s3_data_bucket, tmp_path):
+    """A file the same as the one processed in prev_run/ is copied back to new_run/ within S3"""
+    from get_data.helper_get import upload_file, upload_rows, write_sap_json
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    prev_prefix = prefix.replace("_new_run", "_prev_run")
+    rows = [{"id": f"{i:06}", "name": "x"} for i in range(10)]
+    input_file = tmp_path / "site.json"
+    write_sap_json(rows, input_file, "json")
+    client = boto3.client("s3")
+
+    # upload_file and upload_rows hash the same content the same way
+    upload_rows(iter(rows), bucket, prev_prefix, "site.json", "json")
+
+    assert upload_file(str(input_file), bucket, prefix, "site.json", "json") is False
+    response = client.get_object(Bucket=bucket, Key=f"{prefix}site.json")
+    assert response["Body"].read() == input_file.read_bytes()
+    assert response["ServerSideEncryption"] == "AES256"
+
+    # once it's waiting in new_run/, it isn't copied again
+    client.delete_object(Bucket=bucket, Key=f"{prev_prefix}site.json")
+    assert upload_file(str(input_file), bucket, prefix, "site.json", "json") is False
+
+    write_sap_json(rows[1:], input_file, "json")
+    assert upload_file(str(input_file), bucket, prefix, "site.json", "json") is True
+    response = client.get_object(Bucket=bucket, Key=f"{prefix}site.json")
+    assert response["Body"].read() == input_file.read_bytes()
+
+
+@pytest.mark.parametrize("format", output_formats)
+def test_upload_manifest(aws_credentials, s3_data_bucket, tmp_path, format):
+    """Uploads have a manifest of their rows, the same for a file and for streamed rows"""
+    from get_data.helper_get import upload_file, upload_rows, write_sap_json, get_output_filename
+    from lambda_common.manifest import read_manifest
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    rows = [{"id": f"{i:06}", "name": "x" * 100} for i in range(1000)]
+    input_file = tmp_path / "test.json"
+    write_sap_json(rows, input_file, "json")
+    client = boto3.client("s3")
+
+    upload_rows(iter(rows), bucket, prefix, "rows.json", format)
+    manifest = read_manifest(client, bucket, f"{prefix}{get_output_filename('rows.json', format)}")
+    assert manifest["count"] == 1000
+    assert manifest["size"] == input_file.stat().st_size
+    assert manifest["columns"] == ["id", "name"]
+
+    upload_file(str(input_file), bucket, prefix, "file.json", format)
+    key = f"{prefix}{get_output_filename('file.json', format)}"
+    assert read_manifest(client, bucket, key) == manifest
+
+
+def test_read_manifest_missing(aws_credentials, s3_data_bucket):
+    """Objects without a manifest, or missing, have none"""
+    from lambda_common.manifest import read_manifest
+
+    bucket = os.environ.get("BUCKET")
+    client = boto3.client("s3")
+    client.put_object(Bucket=bucket, Key="site_new_run/site.json", Body=b"{}\n")
+
+    assert read_manifest(client, bucket, "site_new_run/site.json") is None
+    assert read_manifest(client, bucket, "site_new_run/missing.json") is None
+
+
+def test_output_format_unknown():
+    """Only the supported output formats can be used"""
+    from get_data.helper_get import get_output_filename, write_sap_json
+
+    assert get_output_filename("site.json", "json.gz") == "site.json.gz"
+    assert get_output_filename("site.json", "parquet") == "site.parquet"
+
+    with pytest.raises(Exception) as exc_info:
+        write_sap_json([], "test.csv", "csv")
+
+    assert str(exc_info.value) == "unknown output format csv"
+
+
+def test_iter_sap_rows(aws_credentials, secrets_manager, requests_mock):
+    """Pages are only requested from SAP as the rows are consumed"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(2500, requested))
+
+    from get_data.helper_get import iter_sap_rows
+
+    rows = iter_sap_rows("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc)
+    assert requested == []
+
+    assert next(rows)["join_field"] == "0000000000"
+    assert requested == [0]
+
+    assert len(list(rows)) == 2499
+    assert requested == [0, 1000, 2000]
+
+
 def test_sap_post_req_success(aws_credentials, secrets_manager, requests_mock):
     """Send a SOAP envelope to SAP and return processed results. Creds stored in Secretsmanager"""
     requests_mock.register_uri("POST", SAP_URL, text=adrc_response, status_code=200)
@@ -313,3 +684,579 @@ def test_sap_post_req_failure(aws_credentials, secrets_manager, requests_mock):
         sap_post_req(sap_table_name, sap_select_fields, sap_where_field, field_mapping_adrc)
 
     assert str(exc_info.value) == "b'here is my error'"
+
+
+def sap_paged_callback(total_rows, requested):
+    """returns a requests_mock callback that pages total_rows ADRC rows by RowSkips"""
+
+    def callback(request, context):
+        row_skips = get_row_skips(request)
+        requested.append(row_skips)
+        context.status_code = 200
+        rows = [
+            (f"{i:010}", f"CITY_{i}", f"REGION_{i}")
+            for i in range(row_skips, min(row_skips + get_row_count(request), total_rows))
+        ]
+        return get_sap_response(["ADDRNUMBER", "STR_SUPPL3", "CITY2"], rows)
+
+    return callback
+
+
+def test_sap_post_req_paging(aws_credentials, secrets_manager, requests_mock):
+    """Keep requesting pages from SAP until a page is empty"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(2500, requested))
+
+    from get_data.helper_get import sap_post_req
+
+    results = sap_post_req("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc)
+
+    assert requested == [0, 1000, 2000, 2500]
+    assert len(results) == 2500
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(2500)]
+
+
+@pytest.mark.parametrize("max_workers", [2, 3, 8])
+def test_sap_post_req_concurrent_paging(
+    aws_credentials, secrets_manager, requests_mock, max_workers
+):
+    """Concurrent paging returns the same rows in the same order as sequential paging"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(2500, requested))
+
+    from get_data.helper_get import sap_post_req
+
+    results = sap_post_req(
+        "ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc, max_workers=max_workers
+    )
+
+    assert len(results) == 2500
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(2500)]
+    assert results[0] == {
+        "join_field": "0000000000",
+        "City_Subdivision_1": "CITY_0",
+        "Region_Subdivision_1": "REGION_0",
+    }
+
+    # every window up to the short page is requested once, nothing past the pool is requested
+    assert [requested.count(row_skips) for row_skips in [0, 1000, 2000]] == [1, 1, 1]
+    assert max(requested) < 2000 + max_workers * 1000
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_sap_post_req_page_size(aws_credentials, secrets_manager, requests_mock, max_workers):
+    """The page size can be set per table"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(2500, requested))
+
+    from get_data.helper_get import sap_post_req
+
+    with patch.dict("get_data.helper_get.SAP_PAGE_SIZES", {"ADRC": 700}):
+        results = sap_post_req(
+            "ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc, max_workers=max_workers
+        )
+
+    assert sorted(requested)[:4] == [0, 700, 1400, 2100]
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(2500)]
+    assert "<RowCount>700</RowCount>" in requests_mock.request_history[0].text
+
+    # a page size passed in overrides the table's
+    requested.clear()
+    sap_post_req("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc, page_size=2500)
+    assert requested == [0, 2500]
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_sap_post_req_auto_page_size(
+    aws_credentials, secrets_manager, requests_mock, max_workers
+):
+    """An auto tuned page size grows while responses are small and fast"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(10000, requested))
+
+    from get_data.helper_get import sap_post_req, PageSize
+
+    page_size = PageSize(500, auto_tune=True, target_bytes=10 * 1024 * 1024)
+    results = sap_post_req(
+        "ADRC",
+        "ADDRNUMBER,STR_SUPPL3,CITY2",
+        "",
+        field_mapping_adrc,
+        max_workers=max_workers,
+        page_size=page_size,
+    )
+
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(10000)]
+    assert page_size.size > 500
+    assert len(requested) < 10000 // 500
+
+
+def test_page_size_update():
+    """The page size moves towards the byte and latency targets, at most 2x per page"""
+    from get_data.helper_get import PageSize
+
+    page_size = PageSize(1000, auto_tune=True, target_bytes=100000, target_seconds=10)
+
+    # 1000 rows of 50 bytes in 1 second, the byte target allows 2000 rows
+    page_size.update(1000, 50000, 1)
+    assert page_size.size == 2000
+
+    # 2000 rows in 8 seconds, the latency target only allows 2500 rows
+    page_size.update(2000, 10000, 8)
+    assert page_size.size == 2500
+
+    # a very large response halves the page size
+    page_size.update(2500, 10000000, 1)
+    assert page_size.size == 1250
+
+    # never below the minimum, and a fixed page size is not changed
+    page_size = PageSize(1000, auto_tune=True, min_size=800, target_bytes=1)
+    page_size.update(1000, 1000000, 1)
+    assert page_size.size == 800
+
+    page_size = PageSize(1000)
+    page_size.update(1000, 1000000, 1)
+    assert page_size.size == 1000
+
+
+def test_sap_post_req_concurrent_paging_exact_page(
+    aws_credentials, secrets_manager, requests_mock
+):
+    """A table with an exact multiple of 1000 rows ends on the empty page after it"""
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(2000, requested))
+
+    from get_data.helper_get import sap_post_req
+
+    results = sap_post_req(
+        "ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc, max_workers=4
+    )
+
+    assert len(results) == 2000
+    assert [row["join_field"] for row in results] == [f"{i:010}" for i in range(2000)]
+
+
+def test_sap_post_req_concurrent_failure(aws_credentials, secrets_manager, requests_mock):
+    """An error on any page is raised to the caller"""
+    requests_mock.register_uri("POST", SAP_URL, text="here is my error", status_code=500)
+
+    from get_data.helper_get import sap_post_req
+
+    with pytest.raises(Exception) as exc_info:
+        sap_post_req("ADRC", "ADDRNUMBER", "", None, max_workers=3)
+
+    assert str(exc_info.value) == "b'here is my error'"
+
+
+def test_get_sap_client_cached(aws_credentials, secrets_manager, requests_mock):
+    """The SAP PI client and its secrets are created once and reused for every page and table"""
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(1500, []))
+
+    from get_data.helper_get import get_sap_client, sap_post_req
+
+    client = get_sap_client()
+
+    # a warm container does not call Secrets Manager again
+    with patch("lambda_common.secrets_cache.boto3") as boto:
+        sap_post_req("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc)
+        sap_post_req("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc)
+
+        assert get_sap_client() is client
+        boto.client.assert_not_called()
+
+    # all four pages were sent through the same keep-alive session
+    assert requests_mock.call_count == 4
+    assert client.verify == "get_data/certificates/agwa_server.pem"
+    # the deployed path is relative to the root of the package, stack/
+    stack_dir = os.path.join(os.path.dirname(__file__), "..", "..")
+    assert os.path.exists(os.path.join(stack_dir, client.verify))
+
+    # a local client uses a different path for the server certificate
+    assert get_sap_client(True) is not client
+    assert get_sap_client(True).verify == "certificates/agwa_server.pem"
+
+
+def test_sap_client_verify_env(aws_credentials, secrets_manager, requests_mock, monkeypatch):
+    """The SAP PI server CA is used even when the environment has its own CA bundle"""
+    requests_mock.register_uri("POST", SAP_URL, text=sap_paged_callback(10, []))
+    monkeypatch.setenv("REQUESTS_CA_BUNDLE", "/etc/ssl/certs/other-bundle.pem")
+    monkeypatch.setenv("CURL_CA_BUNDLE", "/etc/ssl/certs/other-bundle.pem")
+
+    from get_data.helper_get import get_sap_client, sap_post_req
+
+    sap_post_req("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "", field_mapping_adrc)
+
+    assert requests_mock.last_request.verify == get_sap_client().verify
+
+
+def test_get_sap_client_rotated(aws_credentials, secrets_manager, requests_mock):
+    """The connections of the old client are closed when the client is rebuilt"""
+    from get_data.helper_get import get_sap_client
+    from lambda_common.secrets_cache import invalidate_secrets
+
+    client = get_sap_client()
+    with patch.object(client.session, "close") as close:
+        invalidate_secrets()
+        assert get_sap_client() is not client
+
+    close.assert_called_once()
+
+
+def test_sap_post_req_auth_error(aws_credentials, secrets_manager, requests_mock):
+    """An auth error invalidates the cached secrets so a new client is created on the next call"""
+    requests_mock.register_uri("POST", SAP_URL, text="<html>401</html>", status_code=401)
+
+    from get_data.helper_get import get_sap_client, sap_post_req
+
+    client = get_sap_client()
+
+    with pytest.raises(Exception) as exc_info:
+        sap_post_req("ADRC", "ADDRNUMBER", "", None)
+
+    assert str(exc_info.value) == "b'<html>401</html>'"
+    assert get_sap_client() is not client
+
+
+def test_sap_post_req_ssl_error(aws_credentials, secrets_manager, requests_mock):
+    """A TLS failure raises a cert error and invalidates the cached secrets"""
+    requests_mock.register_uri("POST", SAP_URL, exc=requests.exceptions.SSLError)
+
+    from get_data.helper_get import get_sap_client, sap_post_req
+
+    client = get_sap_client()
+
+    with pytest.raises(Exception) as exc_info:
+        sap_post_req("ADRC", "ADDRNUMBER", "", None)
+
+    assert str(exc_info.value) == "cert error"
+    assert get_sap_client() is not client
+
+
+def test_get_sap_client_cert_error(aws_credentials, secrets_manager):
+    """An invalid client certificate raises a cert error and does not leave files behind"""
+    from get_data.helper_get import load_client_cert
+
+    tmp_dir = tempfile.gettempdir()
+    before = set(os.listdir(tmp_dir))
+
+    with pytest.raises(Exception) as exc_info:
+        load_client_cert("not a certificate", "not a key")
+
+    assert str(exc_info.value) == "cert error"
+    assert set(os.listdir(tmp_dir)) == before
+
+
+def test_fetch_concurrently():
+    """Reads run at the same time and their results come back in order"""
+    import time
+    from get_data.helper_get import fetch_concurrently
+
+    def slow_read(value):
+        def read():
+            time.sleep(0.5)
+            return value
+
+        return read
+
+    def slow_rows():
+        time.sleep(0.5)
+        for i in range(2500):
+            yield {"id": i}
+
+    start = time.time()
+    first, second, rows = fetch_concurrently(slow_read(["0009"]), slow_read({"a": 1}), slow_rows)
+
+    assert first == ["0009"]
+    assert second == {"a": 1}
+    assert [row["id"] for row in rows] == list(range(2500))
+    assert time.time() - start < 1.0
+
+
+def test_fetch_concurrently_error():
+    """An error in any read is raised to the caller, streamed reads raise while iterating"""
+    from get_data.helper_get import fetch_concurrently
+
+    def failed_read():
+        raise Exception("failed to connect")
+
+    def failed_rows():
+        yield {"id": 1}
+        raise Exception("b'here is my error'")
+
+    with pytest.raises(Exception) as exc_info:
+        fetch_concurrently(failed_read, lambda: [])
+    assert str(exc_info.value) == "failed to connect"
+
+    (rows,) = fetch_concurrently(failed_rows)
+    with pytest.raises(Exception) as exc_info:
+        list(rows)
+    assert str(exc_info.value) == "b'here is my error'"
+
+
+@patch("get_data.helper_get.SAP_PAGE_SIZE", 10)
+def test_fetch_concurrently_backpressure():
+    """A streamed read only pages a few pages ahead of a slower consumer"""
+    import time
+    from get_data.helper_get import fetch_concurrently, SAP_READ_AHEAD
+
+    produced = []
+
+    def rows():
+        for i in range(10000):
+            produced.append(i)
+            yield {"id": i}
+
+    (streamed,) = fetch_concurrently(rows)
+    time.sleep(0.5)
+
+    # the pages in the queue, the one being filled and the one the consumer holds
+    assert len(produced) <= (SAP_READ_AHEAD + 2) * 10
+    assert [row["id"] for row in streamed] == list(range(10000))
+
+
+@patch("get_data.helper_get.SAP_PAGE_SIZE", 10)
+def test_fetch_concurrently_abandoned():
+    """Closing or dropping a streamed read stops its paging"""
+    import time
+    from get_data.helper_get import fetch_concurrently
+
+    closed = []
+
+    def rows():
+        try:
+            for i in range(10000):
+                yield {"id": i}
+        finally:
+            closed.append(True)
+
+    (streamed,) = fetch_concurrently(rows)
+    assert next(streamed) == {"id": 0}
+    streamed.close()
+
+    time.sleep(0.5)
+    assert closed == [True]
+    assert list(streamed) == []
+
+    # an upload that fails part way drops the rows without closing them
+    (streamed,) = fetch_concurrently(rows)
+    next(streamed)
+    del streamed
+
+    time.sleep(0.5)
+    assert closed == [True, True]
+
+
+def test_fetch_concurrently_error_stops_reads():
+    """An error in one read stops the streamed reads of the other tables"""
+    import time
+    from get_data.helper_get import fetch_concurrently
+
+    closed = []
+
+    def rows():
+        try:
+            for i in range(100000):
+                yield {"id": i}
+        finally:
+            closed.append(True)
+
+    def failed_read():
+        time.sleep(0.2)
+        raise Exception("failed to connect")
+
+    with pytest.raises(Exception):
+        fetch_concurrently(rows, failed_read)
+
+    time.sleep(0.5)
+    assert closed == [True]
+
+
+def sap_table_callback(rows_by_where, requested):
+    """returns a requests_mock callback that answers with the ADRC rows for each WhereField"""
+
+    def callback(request, context):
+        where_field = get_where_field(request)
+        requested.append(where_field)
+        context.status_code = 200
+        return get_sap_response(["ADDRNUMBER", "STR_SUPPL3", "CITY2"], rows_by_where[where_field])
+
+    return callback
+
+
+def test_sap_incremental_req(aws_credentials, s3_data_bucket, secrets_manager, requests_mock):
+    """First run reads the whole table, next runs only read and merge the changed rows"""
+    from datetime import datetime, timezone
+    from get_data.helper_get import sap_incremental_req
+    from get_data.helper_join import key_field
+
+    today = datetime.now(timezone.utc).strftime("%Y%m%d")
+    changed_where = f"ADDR_GROUP EQ 'CA01' AND AEDAT GE '{today}'"
+    requested = []
+    rows_by_where = {
+        "ADDR_GROUP EQ 'CA01'": [
+            ("0000000001", "CITY_1", "REGION_1"),
+            ("0000000002", "CITY_2", "REGION_2"),
+        ],
+        changed_where: [
+            ("0000000002", "CITY_2_NEW", "REGION_2"),
+            ("0000000003", "CITY_3", "REGION_3"),
+        ],
+    }
+    requests_mock.register_uri("POST", SAP_URL, text=sap_table_callback(rows_by_where, requested))
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    args = ("ADRC", "ADDRNUMBER,STR_SUPPL3,CITY2", "ADDR_GROUP EQ 'CA01'", field_mapping_adrc)
+    key = key_field("join_field")
+
+    # no watermark yet, so everything is read
+    results = sap_incremental_req(*args, key, "AEDAT", bucket, prefix)
+    assert requested == ["ADDR_GROUP EQ 'CA01'"]
+    assert [row["City_Subdivision_1"] for row in results] == ["CITY_1", "CITY_2"]
+
+    client = boto3.client("s3")
+    watermark = client.get_object(Bucket=bucket, Key="site_snapshot/ADRC.watermark.json")
+    assert json.loads(watermark["Body"].read())["watermark"] == today
+
+    # second run only reads the changed rows and merges them into the snapshot
+    results = sap_incremental_req(*args, key, "AEDAT", bucket, prefix)
+    assert requested[-1] == changed_where
+    assert [row["City_Subdivision_1"] for row in results] == ["CITY_1", "CITY_2_NEW", "CITY_3"]
+
+    snapshot = client.get_object(Bucket=bucket, Key="site_snapshot/ADRC.json")
+    assert len(snapshot["Body"].read().splitlines()) == 3
+
+    # nothing was written into the new_run/ prefix
+    assert "Contents" not in client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+
+    # full refresh reads the whole table again, dropping rows that are no longer in SAP
+    results = sap_incremental_req(*args, key, "AEDAT", bucket, prefix, full_refresh=True)
+    assert requested[-1] == "ADDR_GROUP EQ 'CA01'"
+    assert [row["City_Subdivision_1"] for row in results] == ["CITY_1", "CITY_2"]
+
+
+def test_sap_incremental_req_query_changed(
+    aws_credentials, s3_data_bucket, secrets_manager, requests_mock
+):
+    """A watermark stored for a different query is not used"""
+    from get_data.helper_get import sap_incremental_req
+    from get_data.helper_join import key_field
+
+    requested = []
+    rows_by_where = {
+        "": [("0000000001", "CITY_1", "REGION_1")],
+        "ADDR_GROUP EQ 'CA01'": [("0000000001", "CITY_1", "REGION_1")],
+    }
+    requests_mock.register_uri("POST", SAP_URL, text=sap_table_callback(rows_by_where, requested))
+
+    bucket = os.environ.get("BUCKET")
+    prefix = os.environ.get("SITE_NEW")
+    key = key_field("join_field")
+    fields = "ADDRNUMBER,STR_SUPPL3,CITY2"
+
+    sap_incremental_req("ADRC", fields, "", field_mapping_adrc, key, "AEDAT", bucket, prefix)
+    sap_incremental_req(
+        "ADRC", fields, "ADDR_GROUP EQ 'CA01'", field_mapping_adrc, key, "AEDAT", bucket, prefix
+    )
+
+    assert requested == ["", "ADDR_GROUP EQ 'CA01'"]
+
+
+def test_get_changed_where_field():
+    """The change date condition is added to the existing WhereField"""
+    from get_data.helper_get import get_changed_where_field, get_snapshot_prefix
+
+    assert get_changed_where_field("", "AEDAT", "20200101") == "AEDAT GE '20200101'"
+    assert (
+        get_changed_where_field("ZZBLDG_REF EQ 'X'", "AEDAT", "20200101")
+        == "ZZBLDG_REF EQ 'X' AND AEDAT GE '20200101'"
+    )
+    assert get_snapshot_prefix("site_new_run/") == "site_snapshot/"
+
+
+def sap_fields_callback(total_rows, requested):
+    """returns a requests_mock callback with total_rows rows of whatever SelectFields are asked"""
+    import re
+
+    def callback(request, context):
+        fields = re.search(r"<SelectFields>(.*)</SelectFields>", request.text).group(1).split(",")
+        requested.append(fields)
+        context.status_code = 200
+        rows = [[f"{field}_{i}" for field in fields] for i in range(total_rows)]
+        return get_sap_response(fields, rows)
+
+    return callback
+
+
+def test_sap_cached_req(aws_credentials, s3_data_bucket, secrets_manager, requests_mock):
+    """Extracts reading the same table in a cycle share one read from SAP PI"""
+    from get_data.helper_get import sap_cached_req
+
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_fields_callback(3, requested))
+    where = "ZZBLDG_REF EQ 'X'"
+
+    with patch("get_data.helper_get.SAP_CACHE_PREFIX", "sap_cache/"):
+        mapping = {"WERKS": "ID", "NAME1": "Name"}
+        sites = list(sap_cached_req("T001W", "WERKS,NAME1", where, mapping))
+        site_ids = list(sap_cached_req("T001W", "WERKS", where, None))
+
+        assert sites[2] == {"ID": "WERKS_2", "Name": "NAME1_2"}
+        assert site_ids == [{"WERKS": "WERKS_0"}, {"WERKS": "WERKS_1"}, {"WERKS": "WERKS_2"}]
+        assert requested == [["WERKS", "NAME1"]]
+
+        # a field that isn't cached yet reads the table again, with the fields of both
+        assert list(sap_cached_req("T001W", "LAND1", where, None))[0] == {"LAND1": "LAND1_0"}
+        assert requested[-1] == ["WERKS", "NAME1", "LAND1"]
+
+        # another where clause is another read
+        list(sap_cached_req("T001W", "WERKS", "", None))
+        assert len(requested) == 3
+
+        # an expired read isn't used
+        list(sap_cached_req("T001W", "WERKS", where, None, ttl=-1))
+        assert len(requested) == 4
+
+
+def test_sap_cached_req_disabled(aws_credentials, secrets_manager, requests_mock):
+    """Without SAP_CACHE_PREFIX every read goes to SAP PI"""
+    from get_data.helper_get import sap_cached_req
+
+    requested = []
+    requests_mock.register_uri("POST", SAP_URL, text=sap_fields_callback(3, requested))
+
+    list(sap_cached_req("T001W", "WERKS", "", None))
+    list(sap_cached_req("T001W", "WERKS", "", None))
+
+    assert len(requested) == 2
+
+
+def test_iter_sap_rows_in(aws_credentials, s3_data_bucket, secrets_manager, requests_mock):
+    """Keys are pushed down to SAP PI as IN-lists, in batches read concurrently and in order"""
+    import re
+    from get_data.helper_get import iter_sap_rows_in, get_in_where_field
+    from get_data.tests.data import get_where_field
+
+    def callback(request, context):
+        keys = re.findall(r"'(K\d+)'", get_where_field(request))
+        context.status_code = 200
+        return get_sap_response(["KEY"], [[key] for key in keys])
+
+    requests_mock.register_uri("POST", SAP_URL, text=callback)
+    keys = [f"K{i:03}" for i in range(25)]
+
+    where = "ADDR_GROUP EQ 'CA01'"
+    rows = iter_sap_rows_in(
+        "ADRC", "KEY", where, None, "KEY", reversed(keys), max_workers=3, batch_size=10
+    )
+
+    assert [row["KEY"] for row in rows] == keys
+    assert requests_mock.call_count == 3
+
+    # too many keys for IN-lists, the table is read without them and filtered
+    requests_mock.register_uri(
+        "POST", SAP_URL, text=get_sap_response(["KEY"], [["K000"], ["K001"], ["X"]])
+    )
+    rows = iter_sap_rows_in("ADRC", "KEY", where, {"KEY": "id"}, "KEY", keys, max_keys=10)
+    assert list(rows) == [{"id": "K000"}, {"id": "K001"}]
+    assert get_in_where_field("", "KEY", ["O'NEIL"]) == "KEY IN ( 'O''NEIL' )"
@@ -0,0 +1,113 @@
+import pytest
+
+sites = [{"WERKS": "0009"}, {"WERKS": "0014"}, {"WERKS": "0023"}]
+
+buildings = [
+    {"id": "000901", "name": "October 6 Plant"},
+    {"id": "001400", "name": "Rio de Janeiro Plant"},
+    {"id": "000000", "name": "Beijing Innovation Ctr-Tianzhu"},
+]
+
+
+def test_key_field():
+    """Key on a whole field or a prefix of it"""
+    from get_data.helper_join import key_field
+
+    assert key_field("id")(buildings[0]) == "000901"
+    assert key_field("id", 4)(buildings[0]) == "0009"
+
+
+def test_build_index():
+    """Index rows by key, optionally keeping only some of the fields"""
+    from get_data.helper_join import build_index, key_field
+
+    index = build_index(buildings, key_field("id", 4))
+    assert index["0014"] is buildings[1]
+
+    index = build_index(buildings, key_field("id"), lambda row: row["name"])
+    assert index == {
+        "000901": "October 6 Plant",
+        "001400": "Rio de Janeiro Plant",
+        "000000": "Beijing Innovation Ctr-Tianzhu",
+    }
+
+    # a later row with the same key replaces the earlier one
+    assert build_index([{"id": "1", "v": "a"}, {"id": "1", "v": "b"}], key_field("id")) == {
+        "1": {"id": "1", "v": "b"}
+    }
+
+
+def test_build_keys():
+    """Keys for a semi-join from rows or from a list of keys"""
+    from get_data.helper_join import build_keys, key_field
+
+    assert build_keys(sites, key_field("WERKS")) == {"0009", "0014", "0023"}
+    assert build_keys(["0009", "0014"]) == {"0009", "0014"}
+
+
+def test_semi_join():
+    """Only keep rows with a key in the other table, report the rest as unmatched"""
+    from get_data.helper_join import build_keys, key_field, semi_join
+
+    unmatched = []
+    keys = build_keys(sites, key_field("WERKS"))
+    results = list(semi_join(iter(buildings), keys, key_field("id", 4), unmatched))
+
+    assert results == buildings[:2]
+    assert unmatched == [buildings[2]]
+
+
+def test_inner_join():
+    """Merge rows with their match in the index and drop the rest"""
+    from get_data.helper_join import build_index, inner_join, key_field
+
+    unmatched = []
+    index = build_index(sites, key_field("WERKS"))
+    results = list(
+        inner_join(
+            buildings,
+            index,
+            key_field("id", 4),
+            lambda row, match: {**row, "parentid": match["WERKS"]},
+            unmatched,
+        )
+    )
+
+    assert results == [
+        {"id": "000901", "name": "October 6 Plant", "parentid": "0009"},
+        {"id": "001400", "name": "Rio de Janeiro Plant", "parentid": "0014"},
+    ]
+    assert unmatched == [buildings[2]]
+
+
+def test_left_join():
+    """Merge every row, match is None when it's not in the index"""
+    from get_data.helper_join import build_index, key_field, left_join
+
+    unmatched = []
+    index = build_index(sites, key_field("WERKS"))
+    results = list(
+        left_join(
+            buildings,
+            index,
+            key_field("id", 4),
+            lambda row, match: {**row, "parentid": match["WERKS"] if match else ""},
+            unmatched,
+        )
+    )
+
+    assert [row["parentid"] for row in results] == ["0009", "0014", ""]
+    assert unmatched == [buildings[2]]
+
+
+def test_join_is_lazy():
+    """Joins are generators, so the larger table can be streamed through them"""
+    from get_data.helper_join import key_field, semi_join
+
+    def rows():
+        yield buildings[0]
+        raise Exception("should not be read")
+
+    results = semi_join(rows(), {"0009"}, key_field("id", 4))
+
+    assert next(results) == buildings[0]
@@ -0,0 +1,105 @@
+import pytest
+import json
+import sqlite3
+
+# SQLite stands in for the RDS, json_object returns the same one JSON object per row
+query = """SELECT json_object('ID', id, 'ParentID', parent_id, 'Name', name) JSON
+FROM hierarchy
+ORDER BY id;
+"""
+
+# the Oracle default uses ORA_HASH and JSON_VALUE
+sqlite_partition_sql = (
+    "SELECT JSON FROM ({query}) WHERE json_extract(JSON, '$.ID') % :partitions = :partition"
+)
+
+
+@pytest.fixture(scope="function")
+def rds(tmp_path):
+    """SQLite database with a hierarchy table, returns its connect function and query path"""
+    db_path = tmp_path / "rds.db"
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE hierarchy (id INTEGER, parent_id INTEGER, name TEXT)")
+    conn.executemany(
+        "INSERT INTO hierarchy VALUES (?, ?, ?)",
+        [(i, i // 10 or None, f"Node {i}") for i in range(1, 1001)],
+    )
+    conn.commit()
+    conn.close()
+
+    query_path = tmp_path / "rds_test.sql"
+    query_path.write_text(query)
+
+    connections = []
+
+    def connect():
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        connections.append(conn)
+        return conn
+
+    connect.connections = connections
+    return connect, str(query_path)
+
+
+def read_rows(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_get_rds(rds, tmp_path):
+    """Rows are fetched in batches and written one JSON object per line, nulls as empty strings"""
+    from get_data.helper_rds import get_rds
+
+    connect, query_path = rds
+    output_path = tmp_path / "output.json"
+
+    assert get_rds(query_path, output_path, connect, arraysize=64) == 1000
+
+    rows = read_rows(output_path)
+    assert [row["ID"] for row in rows] == list(range(1, 1001))
+    assert rows[0] == {"ID": 1, "ParentID": "", "Name": "Node 1"}
+    assert rows[-1] == {"ID": 1000, "ParentID": 100, "Name": "Node 1000"}
+    assert len(connect.connections) == 1
+
+
+@pytest.mark.parametrize("partitions", [2, 3])
+def test_get_rds_partitions(rds, tmp_path, partitions):
+    """Each partition is read on its own connection and written in partition order"""
+    from get_data.helper_rds import get_rds
+
+    connect, query_path = rds
+    output_path = tmp_path / "output.json"
+
+    count = get_rds(
+        query_path,
+        output_path,
+        connect,
+        arraysize=64,
+        partitions=partitions,
+        partition_sql=sqlite_partition_sql,
+    )
+
+    assert count == 1000
+    ids = [row["ID"] for row in read_rows(output_path)]
+    assert ids == sorted(range(1, 1001), key=lambda i: (i % partitions, i))
+    assert len(connect.connections) == partitions
+    assert list(tmp_path.glob("output.json.*")) == []
+
+
+def test_get_rds_error(rds, tmp_path):
+    """A failing partition is raised and its part files are removed"""
+    from get_data.helper_rds import get_rds
+
+    connect, query_path = rds
+    output_path = tmp_path / "output.json"
+
+    with pytest.raises(sqlite3.OperationalError):
+        get_rds(
+            query_path,
+            output_path,
+            connect,
+            partitions=2,
+            partition_sql="SELECT JSON FROM ({query}) WHERE unknown_column = :partition",
+        )
+
+    assert list(tmp_path.glob("output.json.*")) == []
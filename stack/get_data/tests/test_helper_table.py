@@ -0,0 +1,70 @@
+import pytest
+import json
+
+
+def test_row():
+    """Rows behave like dicts and share their table's header"""
+    from get_data.helper_table import Row, get_header
+
+    header = get_header(["ID", "Name"])
+    row = Row(header, ("0009", "October 6 Plant"))
+    other = Row(get_header(["ID", "Name"]), ("0014", "Rio de Janeiro Plant"))
+
+    assert row == {"ID": "0009", "Name": "October 6 Plant"}
+    assert dict(row) == {"ID": "0009", "Name": "October 6 Plant"}
+    assert {**row, "parentid": "0009"}["parentid"] == "0009"
+    assert row["ID"] == "0009"
+    assert row.get("missing", "") == ""
+    assert "Name" in row and "missing" not in row
+    assert list(row.items()) == [("ID", "0009"), ("Name", "October 6 Plant")]
+    assert len(row) == 2
+    assert row._header is other._header
+
+    with pytest.raises(KeyError):
+        row["missing"]
+
+
+def test_row_changes():
+    """Rows changed the same way move to the same derived header"""
+    from get_data.helper_table import Row, get_header
+
+    header = get_header(["id", "currencycode"])
+    rows = [Row(header, (str(i), "USD")) for i in range(3)]
+
+    for row in rows:
+        row["Location_Type_ID"] = "B"
+        row["id"] = row["id"].zfill(4)
+        assert row.pop("currencycode") == "USD"
+
+    assert rows[0] == {"id": "0000", "Location_Type_ID": "B"}
+    assert rows[0]._header is rows[2]._header
+    assert rows[0]._header is not header
+
+
+def test_select():
+    """Only keep some of the fields of a row"""
+    from get_data.helper_table import Row, get_header, select
+
+    row = Row(get_header(["join_field", "City", "Region"]), ("1", "CITY", "REGION"))
+
+    assert select(row, ("City", "Region")) == {"City": "CITY", "Region": "REGION"}
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ("0009", "October 6 Plant"),
+        ("", 'quote " and backslash \\'),
+        ("São Paulo", "北京"),
+        (None, 1),
+    ],
+)
+def test_row_json(values):
+    """Rows are formatted exactly the same as json.dumps of the same dict"""
+    from get_data.helper_table import Row, get_header, row_json
+
+    row = Row(get_header(["ID", "Name"]), values)
+    expected = json.dumps(dict(row), separators=(",", ":"))
+
+    assert row_json(row) == expected
+    assert row_json(dict(row)) == expected
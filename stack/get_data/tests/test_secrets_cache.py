@@ -0,0 +1,72 @@
+import pytest
+import json
+from mock import Mock, patch
+
+
+def test_get_secrets_cached(aws_credentials, secrets_manager):
+    """Secrets are fetched once and then served from memory until the TTL has passed"""
+    from lambda_common.secrets_cache import get_secrets
+
+    secrets = get_secrets()
+    assert secrets["sap_host"] == "sap.host.com"
+
+    with patch("lambda_common.secrets_cache.boto3") as boto:
+        assert get_secrets() is secrets
+        boto.client.assert_not_called()
+
+
+def test_get_secrets_version_unchanged(aws_credentials, secrets_manager):
+    """After the TTL only the version is checked, the value is kept if it has not changed"""
+    from lambda_common.secrets_cache import SecretsCache
+
+    cache = SecretsCache(ttl=0)
+    secrets = cache.get()
+
+    with patch.object(secrets_manager, "get_secret_value") as get_secret_value:
+        with patch("lambda_common.secrets_cache.boto3.client", return_value=secrets_manager):
+            assert cache.get() is secrets
+        get_secret_value.assert_not_called()
+
+
+def test_get_secrets_version_changed(aws_credentials, secrets_manager):
+    """A new version of the secret is fetched and the derived objects are rebuilt"""
+    from lambda_common.secrets_cache import SecretsCache
+
+    cache = SecretsCache(ttl=0)
+    client = cache.derive("client", lambda secrets: {"host": secrets["sap_host"]})
+    assert cache.derive("client", lambda secrets: {}) is client
+
+    secrets_manager.put_secret_value(
+        SecretId="mysupersecret", SecretString=json.dumps({"sap_host": "new.host.com"})
+    )
+
+    assert cache.get() == {"sap_host": "new.host.com"}
+    assert cache.derive("client", lambda secrets: {"host": secrets["sap_host"]}) == {
+        "host": "new.host.com"
+    }
+
+
+def test_invalidate_secrets(aws_credentials, secrets_manager):
+    """Invalidating the cache fetches the secrets again and rebuilds the derived objects"""
+    from lambda_common.secrets_cache import secrets_cache, invalidate_secrets
+
+    client = secrets_cache.derive("client", lambda secrets: object())
+    invalidate_secrets()
+
+    assert secrets_cache.secrets is None
+    assert secrets_cache.derive("client", lambda secrets: object()) is not client
+
+
+def test_get_secrets_version_changed_close(aws_credentials, secrets_manager):
+    """Derived objects are closed when the secret has a new version"""
+    from lambda_common.secrets_cache import SecretsCache
+
+    cache = SecretsCache(ttl=0)
+    client = cache.derive("client", lambda secrets: Mock())
+
+    secrets_manager.put_secret_value(
+        SecretId="mysupersecret", SecretString=json.dumps({"sap_host": "new.host.com"})
+    )
+    cache.get()
+
+    client.close.assert_called_once()
@@ -0,0 +1,67 @@
+"""
+Manifest of a snapshot written to the data bucket, stored as S3 metadata on the object so it
+is copied along with it (new_run/ -> prev_run/, backups). A manifest next to the object would
+be read by Athena as rows of the table and start a step function.
+
+The manifest describes the rows one JSON object per line, before any compression, so it is the
+same whichever output format the object was written in.
+"""
+import hashlib
+
+import botocore
+
+# S3 metadata keys of the manifest
+CONTENT_HASH_METADATA = "content-sha256"
+ROW_COUNT_METADATA = "row-count"
+BYTE_SIZE_METADATA = "content-bytes"
+COLUMNS_METADATA = "columns"
+
+
+class Manifest:
+    """row count, byte size, content hash and columns of rows as they are written"""
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.content_hash = hashlib.sha256()
+        self.columns = None
+
+    def update(self, data):
+        """add lines of JSON rows, each ending with a newline"""
+        self.content_hash.update(data)
+        self.size += len(data)
+        self.count += data.count(b"\n")
+
+    def add_columns(self, row):
+        """the columns are the keys of the first row"""
+        if self.columns is None:
+            self.columns = list(row)
+
+    def metadata(self):
+        """S3 metadata of the manifest, every value a string"""
+        return {
+            CONTENT_HASH_METADATA: self.content_hash.hexdigest(),
+            ROW_COUNT_METADATA: str(self.count),
+            BYTE_SIZE_METADATA: str(self.size),
+            COLUMNS_METADATA: ",".join(self.columns or []),
+        }
+
+
+def read_manifest(client, bucket, key):
+    """manifest of an object as a dict, None when there is no object or it has no manifest"""
+    try:
+        response = client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError:
+        return None
+
+    metadata = response.get("Metadata", {})
+    if ROW_COUNT_METADATA not in metadata:
+        return None
+
+    columns = metadata.get(COLUMNS_METADATA, "")
+    return {
+        "count": int(metadata[ROW_COUNT_METADATA]),
+        "size": int(metadata.get(BYTE_SIZE_METADATA, 0)),
+        "content_hash": metadata.get(CONTENT_HASH_METADATA),
+        "columns": columns.split(",") if columns else [],
+    }
@@ -0,0 +1,49 @@
+"""
+Uploads to the data bucket from file objects, shared by the get_data and process_deltas
+functions. Nothing has to be written to /tmp first: the source can be an open file, an
+in-memory buffer or a reader over a generator. Anything larger than S3_PART_SIZE is uploaded
+as a multipart upload, S3_MAX_CONCURRENCY parts at a time.
+"""
+import os
+from boto3.s3.transfer import TransferConfig
+
+# bytes per part of a multipart upload, S3 allows at most 10,000 parts per object
+S3_PART_SIZE = int(os.environ.get("S3_PART_SIZE", 16 * 1024 * 1024))
+
+# parts uploaded at the same time, each holds a part in memory while it is sent
+S3_MAX_CONCURRENCY = int(os.environ.get("S3_MAX_CONCURRENCY", 8))
+
+transfer_config = TransferConfig(
+    multipart_threshold=S3_PART_SIZE,
+    multipart_chunksize=S3_PART_SIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+# every object in the data bucket is encrypted and private
+UPLOAD_ARGS = {"ServerSideEncryption": "AES256", "ACL": "private"}
+
+
+def upload_fileobj(client, fileobj, bucket, key, metadata=None):
+    """upload everything read from fileobj to bucket/key"""
+    extra_args = dict(UPLOAD_ARGS)
+    if metadata:
+        extra_args["Metadata"] = metadata
+
+    client.upload_fileobj(
+        Fileobj=fileobj, Bucket=bucket, Key=key, ExtraArgs=extra_args, Config=transfer_config
+    )
+
+
+def copy_object(client, bucket, source_key, key, metadata=None):
+    """copy within the bucket, a multipart copy for large objects, replacing the metadata if given"""
+    extra_args = dict(UPLOAD_ARGS)
+    if metadata is not None:
+        extra_args.update(Metadata=metadata, MetadataDirective="REPLACE")
+
+    client.copy(
+        CopySource={"Bucket": bucket, "Key": source_key},
+        Bucket=bucket,
+        Key=key,
+        ExtraArgs=extra_args,
+        Config=transfer_config,
+    )
@@ -0,0 +1,105 @@
+"""
+Secrets cached for the life of a Lambda container, shared by the get_data and process_deltas
+functions. Within SECRETS_TTL seconds the secrets come from memory. Once the TTL has passed
+only the secret's metadata is checked. The value is fetched again only if its AWSCURRENT
+VersionId has changed.
+
+Objects built from the secrets (e.g. the SAP PI client with its SSL context) can be cached
+with derive(). They are closed and rebuilt once the secrets change. Call invalidate_secrets() on a
+TLS/auth failure so the next call fetches the secrets again, e.g. after a rotation.
+"""
+import os
+import json
+import time
+import threading
+import boto3
+
+try:
+    from shared.helper import get_secrets as get_secrets_uncached, logger
+except ModuleNotFoundError:
+    import sys
+
+    sys.path.append("../")
+    from shared.helper import get_secrets as get_secrets_uncached, logger
+
+# seconds before Secrets Manager is asked whether there is a new version of the secret
+SECRETS_TTL = int(os.environ.get("SECRETS_TTL", 900))
+
+
+class SecretsCache:
+    """secrets and the objects derived from them, refreshed when the secret's VersionId changes"""
+
+    def __init__(self, ttl=SECRETS_TTL):
+        self.ttl = ttl
+        # derive() calls get() while holding the lock
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        """forget the secrets and everything derived from them"""
+        with self.lock:
+            self.secrets = None
+            self.version_id = None
+            self.checked_at = None
+            self.clear_derived()
+
+    def clear_derived(self):
+        """close the derived objects that can be closed, e.g. the connections of a client"""
+        derived = getattr(self, "derived", {})
+        self.derived = {}
+        for value in derived.values():
+            if hasattr(value, "close"):
+                value.close()
+
+    def get(self):
+        """returns the secrets, only calling Secrets Manager once the TTL has passed"""
+        with self.lock:
+            if self.secrets is not None and time.monotonic() - self.checked_at < self.ttl:
+                return self.secrets
+
+            client = boto3.client("secretsmanager")
+            secret_id = os.environ["SECRETS"]
+
+            if self.secrets is None or get_current_version(client, secret_id) != self.version_id:
+                logger.info("Fetching secrets")
+                response = client.get_secret_value(SecretId=secret_id)
+                self.secrets = json.loads(response["SecretString"])
+                self.version_id = response["VersionId"]
+                self.clear_derived()
+
+            self.checked_at = time.monotonic()
+            return self.secrets
+
+    def derive(self, name, create):
+        """returns create(secrets), cached under name until the secrets change"""
+        with self.lock:
+            secrets = self.get()
+            if name not in self.derived:
+                self.derived[name] = create(secrets)
+            return self.derived[name]
+
+
+def get_current_version(client, secret_id):
+    """VersionId of the AWSCURRENT version, describe_secret does not return the secret value"""
+    response = client.describe_secret(SecretId=secret_id)
+    for version_id, stages in response.get("VersionIdsToStages", {}).items():
+        if "AWSCURRENT" in stages:
+            return version_id
+    return None
+
+
+# one cache per Lambda container
+secrets_cache = SecretsCache()
+
+
+def get_secrets(local=False):
+    """cached drop in for shared.helper.get_secrets"""
+    if local:
+        return get_secrets_uncached(local)
+    return secrets_cache.get()
+
+
+def invalidate_secrets():
+    """call on a TLS/auth failure, the next get_secrets fetches the secrets again"""
+    logger.info("Invalidating cached secrets")
+    secrets_cache.invalidate()
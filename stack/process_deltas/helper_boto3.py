@@ -1,8 +1,11 @@
+import hashlib
 import json
 import os
+import re
 import time
 
 import boto3
+import botocore
 
 from shared.helper import logger
 
@@ -19,48 +22,339 @@ ATHENA_MAX_RESULTS_SZ = 1000  # Max query result for Named Queries
 ATHENA_MAX_QUERY_SZ = 50  # Max rows that can be queried from a Table
 HTTP_STATUS_OK = 200
 
+# seconds between checks of a running Athena query, doubling from the first to the cap
+ATHENA_POLL_FIRST = float(os.environ.get("ATHENA_POLL_FIRST", 0.2))
+ATHENA_POLL_CAP = float(os.environ.get("ATHENA_POLL_CAP", 5))
 
-def fetchall_athena(client, query_string, workgroup, db_name, s3_output):
+# read query results from the CSV Athena writes to the output location, rather than paging
+# through get_query_results ATHENA_MAX_QUERY_SZ rows at a time
+ATHENA_READ_CSV = os.environ.get("ATHENA_READ_CSV", "true").lower() == "true"
+
+# QueryExecutionIds a single batch_get_query_execution can poll
+ATHENA_MAX_BATCH = 50
+
+# reuse the results of an identical query over the same input files, e.g. on a retry
+ATHENA_CACHE = os.environ.get("ATHENA_CACHE", "true").lower() == "true"
+
+# hierarchies whose new_run/ and prev_run/ files are the inputs of the Athena tables
+ATHENA_INPUT_HIERARCHIES = [
+    "onezeroone",
+    "companycode",
+    "ninetwosix",
+    "costcenter",
+    "ninetwoone",
+    "site",
+    "building",
+]
+
+# one field of an Athena result CSV, values are quoted and NULL is an empty unquoted field
+CSV_FIELD = re.compile(r'"((?:[^"]|"")*)"|([^,]*)')
+
+
+def fetchall_athena(client, query_string, workgroup, db_name, s3_output, stats=None):
     """
     Run a SQL query in Athena and paginate results to return a list of dicts
     https://gist.github.com/schledererj/b2e2a800998d61af2bbdd1cd50e08b76
+
+    stats, if given, is filled with the queue, execution and wait times of the query
+
+    With ATHENA_CACHE, the results of an earlier execution of the same query are returned when
+    none of the input files have changed since, without starting a new execution
+    """
+    inputs = get_input_etags() if ATHENA_CACHE else None
+    cache_key = get_cache_key(query_string, workgroup, db_name, inputs)
+    query_id, query = read_cached_query(client, s3_output, cache_key)
+
+    if query is not None:
+        logger.info(f"Reusing the results of Athena query {query_id}, its inputs haven't changed")
+        if stats is not None:
+            stats.update(get_query_stats(query, 0), reused=True)
+    else:
+        query_id = start_query(client, query_string, workgroup, db_name, s3_output)
+
+        # poll the query and get its results as soon as it completes
+        query = wait_for_query(client, query_id, stats)
+        if cache_key:
+            write_cached_query(s3_output, cache_key, query_id)
+
+    return query_id, read_results(client, query_id, query)
+
+
+def fetchall_athena_concurrent(
+    client,
+    queries,
+    workgroup,
+    db_name,
+    s3_output,
+    stats=None,
+    first=ATHENA_POLL_FIRST,
+    cap=ATHENA_POLL_CAP,
+):
     """
+    Run several SQL queries in Athena at the same time, queries is a dict of name: query string.
+    Yields the name, QueryExecutionId and results of each query as soon as it completes, so the
+    wall time is that of the slowest query. All running queries are polled with a single
+    batch_get_query_execution, backing off the same as wait_for_query
 
-    # start execution of query in given db and workgroup
-    query_id = client.start_query_execution(
+    stats, if given, is filled with the stats of each query by name
+    """
+    if len(queries) > ATHENA_MAX_BATCH:
+        raise Exception(f"At most {ATHENA_MAX_BATCH} queries can be run at the same time")
+
+    # the input files are only listed once for all the queries
+    inputs = get_input_etags() if ATHENA_CACHE else None
+
+    running = {}
+    for name, query_string in queries.items():
+        cache_key = get_cache_key(query_string, workgroup, db_name, inputs)
+        query_id, query = read_cached_query(client, s3_output, cache_key)
+        if query is not None:
+            logger.info(f"Reusing the results of Athena query {query_id} for {name}")
+            if stats is not None:
+                stats[name] = dict(get_query_stats(query, 0), reused=True)
+            yield name, query_id, read_results(client, query_id, query)
+            continue
+
+        query_id = start_query(client, query_string, workgroup, db_name, s3_output)
+        running[query_id] = (name, cache_key)
+
+    start = time.monotonic()
+    delay = first
+    while running:
+        response = client.batch_get_query_execution(QueryExecutionIds=list(running))
+        for query in response["QueryExecutions"]:
+            query_id = query["QueryExecutionId"]
+            query_status = query["Status"]["State"]
+            if query_status == "FAILED" or query_status == "CANCELLED":
+                raise Exception(query["Status"]["StateChangeReason"])
+            if query_status != "SUCCEEDED":
+                continue
+
+            name, cache_key = running.pop(query_id)
+            query_stats = get_query_stats(query, time.monotonic() - start)
+            logger.info(f"Athena query {query_id} for {name}: {query_stats}")
+            if stats is not None:
+                stats[name] = query_stats
+            if cache_key:
+                write_cached_query(s3_output, cache_key, query_id)
+            yield name, query_id, read_results(client, query_id, query)
+
+        if running:
+            time.sleep(delay)
+            delay = min(delay * 2, cap)
+
+
+def start_query(client, query_string, workgroup, db_name, s3_output):
+    """start execution of query in given db and workgroup, returns its QueryExecutionId"""
+    return client.start_query_execution(
         QueryString=query_string,
         QueryExecutionContext={"Database": f"{db_name}"},
         ResultConfiguration={"OutputLocation": f"{s3_output}"},
         WorkGroup=workgroup,
     )["QueryExecutionId"]
 
-    # poll the query and get paginated results once it completes
-    query_status = None
-    while query_status == "QUEUED" or query_status == "RUNNING" or query_status is None:
-        query = client.get_query_execution(QueryExecutionId=query_id)["QueryExecution"]
-        query_status = query["Status"]["State"]
-        if query_status == "FAILED" or query_status == "CANCELLED":
-            # logger.error(query)
-            raise Exception(query["Status"]["StateChangeReason"])
-        time.sleep(10)
-    results_paginator = client.get_paginator("get_query_results")
-    results_iter = results_paginator.paginate(
-        QueryExecutionId=query_id, PaginationConfig={"PageSize": ATHENA_MAX_QUERY_SZ}
-    )
+
+def read_results(client, query_id, query):
+    """results of a query that succeeded as a list of dicts"""
+    rows = None
+    if ATHENA_READ_CSV:
+        rows = read_result_csv(query)
+    if rows is None:
+        rows = get_query_results(client, query_id)
 
     # converts results into an array of dicts - since Lambdas pass data as JSON
     results = []
     column_names = None
 
+    for column_values in rows:
+        if not column_names:
+            column_names = column_values
+        else:
+            results.append(dict(zip(column_names, column_values)))
+
+    return results
+
+
+def get_input_etags():
+    """
+    key and ETag of every input file of the Athena tables, None when they can't be listed.
+    a new upload to any new_run/ or prev_run/ prefix changes them
+    """
+    bucket = os.environ.get("BUCKET")
+    if not bucket:
+        return None
+
+    prefixes = [os.environ.get("COSTCENTER_REDUCED")]
+    for hierarchy in ATHENA_INPUT_HIERARCHIES:
+        for run in ["NEW", "OLD"]:
+            prefixes.append(os.environ.get(f"{hierarchy.upper()}_{run}"))
+
+    inputs = ""
+    s3_client = boto3.client("s3")
+    paginator = s3_client.get_paginator("list_objects_v2")
+    try:
+        for prefix in sorted(filter(None, set(prefixes))):
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for item in page.get("Contents", []):
+                    inputs += f"|{item['Key']}:{item['ETag']}"
+    except botocore.exceptions.ClientError as e:
+        logger.warning(f"Could not list the inputs of the query, not reusing results: {e}")
+        return None
+
+    return inputs
+
+
+def get_cache_key(query_string, workgroup, db_name, inputs):
+    """hash of the query and the ETags of its inputs, None when the inputs aren't known"""
+    if inputs is None:
+        return None
+    return hashlib.sha256(f"{workgroup}|{db_name}|{query_string}{inputs}".encode()).hexdigest()
+
+
+def get_cache_location(s3_output, cache_key):
+    """bucket and key of the cached query id, kept next to the query results"""
+    bucket, _, prefix = s3_output[len("s3://") :].partition("/")
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return bucket, f"{prefix}query_cache/{cache_key}.json"
+
+
+def read_cached_query(client, s3_output, cache_key):
+    """id and QueryExecution of the cached query, None when there is none or it didn't succeed"""
+    if not cache_key:
+        return None, None
+
+    bucket, key = get_cache_location(s3_output, cache_key)
+    try:
+        response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+        query_id = json.loads(response["Body"].read())["QueryExecutionId"]
+        query = client.get_query_execution(QueryExecutionId=query_id)["QueryExecution"]
+    except botocore.exceptions.ClientError:
+        return None, None
+
+    if query["Status"]["State"] != "SUCCEEDED":
+        return None, None
+    return query_id, query
+
+
+def write_cached_query(s3_output, cache_key, query_id):
+    """remember the query id for the cache key, the query still succeeded without it"""
+    bucket, key = get_cache_location(s3_output, cache_key)
+    try:
+        boto3.client("s3").put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps({"QueryExecutionId": query_id}).encode(),
+            ServerSideEncryption="AES256",
+        )
+    except botocore.exceptions.ClientError as e:
+        logger.warning(f"Could not cache Athena query {query_id}: {e}")
+
+
+def get_query_results(client, query_id):
+    """yields the rows of a query's results as lists of values, the column names first"""
+    results_paginator = client.get_paginator("get_query_results")
+    results_iter = results_paginator.paginate(
+        QueryExecutionId=query_id, PaginationConfig={"PageSize": ATHENA_MAX_QUERY_SZ}
+    )
     for results_page in results_iter:
         for row in results_page["ResultSet"]["Rows"]:
-            column_values = [col.get("VarCharValue", None) for col in row["Data"]]
-            if not column_names:
-                column_names = column_values
-            else:
-                results.append(dict(zip(column_names, column_values)))
+            yield [col.get("VarCharValue", None) for col in row["Data"]]
+
 
-    return query_id, results
+def read_result_csv(query):
+    """
+    rows of the CSV a query wrote to its output location, read in a single streamed GET, with the
+    column names first the same as get_query_results. None when there is no CSV to read
+    """
+    output_location = query.get("ResultConfiguration", {}).get("OutputLocation", "")
+    if not output_location.startswith("s3://") or not output_location.endswith(".csv"):
+        return None
+
+    bucket, _, key = output_location[len("s3://") :].partition("/")
+    try:
+        response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        logger.warning(f"Could not read {output_location}, using get_query_results: {e}")
+        return None
+
+    records = iter_csv_records(response["Body"].iter_chunks())
+    return (parse_csv_record(record) for record in records)
+
+
+def iter_csv_records(chunks):
+    """yields the records of a CSV, a quoted value can span several lines"""
+    buffer = b""
+    record = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            record += line.decode("utf-8")
+            if record.count('"') % 2:
+                # the newline is inside a quoted value
+                record += "\n"
+                continue
+            yield record
+            record = ""
+
+    record += buffer.decode("utf-8")
+    if record:
+        yield record
+
+
+def parse_csv_record(record):
+    """values of a CSV record, None for NULL (an empty unquoted field) like get_query_results"""
+    values = []
+    pos = 0
+    while True:
+        quoted, unquoted = CSV_FIELD.match(record, pos).groups()
+        if quoted is not None:
+            values.append(quoted.replace('""', '"'))
+            pos += len(quoted) + 2
+        else:
+            values.append(unquoted or None)
+            pos += len(unquoted)
+
+        if pos >= len(record):
+            return values
+        # skip the comma
+        pos += 1
+
+
+def wait_for_query(client, query_id, stats=None, first=ATHENA_POLL_FIRST, cap=ATHENA_POLL_CAP):
+    """
+    Poll an Athena query until it succeeds, starting with short waits for quick queries and
+    backing off exponentially up to cap seconds for long ones. Returns the QueryExecution
+    """
+    start = time.monotonic()
+    delay = first
+    while True:
+        query = client.get_query_execution(QueryExecutionId=query_id)["QueryExecution"]
+        query_status = query["Status"]["State"]
+        if query_status == "SUCCEEDED":
+            break
+        if query_status == "FAILED" or query_status == "CANCELLED":
+            raise Exception(query["Status"]["StateChangeReason"])
+        time.sleep(delay)
+        delay = min(delay * 2, cap)
+
+    query_stats = get_query_stats(query, time.monotonic() - start)
+    logger.info(f"Athena query {query_id}: {query_stats}")
+    if stats is not None:
+        stats.update(query_stats)
+    return query
+
+
+def get_query_stats(query, waited):
+    """queue and execution times in seconds reported by Athena, and how long we polled for"""
+    statistics = query.get("Statistics", {})
+    return {
+        "queue_seconds": statistics.get("QueryQueueTimeInMillis", 0) / 1000,
+        "execution_seconds": statistics.get("EngineExecutionTimeInMillis", 0) / 1000,
+        "total_seconds": statistics.get("TotalExecutionTimeInMillis", 0) / 1000,
+        "waited_seconds": round(waited, 3),
+    }
 
 
 def get_record_count(athena, athena_wg, athena_db, s3_output, table):
@@ -68,11 +362,21 @@ def get_record_count(athena, athena_wg, athena_db, s3_output, table):
 
     # reduced_count_query = "SELECT COUNT(ID) FROM costcenter_new_run WHERE companycode IN (SELECT id FROM companycode_prev_run)"
     logger.info("Getting count of reduced cost centers")
-    count_query = f"SELECT count(id) FROM {table}"
+    count_query = get_count_query(table)
 
     query_id, count_results = fetchall_athena(athena, count_query, athena_wg, athena_db, s3_output)
     logger.info(f"Query ID: {query_id}")
 
+    return get_count(count_results)
+
+
+def get_count_query(table):
+    """query for the count of the records in an Athena table"""
+    return f"SELECT count(id) FROM {table}"
+
+
+def get_count(count_results):
+    """the count from the results of get_count_query"""
     return int(count_results[0]["_col0"])
 
 
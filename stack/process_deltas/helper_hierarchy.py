@@ -0,0 +1,94 @@
+"""
+Parent/child index of the delta rows of a hierarchy (101, 921, 926), with a topological level
+for each node. Parents are always on a lower level than their children, so every node of a
+level can be sent to Workday at the same time, waiting only between levels.
+
+A node is on level 0 when it has no parent, is its own parent, or its parent isn't one of the
+deltas (an orphan of the deltas, its parent should already be in Workday). Nodes on a cycle,
+and the nodes below them, can't be given a level and are reported instead.
+"""
+from collections import deque
+
+
+class Hierarchy:
+    """index of rows by id and parent id, and the level of each row"""
+
+    def __init__(self, rows, id_key="id", parent_key="parentid"):
+        self.rows = {}
+        self.parents = {}
+        for row in rows:
+            self.rows[row[id_key]] = row
+            parent = row.get(parent_key)
+            self.parents[row[id_key]] = None if parent == "" else parent
+
+        self.children = {}
+        self.roots = []
+        self.orphans = []
+        for node, parent in self.parents.items():
+            if parent is None or parent == node:
+                self.roots.append(node)
+            elif parent not in self.rows:
+                self.orphans.append(node)
+            else:
+                self.children.setdefault(parent, []).append(node)
+
+        self.level = self.get_levels()
+        self.cycles = self.get_cycles()
+
+    def get_levels(self):
+        """level of every node reachable from the roots and orphans, breadth first"""
+        level = {}
+        queue = deque()
+        for node in self.roots + self.orphans:
+            level[node] = 0
+            queue.append(node)
+
+        while queue:
+            node = queue.popleft()
+            for child in self.children.get(node, []):
+                level[child] = level[node] + 1
+                queue.append(child)
+
+        return level
+
+    def get_cycles(self):
+        """the cycles among the nodes without a level, each a list of ids"""
+        cycles = []
+        visited = set(self.level)
+        for start in self.rows:
+            # every node has one parent, so following parents ends in a level or a cycle
+            path = []
+            on_path = {}
+            node = start
+            while node not in visited:
+                visited.add(node)
+                on_path[node] = len(path)
+                path.append(node)
+                node = self.parents[node]
+
+            if node in on_path:
+                cycles.append(path[on_path[node] :])
+
+        return cycles
+
+    @property
+    def unreachable(self):
+        """ids that have no level, on a cycle or below one"""
+        return [node for node in self.rows if node not in self.level]
+
+    def levels(self):
+        """rows grouped by level, level 0 first, in the order they were given within a level"""
+        grouped = [[] for _ in range(max(self.level.values(), default=-1) + 1)]
+        for node, row in self.rows.items():
+            if node in self.level:
+                grouped[self.level[node]].append(row)
+        return grouped
+
+
+def order_by_level(rows):
+    """rows with parents ahead of their children, rows without a level last, and the Hierarchy"""
+    hierarchy = Hierarchy(rows)
+    last = len(hierarchy.rows)
+    # a stable sort, so rows keep the order they were given within a level
+    ordered = sorted(rows, key=lambda row: hierarchy.level.get(row["id"], last))
+    return ordered, hierarchy
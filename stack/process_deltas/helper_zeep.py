@@ -27,12 +27,14 @@ from requests.packages.urllib3.poolmanager import PoolManager
 from requests.packages.urllib3.util import ssl_
 
 try:
-    from shared.helper import get_secrets, logger
+    from shared.helper import logger
+    from lambda_common.secrets_cache import get_secrets, invalidate_secrets
 except ModuleNotFoundError:
     import sys
 
     sys.path.append("../")
-    from shared.helper import get_secrets, logger
+    from shared.helper import logger
+    from lambda_common.secrets_cache import get_secrets, invalidate_secrets
 
 
 def _signature_prepare(envelope, key, signature_method, digest_method):
@@ -186,6 +188,8 @@ def get_client(local=False, service="Human_Resources"):
         )
     except Exception as e:
         logger.error(e)
+        # a bad certificate or key may have been rotated, fetch the secrets again next time
+        invalidate_secrets()
         raise e
     finally:
         # the temp files need to be explicitly deleted, this is security flaw
@@ -5,21 +5,23 @@ except ImportError:
 
 import json
 import os
+from io import BytesIO
 
 import boto3
 
 try:
-    from process_deltas.helper_boto3 import fetchall_athena, get_record_count
-    from shared.helper import logger, upload_file
+    from process_deltas.helper_boto3 import fetchall_athena_concurrent, get_count_query, get_count
+    from shared.helper import logger
+    from lambda_common.s3_transfer import upload_fileobj
+    from lambda_common.manifest import Manifest, read_manifest
 except ModuleNotFoundError:
-    from helper_boto3 import fetchall_athena, get_record_count
+    from helper_boto3 import fetchall_athena_concurrent, get_count_query, get_count
     import sys
 
     sys.path.append("../")
-    from shared.helper import logger, upload_file
-
-
-reduced_file_path = "/tmp/costcenter.json"
+    from shared.helper import logger
+    from lambda_common.s3_transfer import upload_fileobj
+    from lambda_common.manifest import Manifest, read_manifest
 
 
 def lambda_handler(event, context):
@@ -43,21 +45,37 @@ def lambda_handler(event, context):
     athena = boto3.client("athena")
     sql_query = athena.get_named_query(NamedQueryId=query_id)["NamedQuery"]["QueryString"]
 
-    # execute the SQL query in Athena, returns a list of cost centers less those with inactive company codes
-    query_id, reduced_list = fetchall_athena(athena, sql_query, athena_wg, athena_db, s3_output)
-    logger.warning(f"Reduced costcenter QueryExecutionId: {query_id}")
-
-    # write it locally to lambda /tmp directory
-    with open(reduced_file_path, "w") as f:
-        for row in reduced_list:
-            f.write(json.dumps(row))
-            f.write("\n")
-
-    # upload it to data_bucket/costcenter_reduced_run/
-    upload_file(reduced_file_path, bucket, reduced_prefix, "costcenter.json")
+    # returns a list of cost centers less those with inactive company codes
+    queries = {"reduced": sql_query}
+
+    # get a count of # of reductions for comparison, from the manifest written by get_cost_center
+    s3_client = boto3.client("s3")
+    new_run_manifest = read_manifest(s3_client, bucket, f"{new_prefix}costcenter.json")
+    if new_run_manifest is not None:
+        new_run_count = new_run_manifest["count"]
+    else:
+        # uploaded without a manifest, count it in Athena alongside the reduction
+        queries["count"] = get_count_query(new_prefix[:-1])
+
+    # execute the SQL queries in Athena at the same time
+    for name, query_id, results in fetchall_athena_concurrent(
+        athena, queries, athena_wg, athena_db, s3_output
+    ):
+        logger.warning(f"{name} costcenter QueryExecutionId: {query_id}")
+        if name == "count":
+            new_run_count = get_count(results)
+            continue
+
+        # upload it to data_bucket/costcenter_reduced_run/ with its manifest, already in memory
+        reduced_list = results
+        body = "".join(json.dumps(row) + "\n" for row in reduced_list).encode()
+        manifest = Manifest()
+        manifest.update(body)
+        if reduced_list:
+            manifest.add_columns(reduced_list[0])
+        reduced_key = f"{reduced_prefix}costcenter.json"
+        upload_fileobj(s3_client, BytesIO(body), bucket, reduced_key, manifest.metadata())
 
-    # get a count of # of reductions for comparison
-    new_run_count = get_record_count(athena, athena_wg, athena_db, s3_output, new_prefix[:-1])
     reduced_count = new_run_count - len(reduced_list)
     logger.warning(
         f"Removed {reduced_count} costcenters (new_run: {new_run_count}, reduced: {len(reduced_list)})"
@@ -13,8 +13,12 @@ from process_deltas.helper_boto3 import (
     sqs_purge_queue,
     sqs_send_message_batch,
 )
+from process_deltas.helper_hierarchy import order_by_level
 from shared.helper import logger
 
+# hierarchies whose parents have to be sent to Workday before their children
+LEVELED_HIERARCHIES = ["onezeroone", "ninetwoone", "ninetwosix"]
+
 
 def lambda_handler(event, context):
     """
@@ -57,6 +61,9 @@ def lambda_handler(event, context):
         delta_list_ids = [delta["id"] for delta in delta_list]
         logger.warning(f"{hierarchy} ids w/ changes: " + ", ".join(map(str, delta_list_ids)))
 
+        if hierarchy in LEVELED_HIERARCHIES:
+            delta_list = order_deltas(hierarchy, delta_list)
+
         # costcenters use regular queue and fifo queue
         fifo = False if hierarchy == "costcenter" else True
         num_sent = sqs_send_message_batch(sqs_client, sqs_url, query_id, delta_list, fifo)
@@ -84,3 +91,17 @@ def lambda_handler(event, context):
         "date": event["date"],
         "mode": event["mode"],
     }
+
+
+def order_deltas(hierarchy, delta_list):
+    """deltas ordered by their level in the hierarchy, so parents are sent ahead of children"""
+    delta_list, levels = order_by_level(delta_list)
+    sizes = ", ".join(str(len(level)) for level in levels.levels())
+    logger.warning(f"{hierarchy} deltas per level: {sizes}")
+
+    if levels.orphans:
+        logger.warning(f"{hierarchy} ids w/ parents outside the deltas: {levels.orphans}")
+    if levels.cycles:
+        logger.error(f"{hierarchy} ids in a parent cycle, sent last: {levels.cycles}")
+
+    return delta_list
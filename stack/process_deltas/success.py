@@ -10,6 +10,7 @@ import boto3
 import botocore
 
 from shared.helper import logger
+from lambda_common.manifest import read_manifest
 
 
 def lambda_handler(event, context):
@@ -37,6 +38,12 @@ def lambda_handler(event, context):
 
     s3_client = boto3.client("s3")
 
+    # row counts of the files of the run, from the manifests they were written with
+    run_keys = {"new_run": new_key, "prev_run": prev_key}
+    if hierarchy == "costcenter":
+        run_keys["reduced_run"] = reduced_key
+    get_run_counts(s3_client, main_bucket, hierarchy, run_keys)
+
     # backup files in new_run, prev_run, and reduced_run
     backup_files(
         hierarchy,
@@ -86,6 +93,18 @@ def lambda_handler(event, context):
     execute_next(hierarchy, date, mode)
 
 
+def get_run_counts(s3_client, bucket, hierarchy, keys):
+    """row counts of the files of a run, files without a manifest are left out"""
+    counts = {}
+    for run, key in keys.items():
+        manifest = read_manifest(s3_client, bucket, key)
+        if manifest is not None:
+            counts[run] = manifest["count"]
+
+    logger.info(f"Row counts of the {hierarchy} run: {counts}")
+    return counts
+
+
 def backup_files(
     hierarchy, date, s3_client, main_bucket, backup_bucket, new_prefix, prev_prefix, reduced_prefix
 ):
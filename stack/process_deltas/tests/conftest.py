@@ -62,6 +62,11 @@ def secrets_manager(aws_credentials):
         conn = session.client("secretsmanager", region_name="us-east-1")
         response = conn.create_secret(Name="mysupersecret", SecretString=json.dumps(secrets))
         os.environ["SECRETS"] = "mysupersecret"
+
+        # secrets cached by an earlier test belong to another mocked secret
+        from lambda_common.secrets_cache import secrets_cache
+
+        secrets_cache.invalidate()
         yield conn
 
 
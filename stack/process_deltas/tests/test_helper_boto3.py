@@ -22,6 +22,242 @@ def test_fetchall_athena(aws_credentials, athena):
     assert 2 == 2
 
 
+def get_query_execution(state, **statistics):
+    return {
+        "QueryExecution": {
+            "Status": {"State": state, "StateChangeReason": f"query {state.lower()}"},
+            "Statistics": statistics,
+        }
+    }
+
+
+@patch("process_deltas.helper_boto3.time.sleep")
+def test_wait_for_query(mock_sleep):
+    """Polling starts fast and backs off up to the cap, stopping as soon as the query succeeds"""
+    from process_deltas.helper_boto3 import wait_for_query
+
+    client = mock.Mock()
+    client.get_query_execution.side_effect = [get_query_execution("QUEUED")] + [
+        get_query_execution("RUNNING") for _ in range(5)
+    ] + [
+        get_query_execution(
+            "SUCCEEDED",
+            QueryQueueTimeInMillis=250,
+            EngineExecutionTimeInMillis=1500,
+            TotalExecutionTimeInMillis=1800,
+        )
+    ]
+
+    stats = {}
+    query = wait_for_query(client, "123", stats, first=0.2, cap=1)
+
+    assert query["Status"]["State"] == "SUCCEEDED"
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.2, 0.4, 0.8, 1, 1, 1]
+    assert stats["queue_seconds"] == 0.25
+    assert stats["execution_seconds"] == 1.5
+    assert stats["total_seconds"] == 1.8
+
+
+@patch("process_deltas.helper_boto3.time.sleep")
+def test_wait_for_query_succeeded(mock_sleep):
+    """A query that already succeeded is not waited for"""
+    from process_deltas.helper_boto3 import wait_for_query
+
+    client = mock.Mock()
+    client.get_query_execution.return_value = get_query_execution("SUCCEEDED")
+
+    wait_for_query(client, "123")
+
+    assert mock_sleep.call_count == 0
+
+
+@patch("process_deltas.helper_boto3.time.sleep")
+def test_wait_for_query_failed(mock_sleep):
+    """The reason of a failed query is raised"""
+    from process_deltas.helper_boto3 import wait_for_query
+
+    client = mock.Mock()
+    client.get_query_execution.side_effect = [
+        get_query_execution("RUNNING"),
+        get_query_execution("FAILED"),
+    ]
+
+    with pytest.raises(Exception) as exc_info:
+        wait_for_query(client, "123")
+
+    assert str(exc_info.value) == "query failed"
+
+
+def test_parse_csv_record():
+    """Quoted values are unescaped, empty unquoted values are NULL"""
+    from process_deltas.helper_boto3 import parse_csv_record
+
+    assert parse_csv_record('"id","name","parentid"') == ["id", "name", "parentid"]
+    assert parse_csv_record('"1","say ""hi"", bye",') == ["1", 'say "hi", bye', None]
+    assert parse_csv_record(',"",') == [None, "", None]
+    assert parse_csv_record('"a\nb"') == ["a\nb"]
+
+
+def test_iter_csv_records():
+    """Records are split on newlines outside of quoted values, across chunks"""
+    from process_deltas.helper_boto3 import iter_csv_records
+
+    body = '"id","name"\n"1","two\nlines"\n"2","\u00e9"\n'.encode()
+    chunks = [body[i : i + 5] for i in range(0, len(body), 5)]
+
+    assert list(iter_csv_records(chunks)) == ['"id","name"', '"1","two\nlines"', '"2","\u00e9"']
+
+
+def get_athena_client(output_location, pages):
+    """Athena client for a query that succeeded, with get_query_results returning pages of rows"""
+    client = mock.Mock()
+    client.start_query_execution.return_value = {"QueryExecutionId": "123"}
+    execution = get_query_execution("SUCCEEDED")
+    execution["QueryExecution"]["ResultConfiguration"] = {"OutputLocation": output_location}
+    client.get_query_execution.return_value = execution
+    # NULL values have no VarCharValue
+    rows = [
+        [{"Data": [{} if value is None else {"VarCharValue": value} for value in row]} for row in page]
+        for page in pages
+    ]
+    client.get_paginator.return_value.paginate.return_value = [
+        {"ResultSet": {"Rows": page}} for page in rows
+    ]
+    return client
+
+
+def test_fetchall_athena_csv(aws_credentials, s3_data_bucket):
+    """Results are read from the CSV in the output location, the same as from get_query_results"""
+    from process_deltas.helper_boto3 import fetchall_athena
+
+    bucket = os.environ.get("BUCKET")
+    body = '"id","name","parentid"\n"1","a, ""b""",\n"2","",\n'
+    s3_data_bucket.put_object(Bucket=bucket, Key="athena/123.csv", Body=body.encode())
+    pages = [[["id", "name", "parentid"], ["1", 'a, "b"', None]], [["2", "", None]]]
+
+    client = get_athena_client(f"s3://{bucket}/athena/123.csv", pages)
+    query_id, results = fetchall_athena(client, "SELECT", "wg", "db", "s3://out/")
+
+    assert query_id == "123"
+    assert results == [
+        {"id": "1", "name": 'a, "b"', "parentid": None},
+        {"id": "2", "name": "", "parentid": None},
+    ]
+    assert client.get_paginator.call_count == 0
+
+    # without the CSV the results are paged through
+    client = get_athena_client(f"s3://{bucket}/athena/missing.csv", pages)
+    assert fetchall_athena(client, "SELECT", "wg", "db", "s3://out/")[1] == results
+    assert client.get_paginator.call_count == 1
+
+
+def test_fetchall_athena_cache(aws_credentials, s3_data_bucket, monkeypatch):
+    """An identical query over unchanged inputs reuses the results of the earlier execution"""
+    from process_deltas.helper_boto3 import fetchall_athena
+
+    bucket = os.environ.get("BUCKET")
+    monkeypatch.setenv("ONEZEROONE_NEW", "onezeroone_new_run/")
+    s3_data_bucket.put_object(Bucket=bucket, Key="onezeroone_new_run/101.json", Body=b"{}")
+    s3_output = f"s3://{bucket}/athena/"
+    pages = [[["id"], ["1"]]]
+
+    client = get_athena_client(f"s3://{bucket}/athena/missing.csv", pages)
+    results = fetchall_athena(client, "SELECT", "wg", "db", s3_output)
+    assert client.start_query_execution.call_count == 1
+
+    stats = {}
+    assert fetchall_athena(client, "SELECT", "wg", "db", s3_output, stats) == results
+    assert client.start_query_execution.call_count == 1
+    assert stats["reused"] is True
+
+    # another query isn't reused
+    fetchall_athena(client, "SELECT 1", "wg", "db", s3_output)
+    assert client.start_query_execution.call_count == 2
+
+    # a new upload to an input prefix changes the ETags
+    s3_data_bucket.put_object(Bucket=bucket, Key="onezeroone_new_run/101.json", Body=b"{ }")
+    fetchall_athena(client, "SELECT", "wg", "db", s3_output)
+    assert client.start_query_execution.call_count == 3
+
+
+def test_fetchall_athena_cache_failed(aws_credentials, s3_data_bucket):
+    """A cached query that no longer succeeds is run again"""
+    from process_deltas.helper_boto3 import fetchall_athena
+
+    bucket = os.environ.get("BUCKET")
+    s3_output = f"s3://{bucket}/athena"
+    client = get_athena_client(f"s3://{bucket}/athena/missing.csv", [[["id"], ["1"]]])
+    fetchall_athena(client, "SELECT", "wg", "db", s3_output)
+
+    client.get_query_execution.side_effect = [
+        get_query_execution("FAILED"),
+        client.get_query_execution.return_value,
+    ]
+    fetchall_athena(client, "SELECT", "wg", "db", s3_output)
+    assert client.start_query_execution.call_count == 2
+
+
+def get_batch_query_execution(*states):
+    """batch_get_query_execution response for query ids "1", "2", ... in the given states"""
+    executions = []
+    for query_id, state in states:
+        execution = get_query_execution(state)["QueryExecution"]
+        execution["QueryExecutionId"] = query_id
+        executions.append(execution)
+    return {"QueryExecutions": executions}
+
+
+@patch("process_deltas.helper_boto3.ATHENA_CACHE", False)
+@patch("process_deltas.helper_boto3.time.sleep")
+def test_fetchall_athena_concurrent(mock_sleep):
+    """Queries run at the same time and their results are returned as each one completes"""
+    from process_deltas.helper_boto3 import fetchall_athena_concurrent
+
+    client = get_athena_client("", [[["id"], ["1"]]])
+    client.start_query_execution.side_effect = [
+        {"QueryExecutionId": "1"},
+        {"QueryExecutionId": "2"},
+    ]
+    client.batch_get_query_execution.side_effect = [
+        get_batch_query_execution(("1", "RUNNING"), ("2", "QUEUED")),
+        get_batch_query_execution(("1", "RUNNING"), ("2", "SUCCEEDED")),
+        get_batch_query_execution(("1", "SUCCEEDED")),
+    ]
+
+    stats = {}
+    queries = {"slow": "SELECT 1", "fast": "SELECT 2"}
+    results = list(fetchall_athena_concurrent(client, queries, "wg", "db", "s3://out/", stats))
+
+    assert results == [("fast", "2", [{"id": "1"}]), ("slow", "1", [{"id": "1"}])]
+    assert client.start_query_execution.call_count == 2
+    polled = client.batch_get_query_execution.call_args_list
+    assert [call.kwargs["QueryExecutionIds"] for call in polled] == [["1", "2"], ["1", "2"], ["1"]]
+    assert [call.args[0] for call in mock_sleep.call_args_list] == [0.2, 0.4]
+    assert set(stats) == {"slow", "fast"}
+
+
+@patch("process_deltas.helper_boto3.ATHENA_CACHE", False)
+@patch("process_deltas.helper_boto3.time.sleep")
+def test_fetchall_athena_concurrent_failed(mock_sleep):
+    """The reason of any failed query is raised"""
+    from process_deltas.helper_boto3 import fetchall_athena_concurrent
+
+    client = get_athena_client("", [])
+    client.start_query_execution.side_effect = [
+        {"QueryExecutionId": "1"},
+        {"QueryExecutionId": "2"},
+    ]
+    client.batch_get_query_execution.return_value = get_batch_query_execution(
+        ("1", "RUNNING"), ("2", "FAILED")
+    )
+
+    with pytest.raises(Exception) as exc_info:
+        queries = {"a": "SELECT 1", "b": "SELECT 2"}
+        list(fetchall_athena_concurrent(client, queries, "wg", "db", "s3://out/"))
+
+    assert str(exc_info.value) == "query failed"
+
+
 @patch("process_deltas.helper_boto3.fetchall_athena", return_value=("123", [{"_col0": "86725"}]))
 def test_get_record_count(mock_fetchall_athena, aws_credentials, athena):
     """testing getting count of records in a table using fetchall_athena"""
@@ -0,0 +1,69 @@
+import pytest
+from process_deltas.helper_hierarchy import Hierarchy, order_by_level
+
+
+def get_rows(parents):
+    return [{"id": node, "parentid": parent, "name": f"Name {node}"} for node, parent in parents]
+
+
+def test_hierarchy_levels():
+    """Parents are on a lower level than their children"""
+    rows = get_rows(
+        [("C", "B"), ("A", ""), ("B", "A"), ("D", "B"), ("E", "A"), ("F", "F"), ("G", "F")]
+    )
+    hierarchy = Hierarchy(rows)
+
+    assert hierarchy.roots == ["A", "F"]
+    assert hierarchy.children == {"B": ["C", "D"], "A": ["B", "E"], "F": ["G"]}
+    assert hierarchy.level == {"A": 0, "F": 0, "B": 1, "E": 1, "G": 1, "C": 2, "D": 2}
+    assert [[row["id"] for row in level] for level in hierarchy.levels()] == [
+        ["A", "F"],
+        ["B", "E", "G"],
+        ["C", "D"],
+    ]
+    assert hierarchy.orphans == []
+    assert hierarchy.cycles == []
+
+
+def test_hierarchy_orphans():
+    """Nodes whose parent isn't in the deltas start a level 0, their parent is already in Workday"""
+    hierarchy = Hierarchy(get_rows([("B", "A"), ("C", "B"), ("D", None)]))
+
+    assert hierarchy.orphans == ["B"]
+    assert hierarchy.level == {"D": 0, "B": 0, "C": 1}
+
+
+def test_hierarchy_cycles():
+    """Cycles are reported, and neither they nor the nodes below them get a level"""
+    hierarchy = Hierarchy(
+        get_rows([("A", None), ("B", "C"), ("C", "D"), ("D", "B"), ("E", "D"), ("F", "A")])
+    )
+
+    assert hierarchy.cycles == [["B", "C", "D"]]
+    assert hierarchy.unreachable == ["B", "C", "D", "E"]
+    assert hierarchy.level == {"A": 0, "F": 1}
+
+
+def test_hierarchy_deep():
+    """Deep hierarchies don't recurse"""
+    rows = get_rows([(i, i - 1 if i else None) for i in range(100000)])
+    hierarchy = Hierarchy(reversed(rows))
+
+    assert hierarchy.level[99999] == 99999
+    assert len(hierarchy.levels()) == 100000
+
+
+def test_order_by_level():
+    """Every row is kept, ordered by level and then by the order it was given"""
+    rows = get_rows([("C", "B"), ("B", "A"), ("X", "Y"), ("Y", "X"), ("A", None), ("C", "B")])
+    ordered, hierarchy = order_by_level(rows)
+
+    assert [row["id"] for row in ordered] == ["A", "B", "C", "C", "X", "Y"]
+    assert hierarchy.cycles == [["X", "Y"]]
+
+
+def test_order_by_level_without_parentid():
+    """Rows without a parentid are all on level 0 and keep their order"""
+    rows = [{"id": 3}, {"id": 1}, {"id": 2}]
+
+    assert order_by_level(rows)[0] == rows
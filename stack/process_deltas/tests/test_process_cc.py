@@ -13,6 +13,13 @@ results = [{"id": random.randint(0, 9), "data": random.choice("abcdefg")} for _
 difference = 5
 
 
+def fetchall_results(client, queries, workgroup, db_name, s3_output):
+    """results of the reduction and count queries, the count finishing first"""
+    if "count" in queries:
+        yield "count", "7654321", [{"_col0": str(len(results) + difference)}]
+    yield "reduced", "1234567", results
+
+
 @pytest.mark.dependency()
 def test_upload_file(aws_credentials, s3_data_bucket):
     from shared.helper import upload_file
@@ -40,20 +47,18 @@ def test_upload_file(aws_credentials, s3_data_bucket):
 
 
 @pytest.mark.dependency(depends=["test_upload_file"])
-@patch("process_deltas.helper_boto3.fetchall_athena", return_value=("1234567", results))
-@patch("process_deltas.helper_boto3.get_record_count", return_value=(len(results) + difference))
-def test_lambda_handler_count(
-    mock_get_record_count, mock_athena_results, aws_credentials, athena, sqs, s3_data_bucket
-):
+@patch("process_deltas.process_cc.fetchall_athena_concurrent", side_effect=fetchall_results)
+def test_lambda_handler_count(mock_athena_results, aws_credentials, athena, sqs, s3_data_bucket):
     """get the count of the reduced cost centers"""
-    from process_deltas import process_cc
     from process_deltas.process_cc import lambda_handler
 
     event = {"hierarchy": "costcenter", "date": "2020-07-17", "mode": "continue"}
 
-    process_cc.reduced_file_path = test_file_dir + "costcenter.json"
     response = lambda_handler(event, "")
 
+    # without a manifest, the count query runs at the same time as the reduction
+    assert list(mock_athena_results.call_args.args[1]) == ["reduced", "count"]
+
     expected_response = {
         "hierarchy": "costcenter",
         "date": "2020-07-17",
@@ -65,17 +70,12 @@ def test_lambda_handler_count(
 
 
 @pytest.mark.dependency(depends=["test_upload_file"])
-@patch("process_deltas.helper_boto3.fetchall_athena", return_value=("1234567", results))
-@patch("process_deltas.helper_boto3.get_record_count", return_value=(len(results) + difference))
-def test_lambda_handler_s3(
-    mock_get_record_count, mock_athena_results, aws_credentials, athena, s3_data_bucket
-):
+@patch("process_deltas.process_cc.fetchall_athena_concurrent", side_effect=fetchall_results)
+def test_lambda_handler_s3(mock_athena_results, aws_credentials, athena, s3_data_bucket):
     """check that the data read from the reduction athena query is written to reduced_run/ prefix in s3"""
-    from process_deltas import process_cc
     from process_deltas.process_cc import lambda_handler
 
     event = {"hierarchy": "costcenter", "date": "2020-07-17", "mode": "continue"}
-    process_cc.reduced_file_path = test_file_dir + "costcenter.json"
     response = lambda_handler(event, "")
     assert response["reduced_count"] == difference
 
@@ -86,6 +86,36 @@ def test_lambda_handler_s3(
     response = client.get_object(Bucket=bucket, Key=f"{prefix}costcenter.json")
     rows = response["Body"].read().decode("utf-8").split("\n")
 
+    assert response["ServerSideEncryption"] == "AES256"
+
     # check that it is the same as the results received from fetchall_athena for the reduction query
     for i in range(len(results)):
         assert json.loads(rows[i]) == results[i]
+
+
+@patch("process_deltas.process_cc.fetchall_athena_concurrent", side_effect=fetchall_results)
+def test_lambda_handler_manifest(mock_athena_results, aws_credentials, athena, s3_data_bucket):
+    """the new_run count is read from the manifest of new_run/, without a count query"""
+    from process_deltas import process_cc
+    from lambda_common.manifest import read_manifest
+
+    bucket = os.environ.get("BUCKET")
+    client = boto3.client("s3")
+    client.put_object(
+        Bucket=bucket,
+        Key=f"{os.environ.get('COSTCENTER_NEW')}costcenter.json",
+        Body=b"",
+        Metadata={"row-count": str(len(results) + difference)},
+    )
+
+    event = {"hierarchy": "costcenter", "date": "2020-07-17", "mode": "continue"}
+    response = process_cc.lambda_handler(event, "")
+
+    assert response["reduced_count"] == difference
+    assert list(mock_athena_results.call_args.args[1]) == ["reduced"]
+
+    # the reduced rows are written with their own manifest
+    key = f"{os.environ.get('COSTCENTER_REDUCED')}costcenter.json"
+    manifest = read_manifest(client, bucket, key)
+    assert manifest["count"] == len(results)
+    assert manifest["columns"] == ["id", "data"]
@@ -67,6 +67,21 @@ def test_copy_object_nonexistent(aws_credentials, s3_data_bucket):
     assert response["ResponseMetadata"]["HTTPStatusCode"] == 200
 
 
+def test_get_run_counts(aws_credentials, s3_data_bucket):
+    """counts are read from the manifests, files without one are left out"""
+    from process_deltas.success import get_run_counts
+
+    client = boto3.client("s3")
+    bucket = os.environ.get("BUCKET")
+    client.put_object(
+        Bucket=bucket, Key="site_new_run/site.json", Body=b"", Metadata={"row-count": "12"}
+    )
+    client.put_object(Bucket=bucket, Key="site_prev_run/site.json", Body=b"")
+
+    keys = {"new_run": "site_new_run/site.json", "prev_run": "site_prev_run/site.json"}
+    assert get_run_counts(client, bucket, "site", keys) == {"new_run": 12}
+
+
 """Test execute_next() in success.py"""
 
 
@@ -127,3 +127,28 @@ def test_trigger_step_manual(aws_credentials, step_function, s3_data_bucket, hie
 
     assert len(get_execution(aws_credentials, step_function)) == 0
 
+
+
+def test_trigger_step_unchanged(aws_credentials, step_function, s3_data_bucket):
+    """No step function runs when every file of the chain is the same as the one processed"""
+    from process_deltas.trigger_step import lambda_handler
+
+    bucket = os.environ.get("BUCKET")
+    for hierarchy in ("ninetwoone", "site", "building"):
+        for prefix in (f"{hierarchy}_new_run/", f"{hierarchy}_prev_run/"):
+            s3_data_bucket.put_object(
+                Bucket=bucket,
+                Key=f"{prefix}{hierarchy}.json",
+                Body=b"{}",
+                Metadata={"content-sha256": hierarchy},
+            )
+
+    lambda_handler(get_event("building"), "")
+    assert len(get_execution(aws_credentials, step_function)) == 0
+
+    # a change in any file of the chain runs it
+    s3_data_bucket.put_object(
+        Bucket=bucket, Key="site_new_run/site.json", Body=b"{}", Metadata={"content-sha256": "new"}
+    )
+    lambda_handler(get_event("building"), "")
+    assert f"ninetwoone_{dt}" in get_execution(aws_credentials, step_function)[0]["name"]
@@ -6,8 +6,17 @@ import os
 from datetime import date, datetime
 
 import boto3
+import botocore
 
 from shared.helper import logger
+from lambda_common.manifest import CONTENT_HASH_METADATA
+
+# hierarchies whose new_run/ files are compared by the step functions a trigger starts
+CHAINS = {
+    "onezeroone": ["onezeroone", "companycode"],
+    "ninetwosix": ["ninetwosix", "costcenter"],
+    "ninetwoone": ["ninetwoone", "site", "building"],
+}
 
 
 def lambda_handler(event, context):
@@ -33,6 +42,11 @@ def lambda_handler(event, context):
         bucket = s3_event["bucket"]["name"]
         prefix = key.split("/")[0]
         file = key.split("/")[1]
+
+        if "_new_run" not in prefix:
+            # staging and snapshot objects written by the extracts are not new runs
+            logger.info(f"{key} is not a new run, step function not triggered")
+            return
     except KeyError:
         # not coming from s3 trigger
         prefix = event["hierarchy"]
@@ -51,6 +65,11 @@ def lambda_handler(event, context):
         # if the s3 dump comes from a manually triggered test. then don't continue
         return
 
+    if is_chain_unchanged(boto3.client("s3"), expected_bucket, hierarchy):
+        # every extract is the same as the one already processed, nothing to send to Workday
+        logger.info(f"no change for {hierarchy}, step function not triggered")
+        return
+
     mode = "continue"
     dt = date.today().strftime("%Y-%m-%d")
     input_config = '{"hierarchy" : "%s", "date": "%s", "mode" : "%s"}' % (hierarchy, dt, mode)
@@ -68,3 +87,28 @@ def lambda_handler(event, context):
         raise Exception("failed to invoke State Machine")
     else:
         logger.info(f"triggered step function for {hierarchy}")
+
+
+def is_chain_unchanged(s3_client, bucket, hierarchy):
+    """
+    True when every new_run/ file of the chain has the same content hash as its prev_run/ file.
+    Files without a hash, or missing, count as changed
+    """
+    for chained in CHAINS[hierarchy]:
+        new_key = f"{os.environ.get(f'{chained.upper()}_NEW')}{chained}.json"
+        prev_key = f"{os.environ.get(f'{chained.upper()}_OLD')}{chained}.json"
+
+        new_hash = get_content_hash(s3_client, bucket, new_key)
+        if new_hash is None or new_hash != get_content_hash(s3_client, bucket, prev_key):
+            return False
+
+    return True
+
+
+def get_content_hash(s3_client, bucket, key):
+    """content hash stored on the object, None when it's missing"""
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError:
+        return None
+    return response.get("Metadata", {}).get(CONTENT_HASH_METADATA)